@@ -30,33 +30,33 @@ import re
 OSM_FILE = "austin_texas.osm"
 SAMPLE_FILE = "sample.osm"
 
+# With PROFILE on, the passes over the full extract print a progress line
+# every 10 seconds and time each stage (parsing, shape_element, timestamp
+# parsing, street and postcode cleanup, JSON encoding); see osm_progress.
+# Off, the stage wrappers below hand back the plain functions.
+from osm_progress import Instrument
 
-# In[ ]:
-
-k = 10
+PROFILE = False
+instrument = Instrument(enabled=PROFILE)
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag Reference: http://stackoverflow.com/questions/
-    3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
 
+# In[ ]:
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+# get_element is shared by every pass below: it clears each element from the
+# tree once it has been processed, so memory stays flat however big the file.
+# It also reads the compressed download (austin_texas.osm.bz2 or .gz) and
+# the PBF extract (austin_texas.osm.pbf, decoded by osm_pbf) directly; the
+# sampler, index and parallel passes need byte offsets into the uncompressed
+# XML file, though.
+from osm_stream import get_element
+from osm_sample import sample, EveryKth
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+k = 10
 
-    output.write('</osm>')
+# Copy every kth top level element straight from the source bytes, plus the
+# nodes the sampled ways need. Reservoir(size) and BoundingBox(...) are the
+# other strategies in osm_sample.
+sample(OSM_FILE, SAMPLE_FILE, EveryKth(k))
 
 
 # After loading the sample data, lets parse one tag at a time with ElementTree and count the number of top level tags. Iterative parsing is utilized for this as data is too large to process on the complete document
@@ -68,16 +68,20 @@ def count_tags(filename):
     
     Init 1 in dict if the key not exist, increment otherwise."""
     tags = {}
-    for ev, elem in ET.iterparse(filename):
-        tag = elem.tag
-        if tag not in tags.keys():
-            tags[tag] = 1
+
+    def add(elem):
+        if elem.tag not in tags:
+            tags[elem.tag] = 1
         else:
-            tags[tag] += 1
+            tags[elem.tag] += 1
+
+    for elem in get_element(filename, tags=None, on_root=add):
+        for e in elem.iter():
+            add(e)
     return tags
 
 
-tags = count_tags(OSM_FILE)
+tags = count_tags(SAMPLE_FILE)
 pprint.pprint(tags)
 
 
@@ -89,52 +93,43 @@ pprint.pprint(tags)
 
 # In[4]:
 
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+# The regexes live in osm_keys; classify_key runs them once per distinct key
+# and answers repeated keys from a bounded cache.
+from osm_keys import lower, lower_colon, problemchars, classify_key
 
 
 def key_type(element, keys):
     if element.tag == "tag":
-        for tag in element.iter('tag'):
-            k = tag.get('k')
-            if lower.search(k):
-                keys['lower'] += 1
-            elif lower_colon.search(k):
-                keys['lower_colon'] += 1
-            elif problemchars.search(k):
-                keys['problemchars'] += 1
-            else:
-                keys['other'] += 1
+        keys[classify_key(element.get('k'))] += 1
     return keys
 
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    for element in get_element(filename):
+        for tag in element.iter('tag'):
+            keys = key_type(tag, keys)
     return keys
 
 
-keys = process_map(OSM_FILE)
+keys = process_map(SAMPLE_FILE)
 pprint.pprint(keys)
 
 
-# Next, let's now find out how many unique users have contributed to the map in this osm, following code gives us 1260 different unique users who have contributed to the street map
+# Next, let's now find out how many unique users have contributed to the map in this osm. On the sample the following code only sees the users of every 10th element; the single pass over the full extract below gives us 1260 different unique users who have contributed to the street map
 
 # In[5]:
 
 def process_map_users(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
-        for e in element:
-            if 'uid' in e.attrib:
-                users.add(e.attrib['uid'])
+    for element in get_element(filename):
+        if 'uid' in element.attrib:
+            users.add(element.attrib['uid'])
 
     return users
 
 
-users = process_map_users(OSM_FILE)
+users = process_map_users(SAMPLE_FILE)
 len(users)
 
 
@@ -182,17 +177,15 @@ def is_street_name(elem):
 # In[9]:
 
 def audit(osmfile, regex):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
 
     # iteratively parse the mapping xml
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    for elem in get_element(osmfile, tags=("node", "way")):
         # iterate 'tag' tags within 'node' and 'way' tags
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'],
-                                      regex, expected_street_types)
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'],
+                                  regex, expected_street_types)
 
     return street_types
 
@@ -201,7 +194,7 @@ def audit(osmfile, regex):
 
 # In[10]:
 
-street_types = audit(OSM_FILE, street_type_reg)
+street_types = audit(SAMPLE_FILE, street_type_reg)
 pprint.pprint(dict(street_types), depth = 10)
 
 
@@ -211,15 +204,18 @@ pprint.pprint(dict(street_types), depth = 10)
 
 # In[11]:
 
+# The mapping is compiled once into a single pattern (osm_streets), so
+# multi-word keys like 'IH 35' match too and repeated names come from a cache.
+# Only the street type at the end of the name is expanded (anchored), so
+# 'St. Johns Ave' becomes 'St. Johns Avenue', not 'Street Johns Avenue'.
+# Words after 'Suite'/'Ste' are left alone: don't update 'Suite E' to 'Suite East'
+from osm_streets import normalizer
+
+
 def update(name, mapping): 
-    words = name.split()
-    for w in range(len(words)):
-        if words[w] in mapping:
-            if words[w].lower() not in ['suite', 'ste.', 'ste']: 
-                # For example, don't update 'Suite E' to 'Suite East'
-                words[w] = mapping[words[w]] 
-                name = " ".join(words)
-    return name
+    return normalizer(mapping, anchored=True)(name)
+
+update = instrument.timed('street cleanup', update)
 
 
 # In[12]:
@@ -249,10 +245,16 @@ street_type_mapping = {'Ave':'Avenue','Ave.':'Avenue','Avene':'Avenue',
 
 # In[13]:
 
-for street_type, ways in street_types.iteritems():
-    for name in ways:
-        better_name = update(name, street_type_mapping)
-        print name, "=>", better_name
+def print_street_updates(street_types):
+    for street_type, ways in street_types.iteritems():
+        names = list(ways)
+        better_names = normalizer(street_type_mapping,
+                                  anchored=True).normalize_many(names)
+        for name, better_name in zip(names, better_names):
+            print name, "=>", better_name
+
+
+print_street_updates(street_types)
 
 
 # As seen above the mapping has been applied correctly to give full forms for cardinal directions and Ln, Dr, etc. Also updated IH-35/I-35 etc to 'Interstate Highway 35'(major highway in austin connecting San Antonio and Dallas)
@@ -261,22 +263,13 @@ for street_type, ways in street_types.iteritems():
 
 # In[14]:
 
+from osm_postcodes import (AUSTIN_ZIPS, normalize_postcode,
+                           normalize_postcodes)
+
 zip_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 zip_types = defaultdict(set)
-expected_zip = ["73301","73344","76574","78602","78610","78612",
-                "78613","78615","78616","78617","78619","78620",
-                "78621","78626","78628","78634","78640","78641",
-                "78642","78644","78645","78646","78652","78653",
-                "78654","78656","78660","78663","78664","78665",
-                "78666","78669","78676","78680","78681","78682",
-                "78691","78701","78702","78703","78704","78705",
-                "78712","78717","78719","78721","78722","78723",
-                "78724","78725","78726","78727","78728","78729",
-                "78730","78731","78732","78733","78734","78735",
-                "78736","78737","78738","78739","78741","78742",
-                "78744","78745","78746","78747","78748","78749",
-                "78750","78751","78752","78753","78754","78756",
-                "78757","78758","78759","78957"]
+# Valid Austin area ZIP codes, kept as a frozenset in osm_postcodes for O(1) lookups
+expected_zip = AUSTIN_ZIPS
 def audit_zip_codes(zip_types, zip_name, regex, expected_zip):
     m = regex.search(zip_name)
     if m:
@@ -286,45 +279,57 @@ def audit_zip_codes(zip_types, zip_name, regex, expected_zip):
 def is_zip_name(elem):
     return (elem.attrib['k'] == "addr:postcode")
 def audit(filename, regex):
-    for event, elem in ET.iterparse(filename, events=("start",)):
-        if elem.tag == "way" or elem.tag == "node":
-            for tag in elem.iter("tag"):
-                if is_zip_name(tag):
-                    audit_zip_codes(zip_types, tag.attrib['v'], 
-                                    regex, expected_zip)
+    for elem in get_element(filename, tags=("node", "way")):
+        for tag in elem.iter("tag"):
+            if is_zip_name(tag):
+                audit_zip_codes(zip_types, tag.attrib['v'], 
+                                regex, expected_zip)
     return zip_types
 
 
 # In[15]:
 
-audit(OSM_FILE, zip_type_re)
+audit(SAMPLE_FILE, zip_type_re)
 pprint.pprint(dict(zip_types))
 
 
-# To standardize the zipcodes, I will keep the first 5 digits in the postal code and drop the digits after the hyphen.
+# To standardize the zipcodes, I will keep the first 5 digits in the postal code and drop the digits after the hyphen. osm_postcodes also handles ZIP+4 without a hyphen and codes prefixed with the state, like "TX 78701".
 
 # In[16]:
 
 def update_zip(postcode):
-    return postcode.split("-")[0]
+    return normalize_postcode(postcode)
+
+update_zip = instrument.timed('postcode cleanup', update_zip)
 
 
 # In[18]:
 
-for zip_type, ways in zip_types.iteritems():
-    for postal in ways:
-        better_zip = update_zip(postal)
-        print postal, "=>", better_zip
+def print_zip_updates(zip_types):
+    for zip_type, ways in zip_types.iteritems():
+        postals = list(ways)
+        for postal, better_zip in zip(postals, normalize_postcodes(postals)):
+            print postal, "=>", better_zip
+
+
+print_zip_updates(zip_types)
 
 
 # ## Preparing for Mongo DB
 
 # In[19]:
 
-from datetime import datetime as dt
+from osm_time import parse_timestamp, timestamp_epoch
+
+parse_timestamp = instrument.timed('timestamp', parse_timestamp)
+timestamp_epoch = instrument.timed('timestamp', timestamp_epoch)
 
 CREATED = ["version", "changeset", "timestamp", "user", "uid"]
 
+# Store created.timestamp as int seconds since the epoch instead of a
+# datetime: cheaper to serialize and sort
+TIMESTAMP_AS_EPOCH = False
+
 def shape_element(element):
     node = {}    
     if element.tag == "node" or element.tag == "way" :
@@ -338,8 +343,10 @@ def shape_element(element):
                 if 'created' not in node:
                     node['created'] = {}
                 if attrib == 'timestamp':
-                    node['created'][attrib] = dt.strptime(element.attrib[attrib], 
-                                                                '%Y-%m-%dT%H:%M:%SZ')
+                    if TIMESTAMP_AS_EPOCH:
+                        node['created'][attrib] = timestamp_epoch(element.attrib[attrib])
+                    else:
+                        node['created'][attrib] = parse_timestamp(element.attrib[attrib])
                 else:
                     node['created'][attrib] = element.get(attrib)
 
@@ -357,10 +364,11 @@ def shape_element(element):
         for tag in element.iter('tag'):
             key   = tag.attrib['k']
             value = tag.attrib['v']
-            if not problemchars.search(key):
+            category = classify_key(key)
+            if category != 'problemchars':
 
                 # Tags with single colon and beginning with addr
-                if lower_colon.search(key) and key.find('addr') == 0:
+                if category == 'lower_colon' and key.find('addr') == 0:
                     if 'address' not in node:
                         node['address'] = {}
                     sub_attr = key.split(':')[1]
@@ -369,7 +377,7 @@ def shape_element(element):
                         better_name = update(tag.attrib['v'],
                         street_type_mapping)
                         node['address'][sub_attr] = better_name
-                    if key == 'postcode' or key == 'addr:postcode':
+                    elif key == 'postcode' or key == 'addr:postcode':
                         node['address'][sub_attr]=update_zip(tag.attrib['v'])
                     else:    
                         node['address'][sub_attr] = value
@@ -392,31 +400,174 @@ def shape_element(element):
     else:
         return None
 
+shape_element = instrument.timed('shape_element', shape_element)
+
 
 # #### Write JSON file
 
 # In[21]:
 
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-
 import json
 from bson import json_util
-
-def process_map(file_in, pretty = False):
-    file_out = "{0}.json".format(file_in)    
-    with open(file_out, "wb") as fo:
-        for _, element in ET.iterparse(file_in):
+from osm_output import JsonWriter
+
+from osm_checkpoint import run_checkpointed
+from osm_engine import Shaper
+from osm_output import compression_of, is_pbf
+
+# JsonWriter serializes in batches (with orjson when it is installed) and
+# compresses the output when file_out ends in .gz, .bz2 or .zst.
+# Exports from the plain XML file to an uncompressed file save a checkpoint
+# every 100,000 elements (file_out + ".checkpoint"); if the export dies,
+# calling process_map again picks up where it stopped. Like the plain loop,
+# the checkpointed export parses in one process (run_checkpointed is
+# serial), and the Shaper times its JSON encoding as 'json' too
+def process_map(file_in, pretty = False, file_out = None):
+    if file_out is None:
+        file_out = "{0}.json".format(file_in)
+    instrument.reset()
+    if compression_of(file_in) is None and not is_pbf(file_in) and \
+            compression_of(file_out) is None:
+        shaper = Shaper(shape_element, file_out, pretty,
+                        default=json_util.default, instrument=instrument)
+        run_checkpointed(file_in, {'json': shaper}, file_out + ".checkpoint",
+                         instrument=instrument)
+        instrument.finish(file_out + ".profile.json")
+        return
+    with JsonWriter(file_out, default=json_util.default,
+                    pretty=pretty) as writer:
+        writer.encode = instrument.timed('json', writer.encode)
+        for element in instrument.elements(file_in, tags=("node", "way")):
             el = shape_element(element)
             if el:
-                if pretty:
-                    fo.write(json.dumps(el, indent=2,
-                                        default=json_util.default)+"\n")
-                else:
-                    fo.write(json.dumps(el,default=json_util.default)+"\n")
+                writer.write(el)
+    instrument.finish(file_out + ".profile.json")
+
+
+# #### Single pass over the full extract
+
+# Each of the functions above reads the whole file again, so the exploration cells only run them on the sample. For the full extract they are registered together as visitors of one streaming pass: the 1.4 GB file is parsed once for the tag counts, key types, users, street and postcode audits, address count and the JSON export. With processes=None the file is cut into byte ranges at element boundaries and parsed on every core; the partial results are merged back in file order, so they are identical to a serial run.
+
+# In[ ]:
+
+from osm_engine import (run_visitors, TagCounter, KeyTypeCounter,
+                        UserCollector, TagAuditor, AddressCounter, Shaper)
+from osm_index import load_index
+from osm_columnar import ColumnarExport
+from osm_nodes import NodeStoreBuilder
+from osm_summary import SummaryBuilder
+from osm_intern import EncodedShaper, InternedShape
+
+# Byte offsets of every node/way/relation, built once into austin_texas.osm.idx
+index = load_index(OSM_FILE)
+
+# The JSON, columnar, summary and encoded exports all take the shaped
+# document: shape= shapes every element once, with its repeated strings
+# interned, and hands that one document to all four
+
+instrument.reset()
+results = run_visitors(OSM_FILE, {
+    'tags': TagCounter(),
+    'keys': KeyTypeCounter(key_type),
+    'users': UserCollector(),
+    'street_types': TagAuditor(is_street_name, audit_street_type,
+                               street_type_reg, expected_street_types),
+    'zip_types': TagAuditor(is_zip_name, audit_zip_codes,
+                            zip_type_re, expected_zip),
+    'address_count': AddressCounter(is_street_name),
+    'json': Shaper(shape_element, OSM_FILE + ".json",
+                   default=json_util.default, instrument=instrument),
+    'columns': ColumnarExport(shape_element, OSM_FILE + ".columns"),
+    'nodes': NodeStoreBuilder(OSM_FILE + ".nodes", fixed_point=True),
+    'summary': SummaryBuilder(shape_element, OSM_FILE + ".summary.json"),
+    'encoded': EncodedShaper(shape_element, OSM_FILE + ".encoded.json",
+                             default=json_util.default,
+                             instrument=instrument)},
+    processes=None, index=index, instrument=instrument,
+    shape=InternedShape(shape_element))
+instrument.finish(OSM_FILE + ".profile.json")
+
+pprint.pprint(results['tags'])
+pprint.pprint(results['keys'])
+len(results['users'])
+
+
+# The street and postcode audits of the same pass cover the full extract, so the cleanup is checked on every unexpected street type and postcode, not just those of the sample.
+
+# In[ ]:
+
+print_street_updates(results['street_types'])
+print_zip_updates(results['zip_types'])
+
+
+# The index also gives random access: a single element can be shaped without re-parsing the file.
+
+# In[ ]:
+
+first_way = index.arrays['way'][0][0]
+pprint.pprint(shape_element(index.get('way', first_way)))
+
+
+# The same pass wrote a columnar copy of the shaped data to austin_texas.osm.columns: one .npy file per column, with users and tag keys/values dictionary encoded. It is much smaller than the JSON and loads through mmap instead of being re-parsed.
+
+# In[ ]:
+
+from osm_columnar import load_columnar
+
+columns, dictionaries = load_columnar(OSM_FILE + ".columns")
+print 'nodes: {}, ways: {}, tags: {}'.format(len(columns['nodes.id']),
+                                             len(columns['ways.id']),
+                                             len(columns['tags.key']))
+
+
+# Node coordinates were also kept in a compact store (int64 ids and fixed point int32 lat/lon, 16 bytes per node) for id -> (lat, lon) lookups by binary search.
+
+# In[ ]:
+
+from osm_nodes import NodeStore
+
+nodes = NodeStore.load(OSM_FILE + ".nodes")
+nodes.lookup(nodes.ids[0])
+
+
+# With both, every way's node_refs can be resolved to coordinates in bulk: bounding boxes, centroids and lengths of all roads and buildings.
+
+# In[ ]:
 
-process_map(OSM_FILE)
+from osm_geometry import geometry_from_columns
+
+geometry = geometry_from_columns(columns, nodes)
+print 'Total length of ways: {:.0f} km'.format(geometry['length_m'].sum()
+                                               / 1000.0)
+
+
+# Node positions and way bounding boxes go into a grid index, saved next to the extract, for box, radius and nearest-neighbour queries without MongoDB.
+
+# In[ ]:
+
+from osm_spatial import SpatialIndex, build_spatial_index
+
+build_spatial_index(nodes, columns['ways.id'], geometry).save(OSM_FILE + ".grid")
+grid = SpatialIndex.load(OSM_FILE + ".grid")
+
+# Everything within 200 m of the Texas State Capitol
+kinds, ids, distances = grid.radius(30.2747, -97.7404, 200)
+len(ids)
+
+
+# User names, uids, changesets, tag keys and common values repeat across elements. Interning them gives every document the same shared string objects, and the encoded export (austin_texas.osm.encoded.json plus the austin_texas.osm.encoded.json.dict.json tables) writes integer codes instead. On sample.osm repeated 10 times (256k nodes) the shaped documents take 167 MB instead of 229 MB, and the export is 60 MB instead of 82 MB.
+
+# In[ ]:
+
+from osm_benchmark import scale_osm
+from osm_intern import measure, export_sizes
+
+# sample.osm is too small to show it: measure on ten shifted copies
+scaled_sample = SAMPLE_FILE + ".x10.osm"
+scale_osm(SAMPLE_FILE, scaled_sample, 10)
+pprint.pprint(measure(scaled_sample, shape_element))
+pprint.pprint(export_sizes(scaled_sample, shape_element,
+                           default=json_util.default))
 
 
 # ## Overview of the Data
@@ -440,70 +591,119 @@ print 'The json file is {} MB'.format(os.path.getsize(OSM_FILE + ".json")
 
 # In[24]:
 
-osm_file = open(OSM_FILE, "r")
-address_count = 0
-
-for event, elem in ET.iterparse(osm_file, events=("start",)):
-    if elem.tag == "node" or elem.tag == "way":
-        for tag in elem.iter("tag"): 
-            if is_street_name(tag):
-                address_count += 1
+address_count = results['address_count']
 
 address_count
 
 
 # ## Working with MongoDB
 
+# The queries below run on osm_aggregate, an embedded engine that streams the JSON file and evaluates the same find/distinct/aggregate calls in process, so the report does not need a mongod server. Set USE_MONGO to load the data into MongoDB and run them there instead.
+
 # In[25]:
 
+USE_MONGO = False
+
 import signal
 import subprocess
 
-# The os.setsid() is passed in the argument preexec_fn so
-# it's run after the fork() and before  exec() to run the shell.
-pro = subprocess.Popen('mongod', preexec_fn = os.setsid)
+if USE_MONGO:
+    # The os.setsid() is passed in the argument preexec_fn so
+    # it's run after the fork() and before  exec() to run the shell.
+    pro = subprocess.Popen('mongod', preexec_fn = os.setsid)
 
 
 # #### Connect to database with PyMongo
 
 # In[26]:
 
-from pymongo import MongoClient
-
 db_name = 'openstreetmap'
 
-# Connect to Mongo DB
-client = MongoClient('localhost:27017')
-# Database 'openstreetmap' will be created if it does not exist.
-db = client[db_name]
+if USE_MONGO:
+    from osm_mongo import get_client
+
+    # Connect to Mongo DB; the loader below reuses this same client
+    client = get_client('localhost:27017')
+    # Database 'openstreetmap' will be created if it does not exist.
+    db = client[db_name]
 
 
-# #### Import data set
+# #### Load data set
 
 # In[32]:
 
-# Build mongoimport command
+from osm_mongo import BulkLoader, MongoTarget
+
 collection = OSM_FILE[:OSM_FILE.find('.')]
-working_directory = '/Users/tarunparmar/Nonu/'
-json_file = OSM_FILE + '.json'
+load_checkpoint = OSM_FILE + ".load.checkpoint"
+
+if USE_MONGO:
+    # Before loading, drop collection if it exists (i.e. a re-run), unless
+    # an interrupted load left a checkpoint to resume from
+    if collection in db.collection_names() and \
+            not os.path.exists(load_checkpoint):
+        print 'Dropping collection: ' + collection
+        db[collection].drop()
+
+    # Shape the elements and insert them straight into the collection in
+    # batches from a few writer threads; no JSON file or mongoimport needed.
+    # The load is checkpointed (osm_checkpoint) so a dead run resumes, which
+    # means parsing in one process
+    target = MongoTarget('localhost:27017', db_name, collection)
+    loaded = run_checkpointed(OSM_FILE,
+                              {'load': BulkLoader(shape_element, target,
+                                                  batch_size=1000,
+                                                  writers=4)},
+                              load_checkpoint)
+    print 'Loaded {} documents'.format(loaded['load'])
 
-mongoimport_cmd = 'mongoimport -h 127.0.0.1:27017 ' +                   '--db ' + db_name +                   ' --collection ' + collection +                   ' --file ' + working_directory + json_file
 
-# Before importing, drop collection if it exists (i.e. a re-run)
-if collection in db.collection_names():
-    print 'Dropping collection: ' + collection
-    db[collection].drop()
+# ## Investigating the Data
 
-# Execute the command
-print 'Executing: ' + mongoimport_cmd
-subprocess.call(mongoimport_cmd.split())
+# In[33]:
 
+from osm_aggregate import JsonLinesCollection, record, check
 
-# ## Investigating the Data
+# What MongoDB answers to the report's pipelines is recorded next to the
+# extract; without a server the embedded engine is checked against that
+# recording (up to the order of ties, which MongoDB does not fix either)
+expected_file = OSM_FILE + '.expected.json'
 
-# In[33]:
+if USE_MONGO:
+    austin_texas = db[collection]
+    record(austin_texas, expected_file)
+else:
+    austin_texas = JsonLinesCollection(OSM_FILE + '.json',
+                                       object_hook=json_util.object_hook)
+    if os.path.exists(expected_file):
+        for name, expected, actual in check(austin_texas, expected_file):
+            print name, 'differs from MongoDB:', expected, actual
+
+
+# #### Applying change files
+
+# To refresh the data, download the daily osmChange diffs instead of the whole extract. Each diff is run through the same shape_element, and only the created, modified and deleted elements are written to the collection (or the JSON file) and the summary counts.
 
-austin_texas = db[collection]
+# In[ ]:
+
+import glob
+from osm_changes import read_changes, apply_changes, apply_to_json
+from osm_summary import Summary
+
+summary_file = OSM_FILE + ".summary.json"
+summary = Summary.load(summary_file)
+
+for osc_file in sorted(glob.glob('*.osc')):
+    changes = read_changes(osc_file, shape_element)
+    if USE_MONGO:
+        stats = apply_changes(austin_texas, changes, summary)
+    else:
+        stats = apply_to_json(OSM_FILE + '.json', changes, summary,
+                              default=json_util.default,
+                              object_hook=json_util.object_hook)
+    print osc_file, stats
+
+summary.save(summary_file)
 
 
 # In[34]:
@@ -511,6 +711,17 @@ austin_texas = db[collection]
 austin_texas
 
 
+# The single pass above also kept every count these queries group by, so all of their answers can be read back from the small summary file without scanning the collection. The queries below compute the same numbers (ties may come out in a different order).
+
+# In[ ]:
+
+summary = Summary.load(summary_file)
+
+for name, answer in summary.report().items():
+    print name
+    pprint.pprint(answer)
+
+
 # #### Number of Documents
 
 # In[35]:
@@ -531,12 +742,12 @@ len(austin_texas.distinct('created.user'))
 
 # In[37]:
 
-db.austin_texas.find( {"type":"node"} ).count()
+austin_texas.find( {"type":"node"} ).count()
 
 
 # In[38]:
 
-db.austin_texas.find( {"type":"way"} ).count()
+austin_texas.find( {"type":"way"} ).count()
 
 
 # #### Top 5 Contributors
@@ -545,12 +756,12 @@ db.austin_texas.find( {"type":"way"} ).count()
 
 pipeline = [{'$group': {'_id': '$created.user','count': {'$sum' : 1}}},{'$sort': {'count' : -1}},{'$limit': 5}]
 
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
+def aggregate(collection, pipeline):
+    result = collection.aggregate(pipeline)
     #pprint.pprint(result)
     return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -565,12 +776,8 @@ for document in result:
 
 pipeline = [{"$group":{"_id":"$created.user", "count":{"$sum":1}}}, {"$group":{"_id":"$count", "num_users":{"$sum":1}}}, {"$sort":{"_id":1}}, {"$limit":1}]
 
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -581,12 +788,8 @@ for document in result:
 # In[41]:
 
 pipeline =[{'$match': {'address.postcode': {'$exists': 1}}},{'$group': {'_id': '$address.postcode','count': {'$sum': 1}}}, {'$sort': {'count': -1}},{'$limit': 10}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -597,12 +800,8 @@ for document in result:
 # In[42]:
 
 pipeline =[{'$match': {'address.street': {'$exists': 1}}},{'$group': {'_id': '$address.street','count': {'$sum': 1}}}, {'$sort': {'count': -1}},{'$limit': 10}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -615,12 +814,8 @@ for document in result:
 # In[43]:
 
 pipeline =[{"$group":{"_id":"$address.city", "count":{"$sum":1}}}, {"$sort":{"count": -1}},{'$limit': 10}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -637,12 +832,8 @@ for document in result:
 # In[44]:
 
 pipeline = [{"$group":{"_id":"$amenity", "count":{"$sum":1}}}, {"$sort":{"count": -1}},{'$limit': 10}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -655,12 +846,8 @@ for document in result:
 # In[45]:
 
 pipeline = [{"$match":{"amenity":{"$exists":1}, "amenity":"place_of_worship"}},{"$group":{"_id":"$religion", "count":{"$sum":1}}},{"$sort":{"count":-1}}, {"$limit":5}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -673,12 +860,8 @@ for document in result:
 # In[46]:
 
 pipeline =[{'$match': {'amenity': 'restaurant'}},{'$group': {'_id': '$name','count': {'$sum': 1}}},{'$sort': {'count': -1}},{'$limit': 10}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -689,12 +872,8 @@ for document in result:
 # In[47]:
 
 pipeline = [{"$match":{"amenity":{"$exists":1}, "amenity":"restaurant"}}, {"$group":{"_id":"$cuisine", "count":{"$sum":1}}},{"$sort":{"count":-1}}, {"$limit":5}]
-def aggregate(db, pipeline):
-    result = db.austin_texas.aggregate(pipeline)
-    #pprint.pprint(result)
-    return result
 
-result = aggregate(db, pipeline)
+result = aggregate(austin_texas, pipeline)
 
 for document in result:
     pprint.pprint(document)
@@ -0,0 +1,585 @@
+"""Embedded aggregation engine for the report queries, no mongod needed.
+
+Collection runs the part of the MongoDB query language the Austin report
+uses directly over shaped documents, either kept in memory or streamed from
+the JSON lines file process_map writes:
+
+  find(query).count(), count(query), distinct(path)
+  aggregate(pipeline) with $match, $group, $sort, $skip, $limit
+  insert_many(docs), find_one_and_replace, find_one_and_delete,
+  delete_many(query), drop()
+
+Client and Database complete the pymongo shape (client[db][collection]), so
+code written against a MongoClient can run on in-memory collections.
+
+Queries support equality (a value also matches an array containing it),
+$exists, $eq, $ne, $in and $nin; dotted paths like 'created.user' reach
+into sub-documents.  $group _id may be a '$path', a constant or a dict of
+them, with the $sum, $avg, $min, $max, $first and $last accumulators.
+$sort orders mixed types the way MongoDB does (null < numbers < strings <
+objects < arrays < booleans < dates); ties keep the order of the input,
+and $group emits its groups in the order their first documents came in.
+Both are explicit (an input index in the sort key, a list of group keys),
+so Python 2 gives the same results as Python 3.
+
+MongoDB itself does not order ties, so results are compared with those of
+a real server up to the order of ties: ``record`` saves what a pymongo
+collection returns for the report's pipelines (PIPELINES) to a JSON file,
+``check`` runs them here and lists the differences.
+
+  python osm_aggregate.py --record mongodb://localhost:27017 openstreetmap \
+      austin_texas austin_texas.osm.expected.json
+  python osm_aggregate.py --check austin_texas.osm.json \
+      austin_texas.osm.expected.json
+"""
+import json
+import os
+import sys
+from datetime import datetime
+from itertools import islice
+from numbers import Number
+
+from osm_output import open_input
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+MISSING = object()
+
+# the aggregations of the Austin report, as run in the notebook
+PIPELINES = {
+    'top_users': [
+        {'$group': {'_id': '$created.user', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 5}],
+    'users_appearing_once': [
+        {'$group': {'_id': '$created.user', 'count': {'$sum': 1}}},
+        {'$group': {'_id': '$count', 'num_users': {'$sum': 1}}},
+        {'$sort': {'_id': 1}}, {'$limit': 1}],
+    'top_postcodes': [
+        {'$match': {'address.postcode': {'$exists': 1}}},
+        {'$group': {'_id': '$address.postcode', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 10}],
+    'top_streets': [
+        {'$match': {'address.street': {'$exists': 1}}},
+        {'$group': {'_id': '$address.street', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 10}],
+    'top_cities': [
+        {'$group': {'_id': '$address.city', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 10}],
+    'top_amenities': [
+        {'$group': {'_id': '$amenity', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 10}],
+    'religions': [
+        {'$match': {'amenity': 'place_of_worship'}},
+        {'$group': {'_id': '$religion', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 5}],
+    'restaurant_names': [
+        {'$match': {'amenity': 'restaurant'}},
+        {'$group': {'_id': '$name', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 10}],
+    'cuisines': [
+        {'$match': {'amenity': 'restaurant'}},
+        {'$group': {'_id': '$cuisine', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}}, {'$limit': 5}],
+}
+
+
+def get_path(doc, path):
+    """Value at a dotted path of doc, or MISSING."""
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return MISSING
+    return value
+
+
+def _equals(value, target):
+    if value is MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+
+def _matches(value, condition):
+    if isinstance(condition, dict) and condition and \
+            all(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            if op == '$exists':
+                if (value is not MISSING) != bool(arg):
+                    return False
+            elif op == '$eq':
+                if not _equals(value, arg):
+                    return False
+            elif op == '$ne':
+                if _equals(value, arg):
+                    return False
+            elif op == '$in':
+                if not any(_equals(value, a) for a in arg):
+                    return False
+            elif op == '$nin':
+                if any(_equals(value, a) for a in arg):
+                    return False
+            else:
+                raise ValueError('unsupported query operator ' + op)
+        return True
+    return _equals(value, condition)
+
+
+def match(doc, query):
+    """True if doc satisfies the find/$match query."""
+    for path, condition in query.items():
+        if not _matches(get_path(doc, path), condition):
+            return False
+    return True
+
+
+def evaluate(doc, expression):
+    """Value of a $group expression ('$path', constant or dict) for doc."""
+    if isinstance(expression, dict):
+        return dict((k, evaluate(doc, v)) for k, v in expression.items())
+    if isinstance(expression, string_types) and expression.startswith('$'):
+        value = get_path(doc, expression[1:])
+        return None if value is MISSING else value
+    return expression
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return ('dict', tuple((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ('list', tuple(_hashable(v) for v in value))
+    return (type(value).__name__, value)
+
+
+def _type_rank(value):
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, Number):
+        return 2
+    if isinstance(value, string_types):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    rank = _type_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5):
+        return (rank, json.dumps(value, sort_keys=True, default=str))
+    return (rank, value)
+
+
+class _Descending(object):
+    """Sort key wrapper ordering its key the other way round."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+class _Accumulator(object):
+
+    def __init__(self, op, expression):
+        self.op = op
+        self.expression = expression
+        self.value = None
+        self.count = 0
+
+    def add(self, doc):
+        value = evaluate(doc, self.expression)
+        op = self.op
+        if op == '$sum':
+            if isinstance(value, Number) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+            elif self.value is None:
+                self.value = 0
+        elif op == '$avg':
+            if isinstance(value, Number) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+                self.count += 1
+        elif op in ('$min', '$max'):
+            if value is not None and (
+                    self.value is None or
+                    (_sort_key(value) < _sort_key(self.value)) ==
+                    (op == '$min')):
+                self.value = value
+        elif op == '$first':
+            if self.count == 0:
+                self.value = value
+            self.count += 1
+        elif op == '$last':
+            self.value = value
+        else:
+            raise ValueError('unsupported accumulator ' + op)
+
+    def result(self):
+        if self.op == '$avg':
+            return self.value / float(self.count) if self.count else None
+        return self.value
+
+
+def _group(docs, spec):
+    groups = {}
+    # first-seen order, which a dict does not keep on Python 2
+    order = []
+    for doc in docs:
+        _id = evaluate(doc, spec['_id'])
+        key = _hashable(_id)
+        if key not in groups:
+            groups[key] = (_id, [
+                (field, _Accumulator(*list(acc.items())[0]))
+                for field, acc in spec.items() if field != '_id'])
+            order.append(key)
+        for _, accumulator in groups[key][1]:
+            accumulator.add(doc)
+    for key in order:
+        _id, accumulators = groups[key]
+        out = {'_id': _id}
+        for field, accumulator in accumulators:
+            out[field] = accumulator.result()
+        yield out
+
+
+def _sort(docs, spec):
+    fields = list(spec.items())
+
+    def key(item):
+        index, doc = item
+        keys = []
+        for path, direction in fields:
+            k = _sort_key(get_path(doc, path))
+            keys.append(_Descending(k) if direction < 0 else k)
+        # ties keep the input order
+        keys.append(index)
+        return keys
+
+    return [doc for _, doc in sorted(enumerate(docs), key=key)]
+
+
+def _match(docs, query):
+    for doc in docs:
+        if match(doc, query):
+            yield doc
+
+
+def aggregate(docs, pipeline):
+    """Run a pipeline over an iterable of documents; returns an iterator."""
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == '$match':
+            docs = _match(docs, arg)
+        elif op == '$group':
+            docs = _group(docs, arg)
+        elif op == '$sort':
+            docs = _sort(docs, arg)
+        elif op == '$skip':
+            docs = islice(docs, arg, None)
+        elif op == '$limit':
+            docs = islice(docs, arg)
+        else:
+            raise ValueError('unsupported pipeline stage ' + op)
+    return iter(docs)
+
+
+class Cursor(object):
+    """The result of Collection.find: iterable, with count()."""
+
+    def __init__(self, collection, query):
+        self.collection = collection
+        self.query = query or {}
+
+    def __iter__(self):
+        query = self.query
+        return (doc for doc in self.collection.documents()
+                if match(doc, query))
+
+    def count(self):
+        return sum(1 for _ in self)
+
+
+class Collection(object):
+    """Documents held in memory, queried like a pymongo collection."""
+
+    def __init__(self, docs=None, name='collection'):
+        self.docs = list(docs or [])
+        self.name = name
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.name)
+
+    def documents(self):
+        return iter(self.docs)
+
+    def find(self, query=None):
+        return Cursor(self, query)
+
+    def find_one(self, query=None):
+        for doc in self.find(query):
+            return doc
+        return None
+
+    def count(self, query=None):
+        return self.find(query).count()
+
+    def distinct(self, path):
+        seen = {}
+        for doc in self.documents():
+            value = get_path(doc, path)
+            if value is MISSING:
+                continue
+            for v in (value if isinstance(value, list) else [value]):
+                seen.setdefault(_hashable(v), v)
+        return list(seen.values())
+
+    def aggregate(self, pipeline):
+        return aggregate(self.documents(), pipeline)
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def _position(self, query):
+        for i, doc in enumerate(self.docs):
+            if match(doc, query):
+                return i
+        return None
+
+    def find_one_and_replace(self, query, replacement, upsert=False):
+        """Replace the first match; returns the document it replaced."""
+        i = self._position(query)
+        if i is None:
+            if upsert:
+                self.docs.append(replacement)
+            return None
+        old, self.docs[i] = self.docs[i], replacement
+        return old
+
+    def find_one_and_delete(self, query):
+        i = self._position(query)
+        if i is None:
+            return None
+        return self.docs.pop(i)
+
+    def delete_many(self, query):
+        """Remove every match; returns how many were removed."""
+        kept = [doc for doc in self.docs if not match(doc, query)]
+        deleted = len(self.docs) - len(kept)
+        self.docs = kept
+        return deleted
+
+    def drop(self):
+        self.docs = []
+
+
+class JsonLinesCollection(Collection):
+    """Read-only collection streamed from a process_map JSON lines file.
+
+    Every query is one pass over the file (which may be compressed, see
+    osm_output); nothing is kept in memory.
+    object_hook is handed to json.loads (e.g. bson.json_util.object_hook
+    to get the timestamps back as datetimes).  Change files are applied
+    to the underlying file with osm_changes.apply_to_json.
+    """
+
+    def __init__(self, path, object_hook=None):
+        self.path = path
+        self.name = path
+        self.object_hook = object_hook
+
+    def documents(self):
+        with open_input(self.path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'),
+                                     object_hook=self.object_hook)
+
+    def insert_many(self, docs, ordered=True):
+        raise TypeError('JsonLinesCollection is read-only')
+
+    def find_one_and_replace(self, query, replacement, upsert=False):
+        raise TypeError('JsonLinesCollection is read-only')
+
+    def find_one_and_delete(self, query):
+        raise TypeError('JsonLinesCollection is read-only')
+
+    def delete_many(self, query):
+        raise TypeError('JsonLinesCollection is read-only')
+
+    def drop(self):
+        raise TypeError('JsonLinesCollection is read-only')
+
+
+class Database(object):
+    """db[name] -> Collection, created on first use."""
+
+    def __init__(self, name='test'):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection(name=name)
+        return self.collections[name]
+
+    def collection_names(self):
+        return [name for name, c in self.collections.items() if c.docs]
+
+
+class Client(object):
+    """In-memory stand-in for pymongo.MongoClient: client[db][collection]."""
+
+    def __init__(self, host=None):
+        self.host = host
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = Database(name)
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+
+def _ties(pipeline):
+    """Sort paths of pipeline's last $sort and its final $limit, if any."""
+    paths, limit = None, None
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == '$sort':
+            paths, limit = list(arg), None
+        elif op == '$limit':
+            limit = arg if limit is None else min(limit, arg)
+    return paths, limit
+
+
+def _runs(docs, paths):
+    """docs cut into runs of equal sort keys, as (key, [docs])."""
+    runs = []
+    for doc in docs:
+        key = [get_path(doc, path) for path in paths]
+        if runs and runs[-1][0] == key:
+            runs[-1][1].append(doc)
+        else:
+            runs.append((key, [doc]))
+    return runs
+
+
+def _same(expected, actual, pipeline):
+    """Whether two results of pipeline are equal up to the order of ties.
+
+    Ties in the last run of a limited result may have been cut
+    differently, so there only the number of documents has to match.
+    """
+    paths, limit = _ties(pipeline)
+    if paths is None:
+        return expected == actual
+    if len(expected) != len(actual):
+        return False
+    runs, other = _runs(expected, paths), _runs(actual, paths)
+    if [(k, len(d)) for k, d in runs] != [(k, len(d)) for k, d in other]:
+        return False
+    canonical = lambda docs: sorted(json.dumps(doc, sort_keys=True,
+                                               default=str) for doc in docs)
+    if limit is not None and len(expected) == limit:
+        runs, other = runs[:-1], other[:-1]
+    return all(canonical(a) == canonical(b)
+               for (_, a), (_, b) in zip(runs, other))
+
+
+def record(collection, path, pipelines=PIPELINES):
+    """Save what collection (a real MongoDB one) returns for pipelines."""
+    results = dict((name, list(collection.aggregate(pipeline)))
+                   for name, pipeline in pipelines.items())
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fo:
+        json.dump({'pipelines': pipelines, 'results': results}, fo,
+                  indent=1, sort_keys=True, default=str)
+    os.rename(tmp, path)
+    return results
+
+
+def check(collection, path):
+    """Names of the recorded pipelines collection answers differently.
+
+    Returns [(name, expected, actual)].
+    """
+    with open(path) as f:
+        recorded = json.load(f)
+    differences = []
+    for name, pipeline in sorted(recorded['pipelines'].items()):
+        expected = recorded['results'][name]
+        # through JSON like the recording, e.g. for datetimes
+        actual = json.loads(json.dumps(list(collection.aggregate(pipeline)),
+                                       default=str))
+        if not _same(expected, actual, pipeline):
+            differences.append((name, expected, actual))
+    return differences
+
+
+def test():
+    """Groups and ties in input order; recordings compare up to ties."""
+    from collections import OrderedDict
+
+    users = ['b', 'a', 'c', 'a', 'd', 'b', 'e', 'c', 'f']
+    docs = [{'created': {'user': u}, 'i': i} for i, u in enumerate(users)]
+    collection = Collection(docs)
+    result = list(collection.aggregate(PIPELINES['top_users']))
+    assert result == [{'_id': 'b', 'count': 2}, {'_id': 'a', 'count': 2},
+                      {'_id': 'c', 'count': 2}, {'_id': 'd', 'count': 1},
+                      {'_id': 'e', 'count': 1}], result
+    # a spec of several fields needs an ordered dict (bson.SON) on Python 2
+    spec = OrderedDict([('created.user', 1), ('i', -1)])
+    result = list(collection.aggregate([{'$sort': spec}]))
+    assert [d['i'] for d in result] == [3, 1, 5, 0, 7, 2, 4, 6, 8], result
+
+    # a server that orders the ties differently and cuts the last run
+    # elsewhere is still the same answer
+    pipeline = PIPELINES['top_users']
+    mongo = [{'_id': 'c', 'count': 2}, {'_id': 'b', 'count': 2},
+             {'_id': 'a', 'count': 2}, {'_id': 'f', 'count': 1},
+             {'_id': 'd', 'count': 1}]
+    assert _same(mongo, list(collection.aggregate(pipeline)), pipeline)
+    assert not _same(mongo[:2] + [{'_id': 'd', 'count': 2}] + mongo[3:],
+                     list(collection.aggregate(pipeline)), pipeline)
+    print('ties keep the input order, recordings compare up to ties')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--record']:
+        from pymongo import MongoClient
+        host, db, name, out = sys.argv[2:]
+        record(MongoClient(host)[db][name], out)
+    elif sys.argv[1:2] == ['--check']:
+        json_file, expected = sys.argv[2:]
+        differences = check(JsonLinesCollection(json_file), expected)
+        for name, expected, actual in differences:
+            print('{0}: expected {1}, got {2}'.format(name, expected, actual))
+        if differences:
+            sys.exit('{0} pipelines differ from {1}'.format(
+                len(differences), sys.argv[3]))
+    else:
+        test()
@@ -0,0 +1,81 @@
+"""Growable NumPy columns for the passes that collect numbers per element.
+
+array.array would do, but Python 2 has no 'q' (int64) typecode and the
+notebook runs on Python 2.  A Column collects appended values in a list and
+moves them into a NumPy chunk of its dtype every CHUNK values, so it takes
+little more than the packed size; ``array()`` joins the chunks.
+"""
+import numpy as np
+
+CHUNK = 65536
+
+
+class Column(object):
+    """Append-only column of dtype, read back as one NumPy array."""
+
+    def __init__(self, dtype, values=()):
+        self.dtype = np.dtype(dtype)
+        self.chunks = []
+        self.pending = []
+        self.size = 0
+        self.extend(values)
+
+    def __len__(self):
+        return self.size + len(self.pending)
+
+    def append(self, value):
+        pending = self.pending
+        pending.append(value)
+        if len(pending) >= CHUNK:
+            self._flush()
+
+    def extend(self, values):
+        """Append values: an iterable, a NumPy array or another Column."""
+        if isinstance(values, Column):
+            values = values.array()
+        if isinstance(values, np.ndarray):
+            self._flush()
+            if len(values):
+                self.chunks.append(values.astype(self.dtype))
+                self.size += len(values)
+            return
+        self.pending.extend(values)
+        if len(self.pending) >= CHUNK:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.chunks.append(np.array(self.pending, dtype=self.dtype))
+            self.size += len(self.pending)
+            self.pending = []
+
+    def array(self):
+        """All values so far as one array of dtype."""
+        self._flush()
+        if len(self.chunks) != 1:
+            self.chunks = [np.concatenate(self.chunks) if self.chunks
+                           else np.zeros(0, dtype=self.dtype)]
+        return self.chunks[0]
+
+
+def test():
+    """Appends, extends and chunk boundaries give the plain array."""
+    expected = list(range(-5, 3 * CHUNK)) + [2 ** 40, -2 ** 62]
+    column = Column(np.int64, expected[:10])
+    for value in expected[10:CHUNK]:
+        column.append(value)
+    column.extend(iter(expected[CHUNK:2 * CHUNK]))
+    column.extend(np.array(expected[2 * CHUNK:-2], dtype=np.int64))
+    column.extend(Column(np.int64, expected[-2:]))
+    assert len(column) == len(expected)
+    array = column.array()
+    assert array.dtype == np.int64 and array.tolist() == expected
+    column.append(1)
+    assert column.array().tolist() == expected + [1]
+    assert Column(np.int32).array().dtype == np.int32
+    print('{0:,} values in {1} chunk(s)'.format(len(column),
+                                                 len(column.chunks)))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,444 @@
+"""Benchmarks of the wrangling passes of the notebook and the lesson quizzes.
+
+Every case is one full pass over an input file, the way the notebook or the
+quiz runs it: count_tags, key_type/process_map, process_map_users, the
+street and postcode audits, update and update_zip over every street and
+postcode, shape_element and the JSON process_map.  The cases run on
+sample.osm copied 1x, 10x and 100x (ids and refs shifted per copy, so the
+copies are distinct elements), and report elements/sec, tags/sec and the
+peak RSS of the pass.
+
+Austin_OSM.py and the LessonQuizzes are notebook exports, not modules:
+they hold inline XML, Python 2 print statements and cells that process the
+full extract.  ``load_script`` splits them into top level statements and
+keeps only the imports, functions, classes and constant assignments (of
+values made of literals and names already loaded), plus the assignments of
+the globals those functions read (the notebook's instrument and the stage
+wrappers).  Statements that do not parse on Python 3 are skipped and listed
+on stderr; a kept statement that fails to run raises.  A function defined
+twice (the notebook has two process_map and two audit) is kept in every
+version.
+
+Each case runs in a fresh interpreter, since ru_maxrss never goes down.
+The results are saved as JSON; ``compare`` lines up two result files, e.g.
+from two commits:
+
+  python osm_benchmark.py sample.osm bench.json 1 10 100
+  python osm_benchmark.py --compare before.json bench.json
+"""
+import ast
+import builtins
+import json
+import mmap
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+from osm_index import iter_spans
+from osm_parallel import body_range
+from osm_stream import get_element
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NOTEBOOK = os.path.join(HERE, 'Austin_OSM.py')
+QUIZZES = os.path.join(HERE, os.pardir, 'LessonQuizzes')
+SCALES = (1, 10, 100)
+VERSION = 1
+
+# Assignments whose value calls nothing else are constants; these calls
+# only build containers and patterns.
+CONSTANT_CALLS = frozenset(['compile', 'defaultdict', 'dict', 'frozenset',
+                            'list', 'set', 'tuple'])
+KEPT = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)
+BUILTINS = frozenset(dir(builtins))
+ID_SHIFT = 10 ** 10
+ID_ATTRIBUTE = re.compile(br'(\s(?:id|ref)=")(-?\d+)"')
+
+
+# Loading notebook exports
+
+def iter_statements(source):
+    """Yield (first line, text) of every top level statement of source.
+
+    A statement ends where the next line starts in the first column, once
+    what came before compiles.  Text that never compiles (inline XML, a
+    Python 2 print) is yielded as one piece, up to the next def, class or
+    import.
+    """
+    chunk = []
+    first = 1
+    for number, line in enumerate(source.splitlines(True), 1):
+        starts = line[:1] not in ('', ' ', '\t', '\n', '\r', '#', ')', ']',
+                                  '}')
+        if starts and chunk:
+            text = ''.join(chunk)
+            if _compiles(text) or line.startswith(
+                    ('def ', 'class ', 'import ', 'from ', '@')):
+                yield first, text
+                chunk = []
+        if not chunk:
+            first = number
+        chunk.append(line)
+    if chunk:
+        yield first, ''.join(chunk)
+
+
+def _compiles(text):
+    try:
+        ast.parse(text)
+    except SyntaxError:
+        return False
+    return True
+
+
+def _free_names(node):
+    """Names a function or class reads that it does not bind itself."""
+    loaded = set()
+    bound = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name):
+            (loaded if isinstance(n.ctx, ast.Load) else bound).add(n.id)
+        elif isinstance(n, ast.arg):
+            bound.add(n.arg)
+        elif isinstance(n, (ast.FunctionDef, ast.ClassDef)) and \
+                n is not node:
+            bound.add(n.name)
+    return loaded - bound
+
+
+def _assigned(tree):
+    """Names a block of plain assignments binds, None for other blocks."""
+    if not all(isinstance(node, ast.Assign) for node in tree.body):
+        return None
+    return set(n.id for node in tree.body for target in node.targets
+               for n in ast.walk(target) if isinstance(n, ast.Name))
+
+
+def _reads(tree):
+    """Names the values of a block of assignments read."""
+    return set(n.id for node in tree.body if isinstance(node, ast.Assign)
+               for n in ast.walk(node.value) if isinstance(n, ast.Name))
+
+
+def _is_kept(tree):
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            calls = [n.func for n in ast.walk(node.value)
+                     if isinstance(n, ast.Call)]
+            if any(getattr(f, 'attr', getattr(f, 'id', None))
+                   not in CONSTANT_CALLS for f in calls):
+                return False
+        elif not isinstance(node, KEPT):
+            return False
+    return True
+
+
+def load_script(path):
+    """(namespace, name -> [every version of a function]) of path."""
+    # cElementTree is the same parser as ElementTree on Python 3, which
+    # dropped the module in 3.9
+    sys.modules.setdefault('xml.etree.cElementTree', ET)
+    # the quizzes import their neighbour shared.py, as when run from there
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory not in sys.path:
+        sys.path.append(directory)
+    with open(path) as f:
+        source = f.read()
+    namespace = {'__name__': os.path.splitext(os.path.basename(path))[0],
+                 '__file__': path}
+    definitions = defaultdict(list)
+    statements = []
+    skipped = []
+    for first, text in iter_statements(source):
+        try:
+            statements.append((first, text, ast.parse(text)))
+        except SyntaxError:
+            skipped.append(first)
+    if skipped:
+        sys.stderr.write('{0}: skipped {1} statement(s) that do not parse on '
+                         'Python 3, at line(s) {2}\n'.format(
+                             os.path.basename(path), len(skipped),
+                             ', '.join(str(line) for line in skipped)))
+    used = set()
+    for _, _, tree in statements:
+        if _is_kept(tree):
+            for node in tree.body:
+                if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                    used |= _free_names(node)
+    for first, text, tree in statements:
+        # a constant reading what was not loaded, e.g. first_way from the
+        # index the full pass builds, is not kept
+        kept = _is_kept(tree) and not _reads(tree) - set(namespace) - BUILTINS
+        if not kept and not (_assigned(tree) or set()) & used:
+            continue
+        # pad so tracebacks point at the right line of path
+        code = compile('\n' * (first - 1) + text, path, 'exec')
+        exec(code, namespace)
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef):
+                definitions[node.name].append(namespace[node.name])
+    return namespace, definitions
+
+
+# Inputs
+
+def scale_osm(osm_file, out, factor):
+    """Write osm_file's elements factor times to out; (elements, tags).
+
+    Copy i has every id and ref shifted by i * ID_SHIFT.  A truncated last
+    element (sample.osm has one) is dropped, and the file is closed.
+    """
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            spans = [(offset, length) for _, _, offset, length
+                     in iter_spans(osm_file)]
+            if spans:
+                try:
+                    ET.fromstring(data[spans[-1][0]:sum(spans[-1])])
+                except ET.ParseError:
+                    spans.pop()
+            root, start, _ = body_range(data)
+            head = data[:spans[0][0] if spans else start]
+            body = [data[offset:offset + length] for offset, length in spans]
+        finally:
+            data.close()
+    tags = sum(element.count(b'<tag ') for element in body)
+    with open(out, 'wb') as fo:
+        fo.write(head)
+        for i in range(factor):
+            shift = i * ID_SHIFT
+
+            def shifted(m):
+                return m.group(1) + str(int(m.group(2)) + shift).encode(
+                    'ascii') + b'"'
+            for element in body:
+                fo.write((ID_ATTRIBUTE.sub(shifted, element) if shift
+                          else element) + b'\n')
+        fo.write(b'</osm>\n')
+    return len(body) * factor, tags * factor
+
+
+# Cases: (variant, case, script, pass).  The pass gets the loaded script's
+# namespace and definitions, the input path, a scratch output path and the
+# values of the tag keys INPUTS lists for the case, collected before the
+# pass is timed.
+
+def _values(path, key):
+    for element in get_element(path, tags=('node', 'way')):
+        for tag in element.iter('tag'):
+            if tag.get('k') == key:
+                yield tag.get('v')
+
+
+def _shape_all(shape_element, path):
+    for element in get_element(path, tags=('node', 'way')):
+        shape_element(element)
+
+
+def _quiz(name):
+    return os.path.join(QUIZZES, name + '.py')
+
+
+CASES = [
+    ('notebook', 'count_tags', NOTEBOOK,
+     lambda ns, defs, path, out, values: ns['count_tags'](path)),
+    ('notebook', 'key_type', NOTEBOOK,
+     lambda ns, defs, path, out, values: defs['process_map'][0](path)),
+    ('notebook', 'process_map_users', NOTEBOOK,
+     lambda ns, defs, path, out, values: ns['process_map_users'](path)),
+    ('notebook', 'audit', NOTEBOOK,
+     lambda ns, defs, path, out, values: defs['audit'][0](path,
+                                                  ns['street_type_reg'])),
+    ('notebook', 'audit_zip', NOTEBOOK,
+     lambda ns, defs, path, out, values: defs['audit'][1](path, ns['zip_type_re'])),
+    ('notebook', 'update', NOTEBOOK,
+     lambda ns, defs, path, out, values: [
+         ns['update'](name, ns['street_type_mapping'])
+         for name in values['addr:street']]),
+    ('notebook', 'update_zip', NOTEBOOK,
+     lambda ns, defs, path, out, values: [
+         ns['update_zip'](code) for code in values['addr:postcode']]),
+    ('notebook', 'shape_element', NOTEBOOK,
+     lambda ns, defs, path, out, values: _shape_all(ns['shape_element'], path)),
+    ('notebook', 'process_map_json', NOTEBOOK,
+     lambda ns, defs, path, out, values: defs['process_map'][1](path,
+                                                        file_out=out)),
+    ('quiz', 'count_tags', _quiz('mapparser'),
+     lambda ns, defs, path, out, values: ns['count_tags'](path)),
+    ('quiz', 'key_type', _quiz('tags'),
+     lambda ns, defs, path, out, values: ns['process_map'](path)),
+    ('quiz', 'process_map_users', _quiz('users'),
+     lambda ns, defs, path, out, values: ns['process_map'](path)),
+    ('quiz', 'audit', _quiz('audit'),
+     lambda ns, defs, path, out, values: ns['audit'](path)),
+    ('quiz', 'update', _quiz('audit'),
+     lambda ns, defs, path, out, values: [
+         ns['update_name'](name, ns['mapping'])
+         for name in values['addr:street']]),
+    ('quiz', 'shape_element', _quiz('data'),
+     lambda ns, defs, path, out, values: _shape_all(ns['shape_element'], path)),
+    # writes path + '.json' and returns every document
+    ('quiz', 'process_map_json', _quiz('data'),
+     lambda ns, defs, path, out, values: ns['process_map'](path)),
+]
+
+# tag values the update cases clean, so that parsing is not timed with them
+INPUTS = {
+    ('notebook', 'update'): ('addr:street',),
+    ('notebook', 'update_zip'): ('addr:postcode',),
+    ('quiz', 'update'): ('addr:street',),
+}
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def run_case(variant, case, path):
+    """Time one case in this process; dict of seconds or error, peak_rss."""
+    script, run = [(script, run) for v, c, script, run in CASES
+                   if (v, c) == (variant, case)][0]
+    out = tempfile.mktemp(suffix='.json')
+    result = {}
+    try:
+        ns, defs = load_script(script)
+        values = dict((key, list(_values(path, key)))
+                      for key in INPUTS.get((variant, case), ()))
+        start = time.time()
+        run(ns, defs, path, out, values)
+        result['seconds'] = time.time() - start
+        if values:
+            result['values'] = sum(len(v) for v in values.values())
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        for leftover in (out, path + '.json'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def run(osm_file, scales=SCALES, variants=('notebook', 'quiz'), cases=None):
+    """Run every case of variants on osm_file at every scale."""
+    tmp = tempfile.mkdtemp()
+    results = []
+    try:
+        for scale in scales:
+            path = os.path.join(tmp, 'x{0}.osm'.format(scale))
+            elements, tags = scale_osm(osm_file, path, scale)
+            for variant, case, _, _ in CASES:
+                if variant not in variants or \
+                        cases is not None and case not in cases:
+                    continue
+                # fresh interpreter per case: ru_maxrss never goes down
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--case',
+                     variant, case, path], cwd=HERE)
+                result = json.loads(out.decode('utf-8').splitlines()[-1])
+                result.update(variant=variant, case=case, scale=scale,
+                              elements=elements, tags=tags)
+                if 'seconds' in result:
+                    seconds = result['seconds'] or 1e-9
+                    result['elements_per_sec'] = elements / seconds
+                    result['tags_per_sec'] = tags / seconds
+                    if 'values' in result:
+                        result['values_per_sec'] = result['values'] / seconds
+                results.append(result)
+                print(format_result(result))
+            os.remove(path)
+    finally:
+        shutil.rmtree(tmp)
+    return {'version': VERSION, 'input': osm_file, 'time': time.time(),
+            'commit': _commit(), 'python': platform.python_version(),
+            'results': results}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result):
+    name = '{variant:8s} {case:18s} {scale:>4d}x'.format(**result)
+    if 'error' in result:
+        return '{0}  {1}'.format(name, result['error'])
+    if 'values' in result:
+        # only the cleanup is timed, so elements/sec would mean nothing
+        return ('{0} {1:12,d} values {2:12,.0f} values/sec '
+                '{3:8.1f} MB').format(name, result['values'],
+                                      result['values_per_sec'],
+                                      result['peak_rss'] / 2.0 ** 20)
+    return ('{0} {1:12,.0f} elements/sec {2:12,.0f} tags/sec '
+            '{3:8.1f} MB').format(name, result['elements_per_sec'],
+                                  result['tags_per_sec'],
+                                  result['peak_rss'] / 2.0 ** 20)
+
+
+def save(report, path):
+    """Write a run's report; the file is replaced atomically."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fo:
+        json.dump(report, fo, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    if report.get('version') != VERSION:
+        raise ValueError('{0}: unknown benchmark version {1!r}'.format(
+            path, report.get('version')))
+    return report
+
+
+def compare(before, after):
+    """Yield (variant, case, scale, speed ratio, peak RSS ratio).
+
+    Speed is values/sec for the update cases, elements/sec otherwise.
+    """
+    old = dict(((r['variant'], r['case'], r['scale']), r)
+               for r in before['results'] if 'error' not in r)
+    for r in after['results']:
+        key = (r['variant'], r['case'], r['scale'])
+        if key in old and 'error' not in r:
+            rate = 'values_per_sec' if 'values_per_sec' in r and \
+                'values_per_sec' in old[key] else 'elements_per_sec'
+            yield key + (r[rate] / old[key][rate],
+                         float(r['peak_rss']) / old[key]['peak_rss'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--case':
+        print(json.dumps(run_case(*sys.argv[2:])))
+    elif len(sys.argv) == 4 and sys.argv[1] == '--compare':
+        for variant, case, scale, speed, rss in compare(load(sys.argv[2]),
+                                                        load(sys.argv[3])):
+            print('{0:8s} {1:18s} {2:>4d}x  speed {3:6.2f}x  '
+                  'peak RSS {4:6.2f}x'.format(variant, case, scale, speed,
+                                              rss))
+    else:
+        osm_file = sys.argv[1] if len(sys.argv) > 1 else 'sample.osm'
+        path = sys.argv[2] if len(sys.argv) > 2 else 'benchmark.json'
+        scales = [int(a) for a in sys.argv[3:]] or SCALES
+        report = run(osm_file, scales)
+        save(report, path)
+        failed = [r for r in report['results'] if 'error' in r]
+        if failed:
+            sys.exit('{0} of {1} cases failed'.format(
+                len(failed), len(report['results'])))
@@ -0,0 +1,77 @@
+"""Bounded memo cache with hit-rate counters.
+
+Tag keys, street names and timestamps repeat millions of times in a metro
+extract while the number of distinct values stays small, so the expensive
+per-value work (regexes, string rebuilding, strptime) is worth caching.
+"""
+from collections import OrderedDict
+
+
+class BoundedCache(object):
+    """Memoize function(value), keeping at most maxsize results.
+
+    When full, the oldest entry is dropped.  hits and misses count lookups.
+    """
+
+    def __init__(self, function, maxsize=100000):
+        self.function = function
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, value):
+        try:
+            result = self.data[value]
+        except KeyError:
+            self.misses += 1
+            result = self.function(value)
+            if len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+            self.data[value] = result
+            return result
+        self.hits += 1
+        return result
+
+    def __len__(self):
+        return len(self.data)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.data), 'maxsize': self.maxsize,
+                'hit_rate': self.hit_rate()}
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+
+def test():
+    """Results, counters and eviction of the oldest entry."""
+    calls = []
+
+    def square(value):
+        calls.append(value)
+        return value * value
+
+    cache = BoundedCache(square, maxsize=3)
+    assert [cache(v) for v in (1, 2, 1, 3, 1)] == [1, 4, 1, 9, 1]
+    assert calls == [1, 2, 3] and (cache.hits, cache.misses) == (2, 3)
+    # full: 4 drops 1, the oldest entry, however often it was hit
+    assert cache(4) == 16 and list(cache.data) == [2, 3, 4]
+    assert cache(1) == 1 and calls == [1, 2, 3, 4, 1]
+    assert len(cache) == 3
+    assert cache.stats() == {'hits': 2, 'misses': 5, 'size': 3,
+                             'maxsize': 3, 'hit_rate': 2 / 7.0}
+    cache.clear()
+    assert len(cache) == 0 and cache.hit_rate() == 0.0
+    assert cache(2) == 4 and cache.misses == 1
+    print(cache.stats())
+
+
+if __name__ == '__main__':
+    test()
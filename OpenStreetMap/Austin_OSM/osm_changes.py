@@ -0,0 +1,255 @@
+"""Apply OSM change files (.osc) instead of re-importing the whole extract.
+
+A daily osmChange diff lists the nodes and ways that were created, modified
+or deleted:
+
+  <osmChange version="0.6">
+    <create> <node .../> ... </create>
+    <modify> <way ...> ... </way> </modify>
+    <delete> <node id="..."/> </delete>
+  </osmChange>
+
+``read_changes`` runs every created or modified element through the same
+shape_element as process_map.  It returns the last change of every element,
+keyed by (type, id), with None for a deletion.  The changes can then be
+applied to a MongoDB (or osm_aggregate) collection with ``apply_changes``,
+or to the process_map JSON lines file with ``apply_to_json``.  Both take
+the replaced and deleted documents back out of a Summary and add the new
+ones, so the report's summary file stays exact.  The columnar export and
+node store are append-only and are rebuilt by the next full pass.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from osm_output import JsonWriter, compression_of, open_input
+
+KINDS = ('node', 'way')
+ACTIONS = ('create', 'modify', 'delete')
+
+# "id" of a line written by process_map, to skip unchanged lines unparsed
+JSON_ID = re.compile(br'"id": ?"(-?\d+)"')
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for every element of an osmChange file.
+
+    Like get_element, each element is cleared once the caller moves on.
+    """
+    context = iter(ET.iterparse(osc_file, events=('start', 'end')))
+    _, root = next(context)
+    depth = 1
+    block = None
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                block = elem
+            continue
+        depth -= 1
+        if depth == 2:
+            if block.tag in ACTIONS:
+                yield block.tag, elem
+            block.clear()
+        elif depth == 1:
+            root.clear()
+
+
+def read_changes(osc_file, shape_element):
+    """OrderedDict (type, id) -> shaped document, or None when deleted."""
+    changes = OrderedDict()
+    for action, elem in iter_changes(osc_file):
+        if elem.tag not in KINDS:
+            continue
+        key = (elem.tag, elem.get('id'))
+        doc = shape_element(elem) if action != 'delete' else None
+        # a later change of the same element supersedes the earlier one
+        changes.pop(key, None)
+        changes[key] = doc or None
+    return changes
+
+
+def _count(stats, summary, old, new):
+    if old is None and new is None:
+        return
+    if summary is not None:
+        if old is not None:
+            summary.remove(old)
+        if new is not None:
+            summary.add(new)
+    if new is None:
+        stats['deleted'] += 1
+    elif old is None:
+        stats['inserted'] += 1
+    else:
+        stats['replaced'] += 1
+
+
+def apply_changes(collection, changes, summary=None):
+    """Apply read_changes output to a collection; returns counts by kind.
+
+    Uses find_one_and_replace / find_one_and_delete, so each change is one
+    round trip that also hands back the old document for the summary.
+    """
+    stats = {'inserted': 0, 'replaced': 0, 'deleted': 0}
+    for (kind, id), doc in changes.items():
+        query = {'type': kind, 'id': id}
+        if doc is None:
+            old = collection.find_one_and_delete(query)
+        else:
+            old = collection.find_one_and_replace(query, doc, upsert=True)
+        _count(stats, summary, old, doc)
+    return stats
+
+
+def apply_to_json(json_file, changes, summary=None, default=None,
+                  object_hook=None):
+    """Apply read_changes output to a JSON lines file; returns counts.
+
+    One streaming pass: changed lines are replaced or dropped, lines of
+    other elements are copied without being parsed, and new elements are
+    appended.  The file is replaced atomically at the end, compressed like
+    it was before.
+    """
+    stats = {'inserted': 0, 'replaced': 0, 'deleted': 0}
+    pending = OrderedDict(changes)
+    ids = set(id for _, id in changes)
+    compression = compression_of(json_file)
+    tmp = json_file + '.tmp'
+    with open_input(json_file) as f, \
+            JsonWriter(tmp, default, compression=compression) as writer:
+        for line in f:
+            m = JSON_ID.search(line)
+            if m is not None and m.group(1).decode('ascii') in ids:
+                old = json.loads(line.decode('utf-8'),
+                                 object_hook=object_hook)
+                key = (old.get('type'), old.get('id'))
+                if key in pending:
+                    doc = pending.pop(key)
+                    if doc is not None:
+                        writer.write(doc)
+                    _count(stats, summary, old, doc)
+                    continue
+            writer.write_line(line)
+        for doc in pending.values():
+            if doc is not None:
+                writer.write(doc)
+                _count(stats, summary, None, doc)
+    os.rename(tmp, json_file)
+    return stats
+
+
+BASE = """<osm version="0.6">
+ <node id="1" lat="30.1" lon="-97.1" user="a" uid="1">
+  <tag k="amenity" v="restaurant"/><tag k="cuisine" v="mexican"/>
+ </node>
+ <node id="2" lat="30.2" lon="-97.2" user="b" uid="2"/>
+ <node id="3" lat="30.3" lon="-97.3" user="a" uid="1">
+  <tag k="amenity" v="bench"/>
+ </node>
+ <way id="10" user="b" uid="2"><nd ref="1"/><nd ref="2"/></way>
+</osm>
+"""
+
+CHANGES = """<osmChange version="0.6">
+ <modify>
+  <node id="1" lat="30.1" lon="-97.1" user="c" uid="3">
+   <tag k="amenity" v="restaurant"/><tag k="cuisine" v="pizza"/>
+  </node>
+ </modify>
+ <delete><node id="3"/></delete>
+ <create>
+  <node id="4" lat="30.4" lon="-97.4" user="c" uid="3"/>
+  <relation id="20" user="c" uid="3"/>
+ </create>
+ <modify>
+  <way id="10" user="c" uid="3"><nd ref="1"/><nd ref="4"/></way>
+ </modify>
+ <delete><node id="4"/></delete>
+ <create><node id="5" lat="30.5" lon="-97.5" user="d" uid="4"/></create>
+</osmChange>
+"""
+
+AFTER = """<osm version="0.6">
+ <node id="1" lat="30.1" lon="-97.1" user="c" uid="3">
+  <tag k="amenity" v="restaurant"/><tag k="cuisine" v="pizza"/>
+ </node>
+ <node id="2" lat="30.2" lon="-97.2" user="b" uid="2"/>
+ <way id="10" user="c" uid="3"><nd ref="1"/><nd ref="4"/></way>
+ <node id="5" lat="30.5" lon="-97.5" user="d" uid="4"/>
+</osm>
+"""
+
+
+def _shape(elem):
+    doc = {'type': elem.tag, 'id': elem.get('id'),
+           'created': {'user': elem.get('user'), 'uid': elem.get('uid')}}
+    if elem.tag == 'node':
+        doc['pos'] = [float(elem.get('lat')), float(elem.get('lon'))]
+    else:
+        doc['node_refs'] = [nd.get('ref') for nd in elem.iter('nd')]
+    for tag in elem.iter('tag'):
+        doc[tag.get('k')] = tag.get('v')
+    return doc
+
+
+def test():
+    """Applying CHANGES to BASE must give exactly what shaping AFTER gives."""
+    from osm_aggregate import Collection
+    from osm_stream import get_element
+    from osm_summary import Summary
+
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = {}
+        for name, text in (('base', BASE), ('osc', CHANGES),
+                           ('after', AFTER)):
+            paths[name] = os.path.join(tmp, name + '.osm')
+            with open(paths[name], 'w') as fo:
+                fo.write(text)
+
+        def shaped(name):
+            return [_shape(e) for e in get_element(paths[name])]
+
+        def ordered(docs):
+            return sorted(docs, key=lambda d: (d['type'], int(d['id'])))
+
+        def summary_of(docs):
+            summary = Summary()
+            for doc in docs:
+                summary.add(doc)
+            return summary
+
+        changes = read_changes(paths['osc'], _shape)
+        expected = ordered(shaped('after'))
+        expected_summary = summary_of(expected)
+
+        collection = Collection(shaped('base'))
+        summary = summary_of(collection.docs)
+        stats = apply_changes(collection, changes, summary)
+        assert ordered(collection.docs) == expected
+        assert summary.counters == expected_summary.counters
+        assert summary.documents == expected_summary.documents
+
+        for name in ('base.json', 'base.json.gz'):
+            json_file = os.path.join(tmp, name)
+            with JsonWriter(json_file) as writer:
+                for doc in shaped('base'):
+                    writer.write(doc)
+            summary = summary_of(shaped('base'))
+            assert apply_to_json(json_file, changes, summary) == stats
+            with open_input(json_file) as f:
+                assert ordered(json.loads(line.decode('utf-8'))
+                               for line in f) == expected
+            assert summary.counters == expected_summary.counters
+        print(stats)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
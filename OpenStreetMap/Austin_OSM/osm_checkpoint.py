@@ -0,0 +1,283 @@
+"""Checkpoints for passes that can be resumed after a crash.
+
+A JSON export or Mongo load of the full extract runs for a long time, and
+if it dies halfway the next run started again from byte zero.
+``run_checkpointed`` runs visitors like osm_engine.run_visitors (serially)
+and every ``every`` elements saves a checkpoint: the byte offset where the
+next element starts, found with osm_index.iter_spans alongside the parser,
+the type and id of the last element, and what each visitor's
+``checkpoint`` returns (osm_engine.Shaper: the output file position,
+osm_mongo.BulkLoader: the documents inserted once its queue is drained).
+
+Started again with the same checkpoint file, the pass restores every
+visitor (the JSON file is cut back to the saved position, the documents of
+the elements visited after the checkpoint are deleted from the collection)
+and parses on from the saved offset, so the result is the same as that of
+an uninterrupted run.  The checkpoint is replaced atomically (written to a
+temporary file, synced and renamed) and removed when the pass completes.
+
+Byte offsets need the uncompressed XML file; a checkpointed JSON export
+cannot be compressed either, as a compressed stream cannot be cut off.
+"""
+import itertools
+import json
+import mmap
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from osm_engine import visit_functions
+from osm_index import TYPES, iter_spans
+from osm_output import compression_of, is_pbf
+from osm_parallel import ROOT_END, RangeFile, body_range
+from osm_progress import DISABLED
+
+VERSION = 1
+EVERY = 100000
+
+
+def save_checkpoint(path, state):
+    """Replace the checkpoint at path with state, atomically."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fo:
+        json.dump(state, fo, sort_keys=True)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.rename(tmp, path)
+
+
+def load_checkpoint(path, osm_file):
+    """The checkpoint saved at path for osm_file, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('version') != VERSION:
+        raise ValueError('{0}: checkpoint version {1}, expected {2}'.format(
+            path, state.get('version'), VERSION))
+    if state['size'] != os.path.getsize(osm_file):
+        raise ValueError('{0} has changed since checkpoint {1} was '
+                         'saved'.format(osm_file, path))
+    return state
+
+
+def _body(osm_file):
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return body_range(data)
+        finally:
+            data.close()
+
+
+def run_checkpointed(osm_file, visitors, path, every=EVERY,
+                     instrument=DISABLED, shape=None):
+    """run_visitors with a checkpoint at path every every elements.
+
+    If path holds a checkpoint the pass resumes from it.  Every visitor
+    must implement ``checkpoint`` and ``restore``.
+    """
+    if compression_of(osm_file) is not None or is_pbf(osm_file):
+        raise ValueError('checkpoints need byte offsets into an '
+                         'uncompressed XML file, not {0}'.format(osm_file))
+    root_tag, start, end = _body(osm_file)
+    state = load_checkpoint(path, osm_file)
+
+    def on_root(root):
+        for v in visitors.values():
+            v.start(root)
+
+    if state is None:
+        offset, elements = start, 0
+        state = {'version': VERSION, 'source': osm_file,
+                 'size': os.path.getsize(osm_file)}
+    else:
+        if sorted(state['visitors']) != sorted(visitors):
+            raise ValueError('checkpoint {0} is for visitors {1}'.format(
+                path, ', '.join(sorted(state['visitors']))))
+        offset, elements = state['offset'], state['elements']
+        # the elements a crashed run may have visited after the checkpoint
+        replay = [(kind, id) for kind, id, _, _ in
+                  itertools.islice(iter_spans(osm_file, offset), every)]
+        for name, v in visitors.items():
+            v.restore(state['visitors'][name], replay)
+        on_root = None
+
+    def save(offset, elements, kind=None, id=None):
+        state.update(offset=offset, elements=elements, type=kind, id=id,
+                     visitors=dict((name, v.checkpoint())
+                                   for name, v in visitors.items()))
+        save_checkpoint(path, state)
+
+    if elements == 0:
+        # from the start too: a load restarted before the first checkpoint
+        # must not keep what it had inserted
+        save(offset, elements)
+    visits = visit_functions(visitors, instrument, shape)
+    spans = iter_spans(osm_file, offset)
+    source = RangeFile(osm_file, offset, end, root_tag, ROOT_END)
+    try:
+        for elem in instrument.elements(source, tags=None, on_root=on_root):
+            for visit in visits:
+                visit(elem)
+            if elem.tag not in TYPES:
+                continue
+            kind, id, span_start, length = next(spans)
+            elements += 1
+            if elements % every == 0:
+                if kind != elem.tag or str(id) != elem.get('id'):
+                    raise ValueError('{0} {1} at byte {2} of {3} does not '
+                                     'match the parsed {4} {5}'.format(
+                                         kind, id, span_start, osm_file,
+                                         elem.tag, elem.get('id')))
+                save(span_start + length, elements, kind, id)
+    finally:
+        source.close()
+
+    for v in visitors.values():
+        v.finish()
+    os.remove(path)
+    return dict((name, v.result()) for name, v in visitors.items())
+
+
+def _shape(elem):
+    if elem.tag not in ('node', 'way'):
+        return None
+    doc = dict(elem.attrib)
+    doc['type'] = elem.tag
+    doc['tags'] = dict((t.get('k'), t.get('v')) for t in elem.iter('tag'))
+    return doc
+
+
+def _flat_shape(elem):
+    doc = _shape(elem)
+    if doc is not None:
+        doc.update(doc.pop('tags'))
+    return doc
+
+
+def _export(osm_file, file_out, path, every):
+    from osm_engine import Shaper
+    return run_checkpointed(osm_file, {'json': Shaper(_shape, file_out)},
+                            path, every)['json']
+
+
+class _Crash(Exception):
+    pass
+
+
+def _crash_after(n, shape):
+    seen = itertools.count(1)
+
+    def crashing(elem):
+        if next(seen) > n:
+            raise _Crash()
+        return shape(elem)
+    return crashing
+
+
+def test(size=16 * 2 ** 20, every=5000):
+    """Killed and resumed passes must give what an unbroken one gives."""
+    from osm_aggregate import Client
+    from osm_engine import Shaper, run_visitors
+    from osm_intern import EncodedShaper
+    from osm_mongo import BulkLoader, MongoTarget
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    osm_file = os.path.join(tmp, 'synthetic.osm')
+    expected = os.path.join(tmp, 'expected.json')
+    out = os.path.join(tmp, 'resumed.json')
+    path = out + '.checkpoint'
+    try:
+        write_osm(osm_file, size)
+        count = run_visitors(osm_file,
+                             {'json': Shaper(_shape, expected)})['json']
+
+        # JSON export: SIGKILL the exporting process after a few
+        # checkpoints, then resume it here
+        process = subprocess.Popen([sys.executable, __file__, '--export',
+                                    osm_file, out, path, str(every)])
+        state = None
+        while process.poll() is None:
+            if os.path.exists(path):
+                with open(path) as f:
+                    state = json.load(f)
+                if state['elements'] >= 3 * every:
+                    process.send_signal(signal.SIGKILL)
+                    break
+            time.sleep(0.01)
+        assert process.wait() == -signal.SIGKILL, \
+            'the export finished before it could be killed'
+        print('export killed after {0:,} of {1:,} documents, {2:,} bytes '
+              'written'.format(state['elements'], count,
+                               os.path.getsize(out)))
+        assert _export(osm_file, out, path, every) == count
+        with open(expected, 'rb') as f1, open(out, 'rb') as f2:
+            assert f1.read() == f2.read(), 'resumed export differs'
+        assert not os.path.exists(path)
+        print('resumed export identical: {0:,} documents'.format(count))
+
+        # Mongo load: the writer threads finish inserting what they were
+        # given after the crash, which the resumed load has to remove
+        target = MongoTarget('memory', 'openstreetmap', 'load', Client)
+        path = os.path.join(tmp, 'load.checkpoint')
+        crashed = BulkLoader(_crash_after(int(2.5 * every), _shape), target,
+                             batch_size=97, writers=3)
+        try:
+            run_checkpointed(osm_file, {'load': crashed}, path, every)
+        except _Crash:
+            crashed.finish()
+        else:
+            raise AssertionError('the load did not crash')
+        print('load crashed with {0:,} documents inserted'.format(
+            len(target().docs)))
+        loaded = run_checkpointed(osm_file, {
+            'load': BulkLoader(_shape, target, batch_size=97, writers=3)},
+            path, every)['load']
+        with open(expected, 'rb') as f:
+            docs = [json.loads(line.decode('utf-8')) for line in f]
+        key = lambda doc: (doc['type'], int(doc['id']))
+        assert loaded == count, (loaded, count)
+        assert sorted(target().docs, key=key) == sorted(docs, key=key)
+        print('resumed load identical: {0:,} documents'.format(loaded))
+
+        # encoded export: crash as if right after the table file of the
+        # next checkpoint was saved, so the tables must be cut back
+        expected = os.path.join(tmp, 'expected.encoded.json')
+        out = os.path.join(tmp, 'resumed.encoded.json')
+        path = out + '.checkpoint'
+        run_visitors(osm_file,
+                     {'json': EncodedShaper(_flat_shape, expected)})
+        crashed = EncodedShaper(_crash_after(int(2.5 * every), _flat_shape),
+                                out)
+        try:
+            run_checkpointed(osm_file, {'json': crashed}, path, every)
+        except _Crash:
+            crashed.interner.save(crashed.table_file)
+            crashed._writer.close()
+        else:
+            raise AssertionError('the encoded export did not crash')
+        run_checkpointed(osm_file, {'json': EncodedShaper(_flat_shape, out)},
+                         path, every)
+        for suffix in ('', '.dict.json'):
+            with open(expected + suffix, 'rb') as f1, \
+                    open(out + suffix, 'rb') as f2:
+                assert f1.read() == f2.read(), \
+                    'resumed encoded export differs: ' + suffix
+        print('resumed encoded export identical')
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--export']:
+        osm_file, out, path, every = sys.argv[2:]
+        _export(osm_file, out, path, int(every))
+    else:
+        test()
@@ -0,0 +1,232 @@
+"""Columnar NumPy export of shaped elements, next to the JSON lines file.
+
+One .npy file per column, so analytics can ``np.load(..., mmap_mode='r')``
+the data instead of re-parsing JSON:
+
+  nodes.id, nodes.lat, nodes.lon     int64, float64, float64
+  nodes.user, nodes.uid              int32 code into users, int64
+  nodes.timestamp                    int64 seconds since the epoch
+  nodes.changeset, nodes.version     int64, int32
+  ways.id, ways.user, ways.uid, ways.timestamp, ways.changeset, ways.version
+  ways.ref_offsets, ways.refs        way i uses refs[ref_offsets[i]:
+                                     ref_offsets[i + 1]] (int64 node ids)
+  tags.kind, tags.row                0 node / 1 way, row in nodes/ways
+  tags.key, tags.value               int32 codes into keys / values
+
+The string tables are written to dictionaries.json.  Tags are taken from the
+shaped document, so cleaned address fields are exported as 'addr:<field>'.
+"""
+import calendar
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from osm_arrays import Column
+from osm_engine import DocumentVisitor
+from osm_time import timestamp_epoch
+
+# Keys of a shaped document that are not tags
+SHAPE_FIELDS = frozenset(['id', 'type', 'visible', 'created', 'pos',
+                          'node_refs', 'address', 'version', 'changeset',
+                          'timestamp', 'user', 'uid', 'lat', 'lon'])
+KINDS = {'node': 0, 'way': 1}
+DICTIONARIES = ('users', 'keys', 'values')
+COLUMNS = (
+    ('nodes.id', np.int64), ('nodes.lat', np.float64),
+    ('nodes.lon', np.float64), ('nodes.user', np.int32),
+    ('nodes.uid', np.int64), ('nodes.timestamp', np.int64),
+    ('nodes.changeset', np.int64), ('nodes.version', np.int32),
+    ('ways.id', np.int64), ('ways.user', np.int32),
+    ('ways.uid', np.int64), ('ways.timestamp', np.int64),
+    ('ways.changeset', np.int64), ('ways.version', np.int32),
+    ('ways.ref_offsets', np.int64), ('ways.refs', np.int64),
+    ('tags.kind', np.int8), ('tags.row', np.int64),
+    ('tags.key', np.int32), ('tags.value', np.int32))
+
+
+class StringCodes(object):
+    """Dictionary encoding: string -> int code, in first-seen order."""
+
+    def __init__(self, values=()):
+        self.codes = {}
+        self.values = []
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return code
+
+
+def epoch(timestamp):
+    """Seconds since the epoch of a datetime, OSM timestamp string or int."""
+    if timestamp is None:
+        return 0
+    if isinstance(timestamp, datetime):
+        return calendar.timegm(timestamp.timetuple())
+    if isinstance(timestamp, int):
+        return timestamp
+    return timestamp_epoch(timestamp)
+
+
+def _int(value):
+    return int(value) if value is not None else 0
+
+
+class ColumnarExport(DocumentVisitor):
+    """Shape every node and way and collect it into columns.
+
+    The columns are written to directory by ``finish``; without a directory
+    (as for the partial copies of a parallel run) they are only collected.
+    """
+
+    def __init__(self, shape_element, directory):
+        self.shape_element = shape_element
+        self.directory = directory
+        self.dictionaries = dict((name, StringCodes())
+                                 for name in DICTIONARIES)
+        self.columns = dict((name, Column(dtype)) for name, dtype in COLUMNS)
+        self.columns['ways.ref_offsets'].append(0)
+
+    def visit_doc(self, doc):
+        kind = doc['type']
+        prefix = kind + 's.'
+        c = self.columns
+        row = len(c[prefix + 'id'])
+        created = doc.get('created', {})
+        c[prefix + 'id'].append(int(doc['id']))
+        c[prefix + 'user'].append(
+            self.dictionaries['users'].code(created.get('user') or ''))
+        c[prefix + 'uid'].append(_int(created.get('uid')))
+        c[prefix + 'timestamp'].append(epoch(created.get('timestamp')))
+        c[prefix + 'changeset'].append(_int(created.get('changeset')))
+        c[prefix + 'version'].append(_int(created.get('version')))
+        if kind == 'node':
+            lat, lon = doc.get('pos', (float('nan'), float('nan')))
+            c['nodes.lat'].append(lat)
+            c['nodes.lon'].append(lon)
+        else:
+            c['ways.refs'].extend(int(ref) for ref in doc.get('node_refs', ()))
+            c['ways.ref_offsets'].append(len(c['ways.refs']))
+
+        tags = [(k, v) for k, v in doc.items() if k not in SHAPE_FIELDS]
+        tags.extend(('addr:' + k, v)
+                    for k, v in doc.get('address', {}).items())
+        for k, v in tags:
+            c['tags.kind'].append(KINDS[kind])
+            c['tags.row'].append(row)
+            c['tags.key'].append(self.dictionaries['keys'].code(k))
+            c['tags.value'].append(self.dictionaries['values'].code(v))
+
+    def partial(self, index):
+        return ColumnarExport(self.shape_element, None)
+
+    def merge(self, other):
+        """Append other's rows, re-coding its dictionaries into ours."""
+        recode = {}
+        for name in DICTIONARIES:
+            mine = self.dictionaries[name]
+            recode[name] = np.array([mine.code(v) for v in
+                                     other.dictionaries[name].values],
+                                    dtype=np.int32)
+        c = self.columns
+        o = dict((name, column.array())
+                 for name, column in other.columns.items())
+        node_rows, way_rows = len(c['nodes.id']), len(c['ways.id'])
+        refs = len(c['ways.refs'])
+        for prefix in ('nodes.', 'ways.'):
+            for column in ('id', 'uid', 'timestamp', 'changeset', 'version'):
+                c[prefix + column].extend(o[prefix + column])
+            c[prefix + 'user'].extend(recode['users'][o[prefix + 'user']])
+        c['nodes.lat'].extend(o['nodes.lat'])
+        c['nodes.lon'].extend(o['nodes.lon'])
+        c['ways.refs'].extend(o['ways.refs'])
+        c['ways.ref_offsets'].extend(refs + o['ways.ref_offsets'][1:])
+        c['tags.kind'].extend(o['tags.kind'])
+        c['tags.row'].extend(o['tags.row'] + np.where(
+            o['tags.kind'] == KINDS['node'], node_rows, way_rows))
+        c['tags.key'].extend(recode['keys'][o['tags.key']])
+        c['tags.value'].extend(recode['values'][o['tags.value']])
+
+    def finish(self):
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name, column in self.columns.items():
+            np.save(os.path.join(self.directory, name + '.npy'),
+                    column.array())
+        with open(os.path.join(self.directory, 'dictionaries.json'),
+                  'w') as fo:
+            json.dump(dict((name, d.values)
+                           for name, d in self.dictionaries.items()), fo)
+
+    def result(self):
+        return len(self.columns['nodes.id']) + len(self.columns['ways.id'])
+
+
+def load_columnar(directory, mmap_mode='r'):
+    """Memory-map an export: returns (columns, dictionaries)."""
+    columns = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy'):
+            columns[filename[:-4]] = np.load(
+                os.path.join(directory, filename), mmap_mode=mmap_mode)
+    with open(os.path.join(directory, 'dictionaries.json')) as f:
+        dictionaries = json.load(f)
+    return columns, dictionaries
+
+
+def _shape(elem):
+    if elem.tag not in KINDS:
+        return None
+    doc = {'id': elem.get('id'), 'type': elem.tag,
+           'created': dict((k, elem.get(k)) for k in
+                           ('user', 'uid', 'version', 'changeset',
+                            'timestamp'))}
+    if elem.tag == 'node':
+        doc['pos'] = [float(elem.get('lat')), float(elem.get('lon'))]
+    doc['node_refs'] = [nd.get('ref') for nd in elem.iter('nd')]
+    for tag in elem.iter('tag'):
+        doc[tag.get('k')] = tag.get('v')
+    return doc
+
+
+def test(size=4 * 2 ** 20):
+    """A parallel export must write exactly the columns of a serial one."""
+    from osm_engine import run_visitors
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        exports = {}
+        for processes in (1, 2):
+            directory = os.path.join(tmp, 'x{0}'.format(processes))
+            rows = run_visitors(osm_file, {
+                'columns': ColumnarExport(_shape, directory)},
+                processes=processes)['columns']
+            exports[processes] = load_columnar(directory, mmap_mode=None)
+            print('{0} process(es): {1:,} rows'.format(processes, rows))
+        (serial, serial_dicts), (parallel, parallel_dicts) = \
+            exports[1], exports[2]
+        assert sorted(serial) == sorted(parallel)
+        for name in serial:
+            assert np.array_equal(serial[name], parallel[name]), name
+        assert serial_dicts == parallel_dicts
+        print('parallel export identical: {0} columns'.format(len(serial)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
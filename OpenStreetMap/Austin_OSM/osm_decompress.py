@@ -0,0 +1,137 @@
+"""Read compressed .osm.bz2 / .osm.gz extracts without unpacking them first.
+
+``open_osm`` returns a binary file-like object over the decompressed XML,
+which is all ET.iterparse needs, so the 1.4 GB file never has to exist on
+disk.
+
+bz2 decompression is slow enough to be the bottleneck of a pass.  Extracts
+written by parallel compressors (pbzip2, lbzip2) are a series of
+independent bz2 streams.  Each stream starts on a byte boundary with the
+header 'BZh' + level + block magic, so the file can be cut there without
+decompressing anything.  ParallelBZ2Reader groups the streams into units
+of at least UNIT_SIZE compressed bytes, has a process pool decompress them,
+and hands the results to the parser in file order.  At most 2 * processes
+units are in flight, so memory stays bounded however large the file is.
+
+A file with a single stream (plain bzip2) cannot be split this way.  It is
+read sequentially with bz2.BZ2File, as are gzip files and all input when
+there is only one core.
+"""
+import bz2
+import multiprocessing
+import re
+from collections import deque
+
+from osm_output import compression_of, open_input
+
+STREAM_START = re.compile(b'BZh[1-9]1AY&SY')
+UNIT_SIZE = 1 << 20
+READ_SIZE = 8 << 20
+
+
+def decompress_streams(data):
+    """Decompress one or more complete, concatenated bz2 streams."""
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        if not getattr(decompressor, 'eof', True):
+            raise ValueError('truncated bz2 stream')
+        data = decompressor.unused_data
+    return b''.join(out)
+
+
+def iter_units(f, unit_size=UNIT_SIZE):
+    """Cut a multi-stream bz2 file into runs of whole streams.
+
+    Every run but the last is at least unit_size bytes long.
+    """
+    buf = b''
+    while True:
+        chunk = f.read(READ_SIZE)
+        buf += chunk
+        m = STREAM_START.search(buf, unit_size)
+        while m is not None:
+            yield buf[:m.start()]
+            buf = buf[m.start():]
+            m = STREAM_START.search(buf, unit_size)
+        if not chunk:
+            break
+    if buf:
+        yield buf
+
+
+def is_multistream(path, probe=4 * UNIT_SIZE):
+    """True if a second bz2 stream starts within the first probe bytes."""
+    with open(path, 'rb') as f:
+        head = f.read(probe)
+    return STREAM_START.search(head, 1) is not None
+
+
+class ParallelBZ2Reader(object):
+    """Binary file-like reader decompressing bz2 streams in a process pool."""
+
+    def __init__(self, path, processes=None, unit_size=UNIT_SIZE):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self._f = open(path, 'rb')
+        self._units = iter_units(self._f, unit_size)
+        self._pool = multiprocessing.Pool(processes)
+        self._pending = deque()
+        self._limit = 2 * processes
+        self._buf = b''
+        self._pos = 0
+        self._fill()
+
+    def _fill(self):
+        while self._units is not None and len(self._pending) < self._limit:
+            try:
+                unit = next(self._units)
+            except StopIteration:
+                self._units = None
+                break
+            self._pending.append(
+                self._pool.apply_async(decompress_streams, (unit,)))
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self._pos >= len(self._buf):
+                if not self._pending:
+                    break
+                self._buf = self._pending.popleft().get()
+                self._pos = 0
+                self._fill()
+                continue
+            end = len(self._buf) if wanted is None else self._pos + wanted
+            chunk = self._buf[self._pos:end]
+            self._pos += len(chunk)
+            chunks.append(chunk)
+            if wanted is not None:
+                wanted -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_osm(path, processes=None):
+    """Binary file over the XML of path, which may be .bz2 / .gz / .zst."""
+    compression = compression_of(path)
+    if compression == 'bz2':
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes > 1 and is_multistream(path):
+            return ParallelBZ2Reader(path, processes)
+    return open_input(path, compression)
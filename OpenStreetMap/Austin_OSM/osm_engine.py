@@ -0,0 +1,355 @@
+"""Single pass over an OSM file feeding several analyzers at once.
+
+Every audit in Austin_OSM used to re-read the whole extract.  Instead, each
+analysis is written as a visitor and ``run_visitors`` parses the file once,
+handing every top level element (node, way, relation, bounds) to each
+registered visitor in turn.
+
+Visitors also know how to make an empty ``partial`` copy of themselves and
+``merge`` one back in, which is all osm_parallel needs to run them over byte
+ranges of the file in a process pool.  Visitors that can ``checkpoint``
+and ``restore`` their output can also be run by osm_checkpoint, which
+resumes an interrupted pass where it stopped.
+
+The exports (JSON, columnar, encoded, summary, Mongo) are DocumentVisitors:
+they want shape_element's document rather than the element.  Given a
+``shape``, the runners call it once per element and hand the same document
+to every DocumentVisitor, instead of each of them shaping it again; with
+osm_intern.InternedShape that document also shares its repeated strings.
+"""
+import os
+import shutil
+from collections import defaultdict
+
+from osm_output import JsonWriter, compression_of, is_pbf
+from osm_parallel import run_parallel
+from osm_progress import DISABLED
+
+
+class Visitor(object):
+    """Base class for analyzers registered with ``run_visitors``."""
+
+    def start(self, root):
+        """Called once with the <osm> root before any element."""
+        pass
+
+    def visit(self, elem):
+        """Called with every fully parsed top level element."""
+        pass
+
+    def finish(self):
+        """Called once after the last element.
+
+        A partial copy only flushes what its own chunk wrote; the final
+        output is written by the visitor the partials are merged into.
+        """
+        pass
+
+    def result(self):
+        return None
+
+    def partial(self, index):
+        """Fresh copy of this visitor to run over chunk number index."""
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Fold the state of a finished partial copy into this visitor."""
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """Make the output so far durable; returns it as JSON-ready state."""
+        raise NotImplementedError
+
+    def restore(self, state, replay):
+        """Continue from a checkpoint, undoing output written after it.
+
+        replay lists the (type, id) of the elements that may have been
+        visited after the checkpoint was taken.
+        """
+        raise NotImplementedError
+
+
+class DocumentVisitor(Visitor):
+    """Visitor of shaped documents, shaped by shape_element if need be.
+
+    Run with a shared ``shape`` (see visit_functions) it only gets
+    visit_doc calls, with a document other visitors get too: it must not
+    change it.
+    """
+
+    def visit(self, elem):
+        doc = self.shape_element(elem)
+        if doc:
+            self.visit_doc(doc)
+
+    def visit_doc(self, doc):
+        """Called with the shaped document of every element that has one."""
+        raise NotImplementedError
+
+
+def visit_functions(visitors, instrument=DISABLED, shape=None):
+    """The per element calls of visitors, timed by instrument.
+
+    With shape, every element is shaped once and its document handed to
+    the visit_doc of each DocumentVisitor; the others get the element.
+    """
+    visits = []
+    documents = []
+    for name, v in visitors.items():
+        if shape is not None and isinstance(v, DocumentVisitor):
+            documents.append(instrument.timed('visit ' + name, v.visit_doc))
+        else:
+            visits.append(instrument.timed('visit ' + name, v.visit))
+    if documents:
+        shape = instrument.timed('shape', shape)
+
+        def visit_shared(elem):
+            doc = shape(elem)
+            if doc:
+                for visit in documents:
+                    visit(doc)
+        visits.append(visit_shared)
+    return visits
+
+
+class TagCounter(Visitor):
+    """count_tags: number of times each tag appears in the file."""
+
+    def __init__(self):
+        self.tags = {}
+
+    def start(self, root):
+        self.tags[root.tag] = self.tags.get(root.tag, 0) + 1
+
+    def visit(self, elem):
+        for e in elem.iter():
+            self.tags[e.tag] = self.tags.get(e.tag, 0) + 1
+
+    def result(self):
+        return self.tags
+
+    def partial(self, index):
+        return TagCounter()
+
+    def merge(self, other):
+        for tag, count in other.tags.items():
+            self.tags[tag] = self.tags.get(tag, 0) + count
+
+
+class KeyTypeCounter(Visitor):
+    """process_map: count the "k" values of <tag> by key_type category."""
+
+    def __init__(self, key_type):
+        self.key_type = key_type
+        self.keys = {"lower": 0, "lower_colon": 0,
+                     "problemchars": 0, "other": 0}
+
+    def visit(self, elem):
+        for tag in elem.iter('tag'):
+            self.keys = self.key_type(tag, self.keys)
+
+    def result(self):
+        return self.keys
+
+    def partial(self, index):
+        return KeyTypeCounter(self.key_type)
+
+    def merge(self, other):
+        for key, count in other.keys.items():
+            self.keys[key] += count
+
+
+class UserCollector(Visitor):
+    """process_map_users: set of unique uids."""
+
+    def __init__(self):
+        self.users = set()
+
+    def visit(self, elem):
+        if 'uid' in elem.attrib:
+            self.users.add(elem.attrib['uid'])
+
+    def result(self):
+        return self.users
+
+    def partial(self, index):
+        return UserCollector()
+
+    def merge(self, other):
+        self.users |= other.users
+
+
+class TagAuditor(Visitor):
+    """Street / postcode audit of the <tag> values of nodes and ways.
+
+    is_match(tag) picks the tags to audit and audit_fn is called the same
+    way audit() calls audit_street_type / audit_zip_codes.
+    """
+
+    def __init__(self, is_match, audit_fn, regex, expected):
+        self.is_match = is_match
+        self.audit_fn = audit_fn
+        self.regex = regex
+        self.expected = expected
+        self.types = defaultdict(set)
+
+    def visit(self, elem):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):
+                if self.is_match(tag):
+                    self.audit_fn(self.types, tag.attrib['v'],
+                                  self.regex, self.expected)
+
+    def result(self):
+        return self.types
+
+    def partial(self, index):
+        return TagAuditor(self.is_match, self.audit_fn, self.regex,
+                          self.expected)
+
+    def merge(self, other):
+        for key, values in other.types.items():
+            self.types[key] |= values
+
+
+class AddressCounter(Visitor):
+    """Number of node and way tags accepted by is_match."""
+
+    def __init__(self, is_match):
+        self.is_match = is_match
+        self.count = 0
+
+    def visit(self, elem):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):
+                if self.is_match(tag):
+                    self.count += 1
+
+    def result(self):
+        return self.count
+
+    def partial(self, index):
+        return AddressCounter(self.is_match)
+
+    def merge(self, other):
+        self.count += other.count
+
+
+class Shaper(DocumentVisitor):
+    """process_map: write shape_element output as JSON lines to file_out.
+
+    Output goes through osm_output.JsonWriter: batched, buffered and
+    compressed when file_out ends in .gz, .bz2 or .zst (or as compression
+    says).  The writer's encoding is timed as stage 'json' of instrument.
+    """
+
+    def __init__(self, shape_element, file_out, pretty=False, default=None,
+                 compression=None, fast=True, instrument=DISABLED):
+        self.shape_element = shape_element
+        self.file_out = file_out
+        self.pretty = pretty
+        self.default = default
+        self.compression = compression or compression_of(file_out)
+        self.fast = fast
+        self.instrument = instrument
+        self.count = 0
+        self._writer = None
+        self._fo = None
+
+    def write(self, el):
+        self._open()
+        self._writer.write(el)
+        self.count += 1
+
+    def visit_doc(self, doc):
+        self.write(doc)
+
+    def finish(self):
+        if self._writer is None and self._fo is None:
+            # nothing written: still leave a valid (empty) file
+            self._writer = JsonWriter(self.file_out,
+                                      compression=self.compression)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._fo is not None:
+            self._fo.close()
+            self._fo = None
+
+    def result(self):
+        return self.count
+
+    def partial(self, index):
+        return Shaper(self.shape_element,
+                      '{0}.part{1}'.format(self.file_out, index),
+                      self.pretty, self.default, self.compression, self.fast,
+                      self.instrument)
+
+    def merge(self, other):
+        """Append the shard written by other and remove it.
+
+        Compressed shards are valid when concatenated, so bytes are copied
+        as they are.
+        """
+        if self._fo is None:
+            self._fo = open(self.file_out, "wb")
+        with open(other.file_out, "rb") as shard:
+            shutil.copyfileobj(shard, self._fo, 1 << 20)
+        os.remove(other.file_out)
+        self.count += other.count
+
+    def _open(self, append=False):
+        if self._writer is None:
+            self._writer = JsonWriter(self.file_out, self.default,
+                                      self.pretty, self.compression,
+                                      fast=self.fast, append=append)
+            self._writer.encode = self.instrument.timed('json',
+                                                        self._writer.encode)
+
+    def checkpoint(self):
+        # a compressed stream cannot be cut off at an earlier position
+        if self.compression is not None:
+            raise ValueError('cannot checkpoint compressed output '
+                             '{0}'.format(self.file_out))
+        self._open()
+        return {'position': self._writer.sync(), 'count': self.count}
+
+    def restore(self, state, replay):
+        with open(self.file_out, 'r+b') as f:
+            f.truncate(state['position'])
+        self._writer = None
+        self._open(append=True)
+        self.count = state['count']
+
+
+def run_visitors(osm_file, visitors, processes=1, index=None,
+                 instrument=DISABLED, shape=None):
+    """Parse osm_file once and feed every top level element to visitors.
+
+    visitors is a dict of name -> Visitor; returns a dict of name -> result.
+    With processes other than 1 the file is parsed in parallel by
+    osm_parallel (None uses every core), split where index says if given.
+    Compressed files cannot be split by byte range and are parsed in one
+    process (bz2 is still decompressed in parallel, see osm_decompress).
+    So are .pbf files, whose blocks osm_pbf decodes in parallel instead.
+    instrument (an osm_progress.Instrument) times parsing and each visitor.
+    shape, if given, shapes every element once for all DocumentVisitors
+    (see visit_functions).
+    """
+    if processes != 1 and compression_of(osm_file) is None and \
+            not is_pbf(osm_file):
+        return run_parallel(osm_file, visitors, processes, index=index,
+                            instrument=instrument, shape=shape)
+
+    def start(root):
+        for v in visitors.values():
+            v.start(root)
+
+    visits = visit_functions(visitors, instrument, shape)
+    for elem in instrument.elements(osm_file, tags=None, on_root=start):
+        for visit in visits:
+            visit(elem)
+
+    for v in visitors.values():
+        v.finish()
+    return dict((name, v.result()) for name, v in visitors.items())
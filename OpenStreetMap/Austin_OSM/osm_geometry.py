@@ -0,0 +1,138 @@
+"""Vectorized way geometry from node_refs.
+
+Ways come out of shape_element with node ids only.  way_geometry resolves
+all refs of all ways in one ``searchsorted`` over the NodeStore's sorted id
+array and reduces them per way with ``reduceat`` / ``bincount``, so no
+per-ref dict lookups happen in Python.
+
+Per way it returns, as arrays in way order:
+
+  min_lat, min_lon, max_lat, max_lon   bounding box of the resolved nodes
+  centroid_lat, centroid_lon           mean of the resolved nodes
+  length_m                             haversine length along the refs
+  missing                              refs not found in the store
+
+Ways without any resolved node get NaN boxes, centroids and a 0 length.
+Segments touching an unresolved node are left out of the length.
+"""
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters, elementwise over degree arrays."""
+    lat1, lon1, lat2, lon2 = [np.radians(a) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def way_geometry(nodes, ref_offsets, refs):
+    """Geometry of every way; way i uses refs[ref_offsets[i]:ref_offsets[i+1]].
+
+    nodes is an osm_nodes.NodeStore.
+    """
+    ref_offsets = np.asarray(ref_offsets, dtype=np.int64)
+    refs = np.asarray(refs, dtype=np.int64)
+    n = len(ref_offsets) - 1
+    counts = np.diff(ref_offsets)
+    lat, lon, found = nodes.lookup_many(refs)
+    way = np.repeat(np.arange(n), counts)
+
+    geometry = dict((name, np.full(n, np.nan)) for name in
+                    ('min_lat', 'min_lon', 'max_lat', 'max_lon',
+                     'centroid_lat', 'centroid_lon'))
+    resolved = np.bincount(way[found], minlength=n)
+    geometry['missing'] = counts - resolved
+
+    nonempty = counts > 0
+    if nonempty.any():
+        starts = ref_offsets[:-1][nonempty]
+        # fmin/fmax skip the NaNs of unresolved refs
+        for name, ufunc, values in (('min_lat', np.fmin, lat),
+                                    ('min_lon', np.fmin, lon),
+                                    ('max_lat', np.fmax, lat),
+                                    ('max_lon', np.fmax, lon)):
+            geometry[name][nonempty] = ufunc.reduceat(values, starts)
+
+    has_nodes = resolved > 0
+    for name, values in (('centroid_lat', lat), ('centroid_lon', lon)):
+        sums = np.bincount(way[found], weights=values[found], minlength=n)
+        geometry[name][has_nodes] = sums[has_nodes] / resolved[has_nodes]
+
+    segment = (way[1:] == way[:-1]) & found[1:] & found[:-1]
+    distance = haversine(lat[:-1][segment], lon[:-1][segment],
+                         lat[1:][segment], lon[1:][segment])
+    geometry['length_m'] = np.bincount(way[:-1][segment], weights=distance,
+                                       minlength=n).astype(np.float64)
+    return geometry
+
+
+def geometry_from_columns(columns, nodes):
+    """way_geometry of the ways in an osm_columnar export."""
+    return way_geometry(nodes, columns['ways.ref_offsets'],
+                        columns['ways.refs'])
+
+
+def _reference(nodes, refs):
+    """way_geometry of one way, node by node."""
+    points = [nodes.lookup(ref) for ref in refs]
+    resolved = [p for p in points if p is not None]
+    length = sum(float(haversine(a[0], a[1], b[0], b[1]))
+                 for a, b in zip(points, points[1:])
+                 if a is not None and b is not None)
+    if not resolved:
+        return [np.nan] * 6 + [length, len(refs)]
+    lats, lons = [p[0] for p in resolved], [p[1] for p in resolved]
+    return [min(lats), min(lons), max(lats), max(lons),
+            sum(lats) / len(lats), sum(lons) / len(lons),
+            length, len(refs) - len(resolved)]
+
+
+def test(ways=2000, seed=0):
+    """Boxes, centroids, lengths and missing refs match a per-way loop."""
+    from osm_nodes import NodeStore
+
+    names = ('min_lat', 'min_lon', 'max_lat', 'max_lon', 'centroid_lat',
+             'centroid_lon', 'length_m', 'missing')
+    nodes = NodeStore(np.array([1, 2, 3, 5]),
+                      np.array([30.0, 30.0, 30.1, 30.2]),
+                      np.array([-97.0, -97.1, -97.1, -97.2]))
+    cases = [[1, 2, 3],     # resolved
+             [4, 2, 9, 5],  # missing first and inside: no segment left
+             [],            # no refs
+             [8, 9],        # nothing resolved: NaN box, 0 m
+             [1],           # a single node
+             [1, 2, 1]]     # closed
+    offsets = np.cumsum([0] + [len(refs) for refs in cases])
+    geometry = way_geometry(nodes, offsets, sum(cases, []))
+    segment = float(haversine(30.0, -97.0, 30.0, -97.1))
+    assert geometry['missing'].tolist() == [0, 2, 0, 2, 0, 0]
+    assert geometry['length_m'].tolist()[1:5] == [0, 0, 0, 0]
+    assert abs(geometry['length_m'][5] - 2 * segment) < 1e-6
+    assert np.isnan(geometry['min_lat'][[2, 3]]).all()
+    assert np.isnan(geometry['centroid_lon'][[2, 3]]).all()
+    assert (geometry['min_lat'][1], geometry['max_lat'][1]) == (30.0, 30.2)
+    assert geometry['centroid_lat'][1] == 30.1
+
+    rng = np.random.RandomState(seed)
+    ids = np.unique(rng.randint(0, 10000, 3000))
+    nodes = NodeStore(ids, rng.uniform(30, 30.5, len(ids)),
+                      rng.uniform(-98, -97.5, len(ids)))
+    cases = [rng.randint(0, 10000, rng.randint(0, 8)).tolist()
+             for _ in range(ways)]
+    offsets = np.cumsum([0] + [len(refs) for refs in cases])
+    geometry = way_geometry(nodes, offsets, sum(cases, []))
+    for i, refs in enumerate(cases):
+        expected = _reference(nodes, refs)
+        for name, value in zip(names, expected):
+            actual = geometry[name][i]
+            assert (np.isnan(value) and np.isnan(actual)) or \
+                abs(actual - value) < 1e-6, (i, name, actual, value)
+    print('{0:,} ways, {1:,} without a resolved node'.format(
+        ways, int(np.isnan(geometry['min_lat']).sum())))
+
+
+if __name__ == '__main__':
+    test()
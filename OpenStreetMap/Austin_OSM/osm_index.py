@@ -0,0 +1,197 @@
+"""Sidecar byte-offset index for random access into .osm files.
+
+``build_index`` scans the raw bytes of an extract once and records, for
+every top level node, way and relation, its id and the offset and length of
+its XML.  The result is stored next to the file (``austin_texas.osm.idx``)
+as three sorted integer arrays per element type, so fetching one element or
+a range of ids is a binary search plus one seek instead of a full iterparse.
+
+The arrays (NumPy int64 ids and offsets, int32 lengths) use the machine's
+native byte order; the sidecar is meant to be rebuilt, not shipped.
+"""
+import mmap
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from osm_arrays import Column
+from osm_output import compression_of, is_pbf
+from osm_parallel import body_range
+
+TYPES = ('node', 'way', 'relation')
+ELEMENT = re.compile(br'<(node|way|relation)(?=[\s/>])[^>]*?\sid="(-?\d+)"')
+WHITESPACE = b' \t\r\n'
+MAGIC = b'OSMIDX1\n'
+HEADER = struct.Struct('<qqqq')
+# bytes scanned between two hints that the pages behind may be dropped
+RELEASE_EVERY = 64 * 2 ** 20
+
+
+def iter_spans(osm_file, offset=None):
+    """Yield (type, id, offset, length) of every top level element.
+
+    An element runs from its start tag to the next element (or the closing
+    </osm>), minus the whitespace in between.  With offset, elements before
+    that byte (which must not be inside an element) are skipped.
+    """
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            _, start, end = body_range(data)
+            if offset is not None:
+                start = max(start, offset)
+            prev = None
+            released = 0
+            for m in ELEMENT.finditer(data, start, end):
+                if prev is not None:
+                    yield prev + (_span_length(data, prev[2], m.start()),)
+                    if prev[2] - released > RELEASE_EVERY:
+                        released = _release(data, released, prev[2])
+                prev = (m.group(1).decode('ascii'), int(m.group(2)),
+                        m.start())
+            if prev is not None:
+                yield prev + (_span_length(data, prev[2], end),)
+        finally:
+            data.close()
+
+
+def _release(data, start, end):
+    """Drop the mapped pages in [start, end) from RSS; returns where it did.
+
+    A long scan would otherwise keep the whole file mapped in memory (the
+    pages are clean, but they count as RSS).  Needs mmap.madvise (3.8+).
+    """
+    if not hasattr(data, 'madvise'):
+        return start
+    end -= end % mmap.PAGESIZE
+    if end > start:
+        data.madvise(mmap.MADV_DONTNEED, start, end - start)
+    return end
+
+
+def _span_length(data, start, end):
+    while end > start and data[end - 1:end] in WHITESPACE:
+        end -= 1
+    return end - start
+
+
+class OSMIndex(object):
+    """id -> (offset, length) lookups for one .osm file."""
+
+    def __init__(self, osm_file, arrays, source_size):
+        self.osm_file = osm_file
+        self.arrays = arrays
+        self.source_size = source_size
+        self._f = None
+
+    def __len__(self):
+        return sum(len(ids) for ids, _, _ in self.arrays.values())
+
+    def find(self, kind, id):
+        """(offset, length) of element kind/id, or None."""
+        ids, offsets, lengths = self.arrays[kind]
+        i = int(np.searchsorted(ids, int(id)))
+        if i < len(ids) and ids[i] == int(id):
+            return int(offsets[i]), int(lengths[i])
+        return None
+
+    def read(self, offset, length):
+        if self._f is None:
+            self._f = open(self.osm_file, 'rb')
+        self._f.seek(offset)
+        return self._f.read(length)
+
+    def get(self, kind, id):
+        """Parsed element kind/id, ready for shape_element, or None."""
+        span = self.find(kind, id)
+        if span is None:
+            return None
+        return ET.fromstring(self.read(*span))
+
+    def range(self, kind, lo, hi):
+        """Yield the parsed elements of kind with lo <= id < hi."""
+        ids, offsets, lengths = self.arrays[kind]
+        i, j = np.searchsorted(ids, [lo, hi])
+        for k in range(i, j):
+            yield ET.fromstring(self.read(int(offsets[k]), int(lengths[k])))
+
+    def split_points(self, chunks):
+        """Offsets of the elements that cut the file into chunks parts."""
+        starts = np.sort(np.concatenate([self.arrays[kind][1]
+                                         for kind in TYPES]))
+        if not len(starts):
+            return []
+        first, last = int(starts[0]), self.source_size
+        points = []
+        for i in range(1, chunks):
+            target = first + (last - first) * i // chunks
+            k = int(np.searchsorted(starts, target))
+            if k < len(starts) and (not points or starts[k] > points[-1]):
+                points.append(int(starts[k]))
+        return points
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def index_path(osm_file):
+    return osm_file + '.idx'
+
+
+def build_index(osm_file, path=None):
+    """Scan osm_file, write its sidecar index and return it."""
+    if compression_of(osm_file) is not None or is_pbf(osm_file):
+        raise ValueError('{0}: byte offsets need the uncompressed '
+                         'XML file'.format(osm_file))
+    columns = dict((kind, (Column(np.int64), Column(np.int64),
+                           Column(np.int32)))
+                   for kind in TYPES)
+    for kind, id, offset, length in iter_spans(osm_file):
+        ids, offsets, lengths = columns[kind]
+        ids.append(id)
+        offsets.append(offset)
+        lengths.append(length)
+
+    arrays = {}
+    for kind, built in columns.items():
+        ids, offsets, lengths = [column.array() for column in built]
+        if np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='mergesort')
+            ids, offsets, lengths = ids[order], offsets[order], lengths[order]
+        arrays[kind] = (ids, offsets, lengths)
+
+    source_size = os.path.getsize(osm_file)
+    with open(path or index_path(osm_file), 'wb') as fo:
+        fo.write(MAGIC)
+        fo.write(HEADER.pack(source_size, *[len(arrays[k][0])
+                                            for k in TYPES]))
+        for kind in TYPES:
+            for column in arrays[kind]:
+                column.tofile(fo)
+    return OSMIndex(osm_file, arrays, source_size)
+
+
+def load_index(osm_file, path=None):
+    """Read the sidecar index of osm_file, building it if missing or stale."""
+    path = path or index_path(osm_file)
+    if not os.path.exists(path) or \
+            os.path.getmtime(path) < os.path.getmtime(osm_file):
+        return build_index(osm_file, path)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not an OSM index'.format(path))
+        header = HEADER.unpack(f.read(HEADER.size))
+        source_size, counts = header[0], header[1:]
+        if source_size != os.path.getsize(osm_file):
+            f.close()
+            return build_index(osm_file, path)
+        arrays = {}
+        for kind, count in zip(TYPES, counts):
+            arrays[kind] = tuple(np.fromfile(f, dtype=dtype, count=count)
+                                 for dtype in (np.int64, np.int64, np.int32))
+    return OSMIndex(osm_file, arrays, source_size)
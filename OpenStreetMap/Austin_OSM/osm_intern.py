@@ -0,0 +1,412 @@
+"""Interning and dictionary encoding of the strings that repeat.
+
+Every element the parser hands out carries fresh string objects, so a list
+of shaped documents holds millions of copies of the same user names, uids,
+changesets, versions, tag keys and common values like 'parking'.
+
+Interner keeps one table per kind of string (a StringCodes: value -> code
+in first-seen order) and offers two things:
+
+  shape(doc)    the same document with every repeated string replaced by
+                one shared copy, so documents kept in memory share them
+  encode(doc)   the document with those strings replaced by integer codes,
+                for exports; decode() turns it back
+
+A table holds at most max_shared strings.  Once it is full, strings not in
+it yet (mostly values unique to one element, like names and house numbers)
+are passed through as they are, so memory does not grow with the file.
+
+An encoded document keeps type, id, pos, node_refs and the timestamps (unique
+per element) as they are.  created holds codes, and the remaining keys become
+[key, value] code pairs in 'tags' (top level) and 'address', where a string
+in place of a code is a value that did not fit in its table:
+
+  {"type": "node", "id": "1", "pos": [...], "created": {"user": 0, ...},
+   "tags": [[0, 3], [1, 4]], "address": [[2, 5]]}
+
+EncodedShaper writes such documents as JSON lines plus the tables, saved
+to <file_out>.dict.json.  The columnar export encodes users, keys and values
+the same way.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from osm_columnar import StringCodes
+from osm_engine import Shaper
+from osm_output import open_input
+from osm_progress import DISABLED
+
+CREATED_FIELDS = ('user', 'uid', 'changeset', 'version')
+TABLES = CREATED_FIELDS + ('keys', 'values')
+# kept as they are: unique per element, or not strings
+STRUCTURE = frozenset(['id', 'type', 'pos', 'node_refs', 'timestamp'])
+# strings per table
+MAX_SHARED = 100000
+
+
+class Interner(object):
+    """Shared copies and integer codes of repeated strings, per table."""
+
+    def __init__(self, tables=None, max_shared=MAX_SHARED):
+        self.tables = dict((name, StringCodes((tables or {}).get(name, ())))
+                           for name in TABLES)
+        self.max_shared = max_shared
+
+    def intern(self, table, value):
+        """The shared copy of value, or value once the table is full."""
+        return self._value(table, self.code(table, value))
+
+    def code(self, table, value):
+        """The code of value, or value once the table is full."""
+        codes = self.tables[table]
+        code = codes.codes.get(value)
+        if code is None:
+            if len(codes.values) >= self.max_shared:
+                return value
+            code = codes.code(value)
+        return code
+
+    def _value(self, table, code):
+        if isinstance(code, int):
+            return self.tables[table].values[code]
+        return code
+
+    def _created(self, created, convert):
+        return dict((k, convert(k, v) if k in CREATED_FIELDS else v)
+                    for k, v in created.items())
+
+    def shape(self, doc):
+        """doc with its repeated strings replaced by shared copies."""
+        intern = self.intern
+        out = {}
+        for key, value in doc.items():
+            if key in STRUCTURE:
+                out[key] = value
+            elif key == 'created':
+                out[key] = self._created(value, intern)
+            elif key == 'address':
+                out[key] = dict((intern('keys', k), intern('values', v))
+                                for k, v in value.items())
+            elif key in CREATED_FIELDS:
+                out[key] = intern(key, value)
+            else:
+                out[intern('keys', key)] = intern('values', value)
+        return out
+
+    def encode(self, doc):
+        """doc with its repeated strings replaced by integer codes."""
+        code = self.code
+        out = {}
+        tags = []
+        for key, value in doc.items():
+            if key in STRUCTURE:
+                out[key] = value
+            elif key == 'created':
+                out[key] = self._created(value, code)
+            elif key == 'address':
+                out[key] = [[code('keys', k), code('values', v)]
+                            for k, v in value.items()]
+            else:
+                tags.append([code('keys', key), code('values', value)])
+        out['tags'] = tags
+        return out
+
+    def decode(self, doc):
+        """Inverse of encode."""
+        get = self._value
+        out = {}
+        for key, value in doc.items():
+            if key == 'tags':
+                for k, v in value:
+                    out[get('keys', k)] = get('values', v)
+            elif key == 'address':
+                out[key] = dict((get('keys', k), get('values', v))
+                                for k, v in value)
+            elif key == 'created':
+                out[key] = self._created(value, get)
+            else:
+                out[key] = value
+        return out
+
+    def recoding(self, other):
+        """Per table, a list mapping other's codes to codes of self.
+
+        A code may map to the string itself when self's table is full.
+        """
+        return dict((name, [self.code(name, v) for v in
+                            other.tables[name].values])
+                    for name in TABLES)
+
+    def save(self, path):
+        """Write the tables to path; the file is replaced atomically."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump(dict((name, codes.values)
+                           for name, codes in self.tables.items()), fo)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.rename(tmp, path)
+
+    def sizes(self):
+        return dict((name, len(codes.values))
+                    for name, codes in self.tables.items())
+
+    def truncate(self, sizes):
+        """Forget the strings added after the tables had sizes."""
+        for name, size in sizes.items():
+            codes = self.tables[name]
+            for value in codes.values[size:]:
+                del codes.codes[value]
+            del codes.values[size:]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return sum(len(codes.values) for codes in self.tables.values())
+
+
+class InternedShape(object):
+    """shape_element whose documents share their repeated strings."""
+
+    def __init__(self, shape_element, interner=None):
+        self.shape_element = shape_element
+        self.interner = interner or Interner()
+
+    def __call__(self, element):
+        doc = self.shape_element(element)
+        return self.interner.shape(doc) if doc else doc
+
+
+def _recoded(codes, code):
+    return codes[code] if isinstance(code, int) else code
+
+
+def _recode(doc, recode):
+    created = doc.get('created')
+    if created:
+        for k in CREATED_FIELDS:
+            if k in created:
+                created[k] = _recoded(recode[k], created[k])
+    for name in ('tags', 'address'):
+        if name in doc:
+            doc[name] = [[_recoded(recode['keys'], k),
+                          _recoded(recode['values'], v)]
+                         for k, v in doc[name]]
+    return doc
+
+
+class EncodedShaper(Shaper):
+    """Shaper writing encoded documents and the tables they refer to."""
+
+    def __init__(self, shape_element, file_out, default=None,
+                 compression=None, fast=True, instrument=DISABLED):
+        Shaper.__init__(self, shape_element, file_out, default=default,
+                        compression=compression, fast=fast,
+                        instrument=instrument)
+        self.interner = Interner()
+        self.table_file = file_out + '.dict.json'
+
+    def write(self, el):
+        Shaper.write(self, self.interner.encode(el))
+
+    def finish(self):
+        Shaper.finish(self)
+        if self.table_file is not None:
+            self.interner.save(self.table_file)
+
+    def partial(self, index):
+        shaper = EncodedShaper(self.shape_element,
+                               '{0}.part{1}'.format(self.file_out, index),
+                               self.default, self.compression, self.fast,
+                               self.instrument)
+        shaper.table_file = None
+        return shaper
+
+    def merge(self, other):
+        """Append other's shard, re-coded into our tables."""
+        recode = self.interner.recoding(other.interner)
+        with open_input(other.file_out, self.compression) as shard:
+            for line in shard:
+                Shaper.write(self, _recode(json.loads(line.decode('utf-8')),
+                                           recode))
+        os.remove(other.file_out)
+
+    def checkpoint(self):
+        """Shaper's checkpoint, with the tables saved up to this point.
+
+        Tables only grow, so their sizes are all the checkpoint needs to
+        hold; the table file written here may be ahead of it.
+        """
+        if self.table_file is None:
+            raise ValueError('a partial EncodedShaper has no table file '
+                             'to checkpoint')
+        state = Shaper.checkpoint(self)
+        self.interner.save(self.table_file)
+        state['tables'] = self.interner.sizes()
+        return state
+
+    def restore(self, state, replay):
+        Shaper.restore(self, state, replay)
+        self.interner = Interner.load(self.table_file)
+        self.interner.truncate(state['tables'])
+
+
+def measure(osm_file, shape_element):
+    """Bytes allocated by the shaped documents of osm_file, kept in a list.
+
+    Returns {'plain': bytes, 'interned': bytes, 'documents': n}.
+    Needs tracemalloc (Python 3).
+    """
+    import gc
+    import tracemalloc
+    from osm_stream import get_element
+
+    sizes = {}
+    for name, shape in (('plain', shape_element),
+                        ('interned', InternedShape(shape_element))):
+        gc.collect()
+        tracemalloc.start()
+        docs = [doc for doc in (shape(e) for e in get_element(osm_file))
+                if doc]
+        sizes[name] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        sizes['documents'] = len(docs)
+        del docs
+    return sizes
+
+
+def export_sizes(osm_file, shape_element, default=None):
+    """Bytes of the plain and the encoded JSON lines export (with tables)."""
+    from osm_engine import run_visitors
+
+    plain, encoded = osm_file + '.plain.json', osm_file + '.encoded.json'
+    run_visitors(osm_file, {
+        'plain': Shaper(shape_element, plain, default=default),
+        'encoded': EncodedShaper(shape_element, encoded, default=default)})
+    sizes = {'plain': os.path.getsize(plain),
+             'encoded': os.path.getsize(encoded) +
+             os.path.getsize(encoded + '.dict.json')}
+    for path in (plain, encoded, encoded + '.dict.json'):
+        os.remove(path)
+    return sizes
+
+
+def _shape(elem):
+    from osm_columnar import _shape as shape_columns
+    doc = shape_columns(elem)
+    if doc is not None:
+        address = dict((k[5:], doc.pop(k)) for k in list(doc)
+                       if k.startswith('addr:'))
+        if address:
+            doc['address'] = address
+    return doc
+
+
+class _Counted(object):
+    """shape_element counting its calls."""
+
+    def __init__(self, shape_element):
+        self.shape_element = shape_element
+        self.calls = 0
+
+    def __call__(self, elem):
+        self.calls += 1
+        return self.shape_element(elem)
+
+
+def _read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def _export(osm_file, directory, processes, shared):
+    """Run the four document visitors; their outputs and the shape calls."""
+    from osm_columnar import ColumnarExport, load_columnar
+    from osm_engine import run_visitors
+    from osm_summary import SummaryBuilder
+
+    counted = _Counted(_shape)
+    json_file = os.path.join(directory, 'plain.json')
+    encoded_file = os.path.join(directory, 'encoded.json')
+    columns = os.path.join(directory, 'columns')
+    results = run_visitors(osm_file, {
+        'json': Shaper(counted, json_file),
+        'encoded': EncodedShaper(counted, encoded_file),
+        'columns': ColumnarExport(counted, columns),
+        'summary': SummaryBuilder(counted)},
+        processes=processes,
+        shape=InternedShape(counted) if shared else None)
+    arrays, dictionaries = load_columnar(columns, mmap_mode=None)
+    keys, values = dictionaries['keys'], dictionaries['values']
+    tags = sorted(zip(arrays.pop('tags.kind').tolist(),
+                      arrays.pop('tags.row').tolist(),
+                      [keys[k] for k in arrays.pop('tags.key')],
+                      [values[v] for v in arrays.pop('tags.value')]))
+    summary = results['summary']
+    return {'json': _read(json_file),
+            'encoded': _read(encoded_file),
+            'tables': Interner.load(encoded_file + '.dict.json'),
+            'columns': dict((k, v.tolist()) for k, v in arrays.items()),
+            'tags': tags,
+            'users': dictionaries['users'],
+            'summary': (summary.documents, summary.counters),
+            'calls': counted.calls}
+
+
+def test(size=4 * 2 ** 20):
+    """Shaping once for all visitors changes no output; codes round-trip."""
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        runs = {}
+        for processes in (1, 2):
+            for shared in (False, True):
+                directory = os.path.join(tmp, '{0}{1}'.format(processes,
+                                                              shared))
+                os.makedirs(directory)
+                runs[processes, shared] = _export(osm_file, directory,
+                                                  processes, shared)
+        serial = runs[1, False]
+        documents = serial['summary'][0]
+        elements = serial['calls'] // 4
+        assert documents and runs[1, True]['calls'] == elements
+        for key, run in runs.items():
+            for name in ('json', 'columns', 'tags', 'users', 'summary'):
+                assert run[name] == serial[name], (key, name)
+            # codes of keys and values follow the key order, which Python 2
+            # dicts do not keep: compare encoded documents decoded, parallel
+            # runs after their merge
+            tables = run['tables']
+            assert [tables.decode(doc) for doc in run['encoded']] == \
+                serial['json'], key
+        print('{0:,} documents, shaped once: {1:,} calls instead of {2:,}'
+              .format(documents, elements, serial['calls']))
+
+        # a full table passes new strings through, and they still decode
+        interner = Interner(max_shared=3)
+        docs = serial['json'][:1000]
+        encoded = [interner.encode(doc) for doc in docs]
+        assert [interner.decode(doc) for doc in encoded] == docs
+        assert all(size <= 3 for size in interner.sizes().values())
+        assert [interner.shape(doc) for doc in docs] == docs
+        merged = Interner(max_shared=3)
+        merged.encode(docs[-1])
+        recode = merged.recoding(interner)
+        assert [merged.decode(_recode(json.loads(json.dumps(doc)), recode))
+                for doc in encoded] == docs
+        print('round trip with full tables: {0:,} documents'
+              .format(len(docs)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
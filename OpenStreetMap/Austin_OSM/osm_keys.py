@@ -0,0 +1,71 @@
+"""Memoized classification of <tag> "k" values.
+
+key_type used to run up to three regex searches on every tag and
+shape_element ran two of them again.  The set of distinct keys in an extract
+is tiny next to the number of tags, so each key is classified once and the
+category is served from a bounded cache afterwards.
+
+Categories:
+  "lower", for tags that contain only lowercase letters and are valid,
+  "lower_colon", for otherwise valid tags with a colon in their names,
+  "problemchars", for tags with problematic characters, and
+  "other", for other tags that do not fall into the other three categories.
+"""
+import re
+import sys
+import time
+
+from osm_cache import BoundedCache
+from osm_stream import get_element
+
+lower = re.compile(r'^([a-z]|_)*$')
+lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+
+def key_category(k):
+    """Uncached regex cascade: category of the tag key k."""
+    if lower.search(k):
+        return 'lower'
+    elif lower_colon.search(k):
+        return 'lower_colon'
+    elif problemchars.search(k):
+        return 'problemchars'
+    return 'other'
+
+
+# Shared by key_type, process_map and shape_element.
+classify_key = BoundedCache(key_category, maxsize=50000)
+
+
+def benchmark(osm_file, repeat=3, truncated=False):
+    """Tags/sec of the plain regex cascade vs. the cached classifier.
+
+    truncated is passed to get_element (sample.osm is cut off).
+    """
+    keys = [tag.attrib['k']
+            for elem in get_element(osm_file, truncated=truncated)
+            for tag in elem.iter('tag')]
+    classifier = BoundedCache(key_category, maxsize=50000)
+    rates = {}
+    for name, classify in (('regex', key_category), ('cached', classifier)):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for k in keys:
+                classify(k)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[name] = len(keys) / best if best else float('inf')
+    rates['tags'] = len(keys)
+    rates['cache'] = classifier.stats()
+    return rates
+
+
+if __name__ == '__main__':
+    result = benchmark(sys.argv[1] if len(sys.argv) > 1 else 'sample.osm',
+                       truncated=True)
+    print('{0} tags: regex {1:,.0f} tags/sec, cached {2:,.0f} tags/sec, '
+          'hit rate {3:.4f}'.format(result['tags'], result['regex'],
+                                    result['cached'],
+                                    result['cache']['hit_rate']))
@@ -0,0 +1,204 @@
+"""Stream shaped documents straight into MongoDB.
+
+process_map used to write the whole extract to a JSON file, which
+mongoimport then read back.  BulkLoader is a visitor that shapes each
+element and hands batches of documents to a few writer threads.  The
+threads send them with unordered ``insert_many`` calls, so no intermediate
+file is needed.  All writers of a process share one MongoClient (pymongo
+clients are thread safe and pool their connections).  A bounded queue keeps
+the parser at most a couple of batches ahead of the database.
+
+MongoTarget names the collection by uri, database and collection instead
+of holding a connection, so a loader can be pickled to osm_parallel
+workers; each process opens its own client.  With
+client_class=osm_aggregate.Client the documents are loaded into memory
+instead, which is how ``test`` runs without a server.
+
+Run by osm_checkpoint, a BulkLoader waits for every queued batch at each
+checkpoint, and a resumed load first deletes the documents of the elements
+that may have been inserted after the last one.  Those are found by their
+``type`` and ``id`` fields, as shape_element writes them.
+"""
+import os
+import tempfile
+import threading
+from collections import defaultdict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from osm_engine import DocumentVisitor, run_visitors
+
+BATCH_SIZE = 1000
+WRITERS = 4
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(uri, client_class=None):
+    """The client for uri shared by everything in this process."""
+    # keyed by pid: a client inherited across fork() must not be reused
+    key = (os.getpid(), client_class, uri)
+    with _clients_lock:
+        if key not in _clients:
+            if client_class is None:
+                from pymongo import MongoClient
+                client_class = MongoClient
+            _clients[key] = client_class(uri)
+        return _clients[key]
+
+
+class MongoTarget(object):
+    """Picklable reference to a collection; calling it returns it."""
+
+    def __init__(self, uri, db_name, name, client_class=None):
+        self.uri = uri
+        self.db_name = db_name
+        self.name = name
+        self.client_class = client_class
+
+    def __call__(self):
+        client = get_client(self.uri, self.client_class)
+        return client[self.db_name][self.name]
+
+
+class BulkLoader(DocumentVisitor):
+    """Shape every element and insert the documents in batches.
+
+    target is a zero-argument callable returning the collection, such as a
+    MongoTarget.  The result is the number of documents inserted.
+    """
+
+    def __init__(self, shape_element, target, batch_size=BATCH_SIZE,
+                 writers=WRITERS):
+        self.shape_element = shape_element
+        self.target = target
+        self.batch_size = batch_size
+        self.writers = writers
+        self.batch = []
+        self.written = []
+        self.errors = []
+        self.queue = None
+        self.threads = []
+
+    def _start_writers(self):
+        collection = self.target()
+        self.queue = queue.Queue(maxsize=2 * self.writers)
+        self.threads = [threading.Thread(target=self._write,
+                                         args=(collection,))
+                        for _ in range(self.writers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _write(self, collection):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            try:
+                if not self.errors:  # else drain so the parser never blocks
+                    collection.insert_many(batch, ordered=False)
+                    self.written.append(len(batch))
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _flush(self):
+        if self.errors:
+            raise self.errors[0]
+        if not self.batch:
+            return
+        if self.queue is None:
+            self._start_writers()
+        self.queue.put(self.batch)
+        self.batch = []
+
+    def visit_doc(self, doc):
+        # insert_many adds _id to what it inserts; the document is shared
+        self.batch.append(dict(doc))
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def finish(self):
+        self._flush()
+        if self.queue is not None:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.queue = None
+            self.threads = []
+        if self.errors:
+            raise self.errors[0]
+
+    def result(self):
+        return sum(self.written)
+
+    def partial(self, index):
+        # workers insert their own chunk; only the counts come back
+        return BulkLoader(self.shape_element, self.target,
+                          self.batch_size, self.writers)
+
+    def merge(self, other):
+        self.written.extend(other.written)
+
+    def checkpoint(self):
+        self._flush()
+        if self.queue is not None:
+            self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+        return {'written': self.result()}
+
+    def restore(self, state, replay):
+        collection = self.target()
+        ids = defaultdict(list)
+        for kind, id in replay:
+            ids[kind].append(str(id))
+        for kind, kind_ids in ids.items():
+            collection.delete_many({'type': kind, 'id': {'$in': kind_ids}})
+        self.written = [state['written']]
+
+
+def _shape(elem):
+    if elem.tag not in ('node', 'way'):
+        return None
+    doc = dict(elem.attrib)
+    doc['type'] = elem.tag
+    doc['tags'] = dict((t.get('k'), t.get('v')) for t in elem.iter('tag'))
+    return doc
+
+
+def test(size=4 * 2 ** 20):
+    """Loaded documents must be exactly the shaped elements, in any order."""
+    from osm_aggregate import Client
+    from osm_stream import get_element
+    from osm_synthetic import write_osm
+
+    fd, path = tempfile.mkstemp(suffix='.osm')
+    os.close(fd)
+    try:
+        write_osm(path, size)
+        expected = sorted((doc['type'], int(doc['id'])) for doc in
+                          (_shape(e) for e in get_element(path)) if doc)
+        for batch_size, writers in ((1, 1), (97, 3), (1000, 8)):
+            target = MongoTarget('memory', 'openstreetmap',
+                                 'load{0}'.format(batch_size), Client)
+            loader = BulkLoader(_shape, target, batch_size, writers)
+            inserted = run_visitors(path, {'load': loader})['load']
+            ids = sorted((doc['type'], int(doc['id']))
+                         for doc in target().docs)
+            assert inserted == len(expected), (inserted, len(expected))
+            assert ids == expected
+            print('batch {0}, {1} writers: {2} documents'.format(
+                batch_size, writers, inserted))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
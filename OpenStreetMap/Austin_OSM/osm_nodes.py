@@ -0,0 +1,188 @@
+"""Compact, array-backed node coordinate store.
+
+shape_element keeps ``pos`` as a list of two Python floats per node, which
+costs hundreds of bytes per node once it sits in a dict.  NodeStore keeps
+the coordinates of every node in three parallel arrays sorted by id:
+
+  ids         int64
+  lat, lon    float64, or int32 fixed point in 1e-7 degrees (OSM's own
+              precision) with fixed_point=True: 16 bytes per node
+
+so a metro extract's nodes take a few hundred MB at most.  id -> (lat, lon)
+is a binary search.  A store can be saved as .npy files and loaded back
+memory-mapped.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from osm_arrays import Column
+from osm_engine import Visitor
+
+SCALE = 10 ** 7
+
+
+class NodeStore(object):
+    """id -> (lat, lon) lookups over sorted coordinate arrays."""
+
+    def __init__(self, ids, lat, lon, fixed_point=False):
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+        self.fixed_point = fixed_point
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _degrees(self, values):
+        if self.fixed_point:
+            return values / float(SCALE)
+        return values
+
+    def lookup(self, id):
+        """(lat, lon) of node id, or None if it is not in the store."""
+        i = np.searchsorted(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return (float(self._degrees(self.lat[i])),
+                    float(self._degrees(self.lon[i])))
+        return None
+
+    def lookup_many(self, ids):
+        """Vectorized lookup: (lat, lon, found) arrays, NaN where missing."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            missing = np.full(len(ids), np.nan)
+            return missing, missing.copy(), np.zeros(len(ids), dtype=bool)
+        i = np.searchsorted(self.ids, ids)
+        i[i == len(self.ids)] = 0
+        found = self.ids[i] == ids
+        lat = np.where(found, self._degrees(self.lat[i]), np.nan)
+        lon = np.where(found, self._degrees(self.lon[i]), np.nan)
+        return lat, lon, found
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ('ids', 'lat', 'lon'):
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+        with open(os.path.join(directory, 'store.json'), 'w') as fo:
+            json.dump({'fixed_point': self.fixed_point}, fo)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'store.json')) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(directory, name + '.npy'),
+                          mmap_mode=mmap_mode)
+                  for name in ('ids', 'lat', 'lon')]
+        return cls(*arrays, fixed_point=meta['fixed_point'])
+
+
+class NodeStoreBuilder(Visitor):
+    """Collect node coordinates during the streaming pass.
+
+    The result is a NodeStore, saved to directory when one is given.
+    """
+
+    def __init__(self, directory=None, fixed_point=False):
+        self.directory = directory
+        self.fixed_point = fixed_point
+        self.ids = Column(np.int64)
+        dtype = np.int32 if fixed_point else np.float64
+        self.lat = Column(dtype)
+        self.lon = Column(dtype)
+        self.store = None
+
+    def visit(self, elem):
+        if elem.tag != 'node':
+            return
+        lat, lon = elem.get('lat'), elem.get('lon')
+        if lat is None or lon is None:
+            return
+        self.ids.append(int(elem.attrib['id']))
+        if self.fixed_point:
+            self.lat.append(int(round(float(lat) * SCALE)))
+            self.lon.append(int(round(float(lon) * SCALE)))
+        else:
+            self.lat.append(float(lat))
+            self.lon.append(float(lon))
+
+    def partial(self, index):
+        return NodeStoreBuilder(None, self.fixed_point)
+
+    def merge(self, other):
+        self.ids.extend(other.ids)
+        self.lat.extend(other.lat)
+        self.lon.extend(other.lon)
+
+    def finish(self):
+        # partials have no directory: their arrays go back to be merged
+        if self.directory is not None:
+            self.result().save(self.directory)
+
+    def _build(self):
+        ids, lat, lon = self.ids.array(), self.lat.array(), self.lon.array()
+        if len(ids) and np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='mergesort')
+            ids, lat, lon = ids[order], lat[order], lon[order]
+        return NodeStore(ids, lat, lon, self.fixed_point)
+
+    def result(self):
+        if self.store is None:
+            self.store = self._build()
+        return self.store
+
+
+def test(size=4 * 2 ** 20):
+    """Lookups give every node's coordinates, serial, parallel and loaded."""
+    from osm_engine import run_visitors
+    from osm_stream import get_element
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        expected = dict((int(e.get('id')), (float(e.get('lat')),
+                                            float(e.get('lon'))))
+                        for e in get_element(osm_file, tags=('node',)))
+        ids = sorted(expected)
+        missing = [ids[0] - 1, ids[-1] + 1]
+        for fixed_point in (False, True):
+            tolerance = 0.5 / SCALE if fixed_point else 0
+            for processes in (1, 2):
+                directory = os.path.join(tmp, 'nodes{0}{1}'.format(
+                    processes, fixed_point))
+                store = run_visitors(osm_file, {
+                    'nodes': NodeStoreBuilder(directory, fixed_point)},
+                    processes=processes)['nodes']
+                for store in (store, NodeStore.load(directory)):
+                    assert len(store) == len(expected)
+                    assert list(store.ids) == ids
+                    for id in ids[::97]:
+                        lat, lon = store.lookup(id)
+                        assert abs(lat - expected[id][0]) <= tolerance
+                        assert abs(lon - expected[id][1]) <= tolerance
+                    assert all(store.lookup(id) is None for id in missing)
+                    lat, lon, found = store.lookup_many(ids + missing)
+                    assert found.tolist() == [True] * len(ids) + \
+                        [False, False]
+                    assert np.all(np.abs(lat[:-2] - np.array(
+                        [expected[id][0] for id in ids])) <= tolerance)
+                    assert np.isnan(lat[-2:]).all() and \
+                        np.isnan(lon[-2:]).all()
+        empty = NodeStoreBuilder().result()
+        assert len(empty) == 0 and empty.lookup(1) is None
+        assert not empty.lookup_many([1, 2])[2].any()
+        print('{0:,} nodes: float and fixed point, 1 and 2 processes'
+              .format(len(expected)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
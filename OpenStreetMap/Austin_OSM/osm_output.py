@@ -0,0 +1,173 @@
+"""Buffered, batched and optionally compressed JSON lines output.
+
+process_map serialized every document with json.dumps and wrote it with a
+separate fo.write.  JsonWriter collects documents into batches, serializes
+a batch at once and writes it as one large block.  It uses orjson when it
+is installed (several times faster than json.dumps), and the json module
+otherwise or for pretty output.  orjson is called with
+OPT_PASSTHROUGH_DATETIME, so datetimes still go through ``default`` (e.g.
+bson.json_util.default) exactly as with json.dumps.  Output is the same
+documents either way; only the whitespace between tokens differs.
+
+Files whose names end in .gz, .bz2 or .zst are compressed while they are
+written (.zst needs the zstandard package); ``open_input`` opens them for
+reading the same way.  Concatenated gzip members, bz2 streams and zstd
+frames form valid files, so osm_engine.Shaper can still merge the shards of
+a parallel run by copying their bytes.
+"""
+import bz2
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BATCH_SIZE = 1000
+BUFFER_SIZE = 1 << 20
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd'}
+
+
+def compression_of(path):
+    """'gzip', 'bz2', 'zstd' or None, from the file name extension."""
+    for extension, compression in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def _open(path, mode, compression, level):
+    if compression is None:
+        return open(path, mode, BUFFER_SIZE)
+    if compression == 'gzip':
+        return gzip.open(path, mode, 6 if level is None else level)
+    if compression == 'bz2':
+        return bz2.BZ2File(path, mode, compresslevel=9 if level is None
+                           else level)
+    if compression == 'zstd':
+        import zstandard
+        if 'w' in mode:
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(
+                level=3 if level is None else level))
+        return zstandard.open(path, mode)
+    raise ValueError('unknown compression {0!r}'.format(compression))
+
+
+def is_pbf(path):
+    """True for an .osm.pbf extract, which osm_pbf reads."""
+    return path.endswith('.pbf')
+
+
+def open_output(path, compression=None, level=None, append=False):
+    """Binary file for writing; compressed as the extension says if None."""
+    return _open(path, 'ab' if append else 'wb',
+                 compression or compression_of(path), level)
+
+
+def open_input(path, compression=None):
+    """Binary file for reading, decompressing as the extension says."""
+    return _open(path, 'rb', compression or compression_of(path), None)
+
+
+def make_encoder(default=None, pretty=False, fast=True):
+    """Function serializing one document to a JSON line (bytes)."""
+    if fast and orjson is not None and not pretty:
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_APPEND_NEWLINE
+
+        def encode(doc):
+            return orjson.dumps(doc, default=default, option=option)
+        return encode
+
+    indent = 2 if pretty else None
+
+    def encode(doc):
+        return (json.dumps(doc, indent=indent, default=default) +
+                "\n").encode('utf-8')
+    return encode
+
+
+class JsonWriter(object):
+    """Write documents as JSON lines in batches to a (compressed) file."""
+
+    def __init__(self, path, default=None, pretty=False, compression=None,
+                 batch_size=BATCH_SIZE, fast=True, level=None, append=False):
+        self.path = path
+        self.encode = make_encoder(default, pretty, fast)
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        self._fo = open_output(path, compression, level, append)
+
+    def write(self, doc):
+        self.batch.append(doc)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_line(self, line):
+        """Write an already serialized line (bytes ending in a newline)."""
+        self.flush()
+        self._fo.write(line)
+        self.count += 1
+
+    def flush(self):
+        if self.batch:
+            encode = self.encode
+            self._fo.write(b''.join([encode(doc) for doc in self.batch]))
+            self.count += len(self.batch)
+            self.batch = []
+
+    def sync(self):
+        """Flush everything to disk; returns the position in the file."""
+        self.flush()
+        self._fo.flush()
+        os.fsync(self._fo.fileno())
+        return self._fo.tell()
+
+    def close(self):
+        if self._fo is not None:
+            self.flush()
+            self._fo.close()
+            self._fo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def benchmark(docs, path, default=None, repeat=3):
+    """Documents per second and bytes written, per writer configuration."""
+    import os
+    import time
+
+    docs = list(docs)
+    configurations = [('json.dumps per line', None)]
+    configurations += [('JsonWriter json', dict(fast=False)),
+                       ('JsonWriter ' + ('orjson' if orjson else 'json'),
+                        dict(fast=True))]
+    configurations += [('JsonWriter ' + extension, dict(fast=True))
+                       for extension in ('.gz', '.bz2')]
+    rates = {}
+    for name, options in configurations:
+        out = path + (name.split()[-1] if name.endswith(('.gz', '.bz2'))
+                      else '')
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            if options is None:
+                with open(out, 'wb') as fo:
+                    for doc in docs:
+                        fo.write((json.dumps(doc, default=default) +
+                                  "\n").encode('utf-8'))
+            else:
+                with JsonWriter(out, default, **options) as writer:
+                    for doc in docs:
+                        writer.write(doc)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[name] = (len(docs) / best, os.path.getsize(out))
+        os.remove(out)
+    return rates
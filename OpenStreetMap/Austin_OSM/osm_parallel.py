@@ -0,0 +1,201 @@
+"""Parse an OSM file in a process pool, one byte range per task.
+
+The body of the <osm> element is split into byte ranges that each start on
+a top level <node>, <way> or <relation>.  Every range is parsed on its own
+(wrapped in the file's own <osm ...> start tag) by a worker running fresh
+partial copies of the visitors, and the partial results are merged back in
+file order so they match a serial ``run_visitors`` exactly.
+
+The partial copies are made in the parent before any chunk runs, and only
+they (with the functions they wrap) are pickled to the workers, never the
+visitors being merged into; the functions must be importable or, as in the
+notebook, defined before the pool forks.
+An osm_progress.Instrument times the workers' stages; their stats are
+merged back with the results.
+"""
+import mmap
+import multiprocessing
+import os
+import re
+
+from osm_progress import DISABLED
+
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+ROOT_START = re.compile(br'<osm(?:\s[^>]*)?>')
+ROOT_END = b'</osm>'
+
+
+def body_range(data):
+    """Return (root start tag, body start, body end) of a mapped file."""
+    m = ROOT_START.search(data)
+    if m is None:
+        raise ValueError('no <osm> root element found')
+    end = data.rfind(ROOT_END)
+    if end < m.end():
+        end = len(data)
+    return m.group(), m.end(), end
+
+
+def chunk_ranges(osm_file, chunks, index=None):
+    """Split osm_file into at most chunks (start, end) byte ranges.
+
+    Every range but the first begins on a top level element, the first also
+    holds whatever precedes the first element (<bounds>, ...).  Split points
+    come from index (an osm_index.OSMIndex) when given, otherwise they are
+    searched for in the file.
+    """
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            root_tag, start, end = body_range(data)
+            points = [start]
+            if index is not None:
+                points.extend(p for p in index.split_points(chunks)
+                              if start < p < end)
+                chunks = 0
+            for i in range(1, chunks):
+                target = start + (end - start) * i // chunks
+                m = ELEMENT_START.search(data, max(target, points[-1] + 1),
+                                         end)
+                if m is None:
+                    break
+                points.append(m.start())
+        finally:
+            data.close()
+    points.append(end)
+    return root_tag, list(zip(points[:-1], points[1:]))
+
+
+class RangeFile(object):
+    """Read-only file serving prefix, bytes [start, end) of path, suffix."""
+
+    def __init__(self, path, start, end, prefix=b'', suffix=b''):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.prefix) + self.remaining + len(self.suffix)
+        out = b''
+        if self.prefix:
+            out, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(out) < size and self.remaining:
+            data = self.f.read(min(size - len(out), self.remaining))
+            self.remaining -= len(data)
+            out += data
+        if len(out) < size and not self.remaining and self.suffix:
+            n = size - len(out)
+            out, self.suffix = out + self.suffix[:n], self.suffix[n:]
+        return out
+
+    def close(self):
+        self.f.close()
+
+
+def run_chunk(task):
+    """Worker: run partial visitors over one byte range.
+
+    Returns the partial visitors and the chunk's instrument stats.
+    """
+    from osm_engine import visit_functions
+
+    osm_file, root_tag, start, end, index, partials, instrument, shape = task
+    instrument.worker()
+    visits = visit_functions(partials, instrument, shape)
+
+    def on_root(root):
+        if index == 0:
+            for v in partials.values():
+                v.start(root)
+
+    source = RangeFile(osm_file, start, end, root_tag, ROOT_END)
+    try:
+        for elem in instrument.elements(source, tags=None, on_root=on_root):
+            for visit in visits:
+                visit(elem)
+    finally:
+        source.close()
+    # flushes the chunk's own output (shards, queued batches); partials
+    # never write the final output, the merged parent's finish does
+    for v in partials.values():
+        v.finish()
+    return partials, instrument.stats()
+
+
+def run_parallel(osm_file, visitors, processes=None, chunks=None,
+                 index=None, instrument=DISABLED, shape=None):
+    """Parallel run_visitors: same results, parsed on processes cores."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunks is None:
+        chunks = processes * 4
+    root_tag, ranges = chunk_ranges(osm_file, chunks, index)
+    # fresh partials only: the parent's visitors hold open files once the
+    # first chunk is merged, and imap pickles the later tasks after that
+    tasks = [(osm_file, root_tag, start, end, i,
+              dict((name, v.partial(i)) for name, v in visitors.items()),
+              instrument, shape)
+             for i, (start, end) in enumerate(ranges)]
+    size = os.path.getsize(osm_file)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap keeps file order, so shards are merged as serial would write
+        for task, (partials, stats) in zip(tasks,
+                                           pool.imap(run_chunk, tasks)):
+            for name, v in visitors.items():
+                v.merge(partials[name])
+            if instrument.enabled:
+                instrument.merge(stats)
+                instrument.advance(position=task[3], total=size)
+    finally:
+        pool.close()
+        pool.join()
+
+    for v in visitors.values():
+        v.finish()
+    return dict((name, v.result()) for name, v in visitors.items())
+
+
+def _shape(elem):
+    if elem.tag not in ('node', 'way'):
+        return None
+    doc = dict(elem.attrib)
+    doc['type'] = elem.tag
+    return doc
+
+
+def test(size=4 * 2 ** 20, processes=2, chunks=200):
+    """Many more chunks than processes must give the serial results."""
+    import shutil
+    import tempfile
+    from osm_engine import (Shaper, TagCounter, UserCollector,
+                            run_visitors)
+    from osm_synthetic import write_osm
+
+    def visitors(out):
+        return {'tags': TagCounter(), 'users': UserCollector(),
+                'json': Shaper(_shape, out)}
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        serial = run_visitors(osm_file, visitors(osm_file + '.serial.json'))
+        parallel = run_parallel(osm_file, visitors(osm_file + '.json'),
+                                processes, chunks)
+        assert serial == parallel
+        with open(osm_file + '.serial.json', 'rb') as f1, \
+                open(osm_file + '.json', 'rb') as f2:
+            assert f1.read() == f2.read(), 'parallel export differs'
+        print('{0} chunks on {1} processes identical: {2:,} documents'.format(
+            chunks, processes, parallel['json']))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,94 @@
+"""Postcode parsing, validation and normalization.
+
+The valid Austin area ZIP codes are kept in a frozenset, so checking a code
+is a hash lookup rather than a scan of an 80 element list.  parse_postcode
+understands plain ZIPs, ZIP+4 ('78701-1234', '787011234') and the malformed
+variants found in the extract ('TX 78701', 'TX, 78701-1234', ' 78701 ');
+normalize_postcode reduces all of them to the 5 digit ZIP.
+"""
+import re
+
+from osm_cache import BoundedCache
+
+AUSTIN_ZIPS = frozenset([
+    "73301", "73344", "76574", "78602", "78610", "78612",
+    "78613", "78615", "78616", "78617", "78619", "78620",
+    "78621", "78626", "78628", "78634", "78640", "78641",
+    "78642", "78644", "78645", "78646", "78652", "78653",
+    "78654", "78656", "78660", "78663", "78664", "78665",
+    "78666", "78669", "78676", "78680", "78681", "78682",
+    "78691", "78701", "78702", "78703", "78704", "78705",
+    "78712", "78717", "78719", "78721", "78722", "78723",
+    "78724", "78725", "78726", "78727", "78728", "78729",
+    "78730", "78731", "78732", "78733", "78734", "78735",
+    "78736", "78737", "78738", "78739", "78741", "78742",
+    "78744", "78745", "78746", "78747", "78748", "78749",
+    "78750", "78751", "78752", "78753", "78754", "78756",
+    "78757", "78758", "78759", "78957"])
+
+POSTCODE = re.compile(r'^\s*(?:[A-Za-z]{2}[\s,]*)?(\d{5})(?:\s*-?\s*(\d{4}))?\s*$')
+
+
+def parse_postcode(value):
+    """(zip5, plus4) of value, plus4 None if absent; None if unparseable."""
+    m = POSTCODE.match(value)
+    if m is None:
+        return None
+    return m.group(1), m.group(2)
+
+
+def is_valid(zip5, valid=AUSTIN_ZIPS):
+    return zip5 in valid
+
+
+def _normalize(value):
+    parsed = parse_postcode(value)
+    if parsed is None:
+        # Unknown shape: keep what update_zip used to return
+        return value.split("-")[0].strip()
+    return parsed[0]
+
+
+# 5 digit ZIP for value; the same few hundred values repeat all over.
+normalize_postcode = BoundedCache(_normalize, maxsize=10000)
+
+
+def normalize_postcodes(values):
+    """Normalize a whole column of postcodes at once.
+
+    Every distinct value is parsed a single time; returns a list in the
+    order of values.
+    """
+    values = list(values)
+    distinct = dict.fromkeys(values)
+    for value in distinct:
+        distinct[value] = _normalize(value)
+    return [distinct[value] for value in values]
+
+
+def test():
+    """Plain ZIPs, ZIP+4 and the malformed variants parse and normalize."""
+    cases = [
+        ('78701', ('78701', None), '78701'),
+        ('78701-1234', ('78701', '1234'), '78701'),
+        ('787011234', ('78701', '1234'), '78701'),
+        ('78701 - 1234', ('78701', '1234'), '78701'),
+        ('TX 78701', ('78701', None), '78701'),
+        ('TX, 78701-1234', ('78701', '1234'), '78701'),
+        (' 78701 ', ('78701', None), '78701'),
+        ('7870', None, '7870'),
+        ('78701-123', None, '78701'),
+        ('Austin, TX', None, 'Austin, TX'),
+    ]
+    for value, parsed, normalized in cases:
+        assert parse_postcode(value) == parsed, (value, parse_postcode(value))
+        assert normalize_postcode(value) == normalized, value
+    values = [value for value, _, _ in cases] * 3
+    assert normalize_postcodes(values) == [_normalize(v) for v in values]
+    assert is_valid('78701') and not is_valid('90210')
+    assert is_valid('90210', valid=frozenset(['90210']))
+    print('{0} postcodes'.format(len(cases)))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,292 @@
+"""Stage timers, counters and progress lines for long passes.
+
+A pass over the full extract runs for many minutes without a word, and
+nothing tells whether parsing, shape_element, timestamp parsing, street
+cleanup or JSON encoding takes the time.  An Instrument keeps cumulative
+seconds and calls per named stage and plain counters, prints a progress
+line every ``interval`` seconds (elements/sec, MB read, ETA, RSS) and ends
+with a summary dict that ``finish`` can write as JSON.  With ``trace=True`` it
+also runs tracemalloc and reports the traced memory and the top allocation
+sites.
+
+Stages are timed by wrapping, not by calls sprinkled in the loops:
+
+  shape_element = instrument.timed('shape_element', shape_element)
+  for elem in instrument.elements(osm_file):
+      ...
+
+A disabled Instrument hands the function back unwrapped and ``elements``
+is plain get_element, so leaving the wrapping in place costs nothing.
+Stage times are inclusive: shape_element's time contains the time of the
+timestamp parsing and street cleanup it calls.
+
+Visitors run by osm_parallel time themselves in the worker processes.  An
+Instrument pickles as a reference to the same object in a forked worker,
+so the functions wrapped before the pool forked and run_chunk use one
+Instrument there, and each chunk's stats are merged back in the parent.
+Their seconds add up over the workers, so shares of the elapsed time may
+exceed 100%.
+"""
+import functools
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+import weakref
+
+from osm_output import compression_of, is_pbf
+from osm_stream import get_element
+
+INTERVAL = 10.0
+# elements between two looks at the clock
+CHECK_EVERY = 1024
+TRACE_TOP = 10
+
+_instances = weakref.WeakValueDictionary()
+_ids = itertools.count()
+
+
+def rss():
+    """Current resident set size in bytes (peak RSS if unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                        seconds % 60)
+
+
+class CountingFile(object):
+    """Binary file that counts the bytes read from it."""
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def _lookup(id, enabled, interval, trace):
+    instrument = _instances.get(id)
+    if instrument is None:
+        instrument = Instrument(enabled, interval, None, trace)
+    return instrument
+
+
+class Instrument(object):
+    """Stage timers, counters and progress; a no-op when not enabled."""
+
+    def __init__(self, enabled=True, interval=INTERVAL, stream=sys.stderr,
+                 trace=False):
+        self.enabled = enabled
+        self.interval = interval
+        self.stream = stream
+        self.trace = trace and enabled
+        self.id = next(_ids)
+        _instances[self.id] = self
+        self.reset()
+        if self.trace:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def __reduce__(self):
+        return _lookup, (self.id, self.enabled, self.interval, self.trace)
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.elements_seen = 0
+        self.position = 0
+        self.total = None
+        self.started = time.time()
+        self._next_report = self.started + self.interval
+
+    def worker(self):
+        """Start a chunk in a worker: fresh stats, no progress lines."""
+        self.reset()
+        self.stream = None
+
+    # stages and counters
+
+    def add(self, name, seconds, calls=1):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [seconds, calls]
+        else:
+            stage[0] += seconds
+            stage[1] += calls
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name, function):
+        """function, timing every call as stage name if enabled."""
+        if not self.enabled:
+            return function
+        clock = time.time
+        add = self.add
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(name, clock() - start)
+        return timed
+
+    # progress
+
+    def elements(self, osm_file, tags=('node', 'way', 'relation'),
+                 on_root=None, stage='parse'):
+        """get_element(osm_file, tags, on_root), timed and reported."""
+        if not self.enabled:
+            return get_element(osm_file, tags, on_root)
+        return self._elements(osm_file, tags, on_root, stage)
+
+    def _elements(self, osm_file, tags, on_root, stage):
+        source = osm_file
+        if isinstance(osm_file, str) and compression_of(osm_file) is None \
+                and not is_pbf(osm_file):
+            source = CountingFile(osm_file)
+            self.total = os.path.getsize(osm_file)
+        clock = time.time
+        add = self.add
+        try:
+            elements = get_element(source, tags, on_root)
+            while True:
+                start = clock()
+                try:
+                    elem = next(elements)
+                except StopIteration:
+                    break
+                finally:
+                    add(stage, clock() - start)
+                self.elements_seen += 1
+                if self.elements_seen % CHECK_EVERY == 0:
+                    if source is not osm_file:
+                        self.position = source.position
+                    self.report()
+                yield elem
+            if source is not osm_file:
+                self.position = source.position
+        finally:
+            if source is not osm_file:
+                source.close()
+
+    def advance(self, elements=0, position=None, total=None):
+        """Progress made elsewhere, e.g. a merged parallel chunk."""
+        if not self.enabled:
+            return
+        self.elements_seen += elements
+        if position is not None:
+            self.position = position
+        if total is not None:
+            self.total = total
+        self.report()
+
+    def report(self, force=False):
+        now = time.time()
+        if self.stream is None or not force and now < self._next_report:
+            return
+        self._next_report = now + self.interval
+        elapsed = max(now - self.started, 1e-9)
+        parts = ['{0:,} elements'.format(self.elements_seen),
+                 '{0:,.0f}/s'.format(self.elements_seen / elapsed)]
+        if self.position:
+            mb = '{0:,.1f}'.format(self.position / 2.0 ** 20)
+            if self.total:
+                done = float(self.position) / self.total
+                mb += '/{0:,.1f} MB {1:.1%}'.format(self.total / 2.0 ** 20,
+                                                    done)
+                if done > 0:
+                    mb += ' ETA ' + _duration(elapsed * (1 - done) / done)
+            else:
+                mb += ' MB'
+            parts.append(mb)
+        parts.append('RSS {0:,.1f} MB'.format(rss() / 2.0 ** 20))
+        if self.trace:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            parts.append('traced {0:,.1f} MB'.format(current / 2.0 ** 20))
+        self.stream.write('[{0}] {1}\n'.format(_duration(elapsed),
+                                               ', '.join(parts)))
+        self.stream.flush()
+
+    # results
+
+    def stats(self):
+        """Mergeable state: stages, counters and elements."""
+        return {'stages': self.stages, 'counters': self.counters,
+                'elements': self.elements_seen}
+
+    def merge(self, stats):
+        for name, (seconds, calls) in stats['stages'].items():
+            self.add(name, seconds, calls)
+        for name, n in stats['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.elements_seen += stats['elements']
+
+    def summary(self):
+        """Everything measured so far, as a JSON-ready dict."""
+        elapsed = time.time() - self.started
+        summary = {
+            'elapsed': elapsed,
+            'elements': self.elements_seen,
+            'elements_per_sec': self.elements_seen / elapsed if elapsed
+            else 0.0,
+            'bytes': self.position,
+            'rss': rss(),
+            'counters': dict(self.counters),
+            'stages': dict((name, {'seconds': seconds, 'calls': calls,
+                                   'share': seconds / elapsed if elapsed
+                                   else 0.0})
+                           for name, (seconds, calls) in self.stages.items())}
+        if self.trace:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:TRACE_TOP]
+            summary['tracemalloc'] = {
+                'current': current, 'peak': peak,
+                'top': [{'where': str(stat.traceback), 'size': stat.size,
+                         'count': stat.count} for stat in top]}
+        return summary
+
+    def finish(self, path=None):
+        """Print the last progress line, save the summary if path."""
+        if not self.enabled:
+            return None
+        self.report(force=True)
+        summary = self.summary()
+        if self.stream is not None:
+            for name, stage in sorted(summary['stages'].items(),
+                                      key=lambda item: -item[1]['seconds']):
+                self.stream.write('{0:24s} {1:9.2f} s {2:6.1%} {3:12,} '
+                                  'calls\n'.format(name, stage['seconds'],
+                                                   stage['share'],
+                                                   stage['calls']))
+        if path is not None:
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as fo:
+                json.dump(summary, fo, indent=1, sort_keys=True)
+            os.rename(tmp, path)
+        return summary
+
+
+DISABLED = Instrument(enabled=False)
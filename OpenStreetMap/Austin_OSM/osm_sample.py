@@ -0,0 +1,213 @@
+"""Extract a sample .osm by copying the raw bytes of chosen elements.
+
+Nothing is parsed into a tree or re-serialized: the byte span of every top
+level element comes from osm_index.iter_spans, a sampling strategy decides
+which spans to keep, and those spans are copied to the sample in file order.
+
+After sampling, every node referenced by a kept way is pulled in as well, so
+the sample never has a way pointing at a missing node.  Relations are copied
+as they are and may still name members outside the sample.
+"""
+import mmap
+import os
+import random
+import re
+import shutil
+import tempfile
+
+from osm_index import iter_spans
+from osm_parallel import body_range
+
+LAT = re.compile(br'\slat="(-?[\d.]+)"')
+LON = re.compile(br'\slon="(-?[\d.]+)"')
+ND_REF = re.compile(br'<nd\s[^>]*?ref="(-?\d+)"')
+MEMBER = re.compile(br'<member\s[^>]*>')
+MEMBER_TYPE = re.compile(br'\stype="(\w+)"')
+MEMBER_REF = re.compile(br'\sref="(-?\d+)"')
+
+
+class EveryKth(object):
+    """Keep every kth top level element, like the original sampling cell."""
+
+    def __init__(self, k):
+        self.k = k
+        self.spans = []
+        self.seen = 0
+
+    def offer(self, kind, id, offset, data):
+        if self.seen % self.k == 0:
+            self.spans.append((kind, offset, len(data)))
+        self.seen += 1
+
+    def chosen(self):
+        return self.spans
+
+
+class Reservoir(object):
+    """Keep a uniform random sample of size elements (Algorithm R)."""
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.random = random.Random(seed)
+        self.spans = []
+        self.seen = 0
+
+    def offer(self, kind, id, offset, data):
+        if len(self.spans) < self.size:
+            self.spans.append((kind, offset, len(data)))
+        else:
+            i = self.random.randint(0, self.seen)
+            if i < self.size:
+                self.spans[i] = (kind, offset, len(data))
+        self.seen += 1
+
+    def chosen(self):
+        return self.spans
+
+
+class BoundingBox(object):
+    """Keep the nodes inside a box and the ways and relations using them."""
+
+    def __init__(self, min_lat, min_lon, max_lat, max_lon):
+        self.box = (min_lat, min_lon, max_lat, max_lon)
+        self.spans = []
+        self.nodes = set()
+        self.ways = set()
+
+    def offer(self, kind, id, offset, data):
+        if kind == 'node':
+            head = data[:data.find(b'>') + 1]
+            lat, lon = LAT.search(head), LON.search(head)
+            if lat is None or lon is None:
+                return
+            min_lat, min_lon, max_lat, max_lon = self.box
+            if min_lat <= float(lat.group(1)) <= max_lat and \
+                    min_lon <= float(lon.group(1)) <= max_lon:
+                self.nodes.add(id)
+                self.spans.append((kind, offset, len(data)))
+        elif kind == 'way':
+            if any(int(ref) in self.nodes for ref in ND_REF.findall(data)):
+                self.ways.add(id)
+                self.spans.append((kind, offset, len(data)))
+        else:
+            for member in MEMBER.findall(data):
+                member_type = MEMBER_TYPE.search(member)
+                ref = MEMBER_REF.search(member)
+                if member_type is None or ref is None:
+                    continue
+                members = {b'node': self.nodes,
+                           b'way': self.ways}.get(member_type.group(1))
+                if members is not None and int(ref.group(1)) in members:
+                    self.spans.append((kind, offset, len(data)))
+                    break
+
+    def chosen(self):
+        return self.spans
+
+
+def sample(osm_file, sample_file, strategy):
+    """Write the elements strategy picks from osm_file to sample_file.
+
+    Returns the number of elements written.
+    """
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            root_tag = body_range(data)[0]
+            for kind, id, offset, length in iter_spans(osm_file):
+                strategy.offer(kind, id, offset, data[offset:offset + length])
+
+            spans = dict((offset, length)
+                         for _, offset, length in strategy.chosen())
+
+            # way -> node integrity: pull in every node a kept way uses
+            needed = set()
+            for kind, offset, length in strategy.chosen():
+                if kind == 'way':
+                    needed.update(int(ref) for ref in
+                                  ND_REF.findall(data[offset:offset + length]))
+            if needed:
+                for kind, id, offset, length in iter_spans(osm_file):
+                    if kind == 'node' and id in needed:
+                        spans[offset] = length
+
+            with open(sample_file, 'wb') as output:
+                output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+                output.write(root_tag + b'\n')
+                for offset in sorted(spans):
+                    output.write(b'  ')
+                    output.write(data[offset:offset + spans[offset]])
+                    output.write(b'\n')
+                output.write(b'</osm>\n')
+        finally:
+            data.close()
+    return len(spans)
+
+
+def _elements(osm_file):
+    """[(kind, id)] of osm_file in order, and {node id: (lat, lon)}."""
+    from osm_stream import get_element
+
+    elements, nodes, refs = [], {}, {}
+    for elem in get_element(osm_file):
+        key = elem.tag, int(elem.get('id'))
+        elements.append(key)
+        if elem.tag == 'node':
+            nodes[key[1]] = float(elem.get('lat')), float(elem.get('lon'))
+        elif elem.tag == 'way':
+            refs[key[1]] = [int(nd.get('ref')) for nd in elem.iter('nd')]
+    return elements, nodes, refs
+
+
+def test(size=4 * 2 ** 20):
+    """Samples are well formed, in file order and keep way -> node refs."""
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        everything, positions, refs = _elements(osm_file)
+        order = dict((key, i) for i, key in enumerate(everything))
+        lats = sorted(lat for lat, _ in positions.values())
+        lons = sorted(lon for _, lon in positions.values())
+        box = (lats[len(lats) // 4], lons[len(lons) // 4],
+               lats[len(lats) // 2], lons[len(lons) // 2])
+        strategies = [('every 10th', lambda: EveryKth(10)),
+                      ('reservoir', lambda: Reservoir(500, seed=1)),
+                      ('bounding box', lambda: BoundingBox(*box))]
+        for name, strategy in strategies:
+            sample_file = os.path.join(tmp, 'sample.osm')
+            written = sample(osm_file, sample_file, strategy())
+            elements, nodes, _ = _elements(sample_file)
+            assert len(elements) == written
+            assert [order[key] for key in elements] == \
+                sorted(order[key] for key in elements)
+            kept = set(elements)
+            ways = [id for kind, id in elements if kind == 'way']
+            assert ways and all(ref in nodes for way in ways
+                                for ref in refs[way])
+            if name == 'every 10th':
+                assert kept >= set(everything[::10])
+            elif name == 'reservoir':
+                with open(sample_file, 'rb') as f:
+                    first = f.read()
+                sample(osm_file, sample_file, strategy())
+                with open(sample_file, 'rb') as f:
+                    assert f.read() == first
+            else:
+                inside = set(id for id, (lat, lon) in positions.items()
+                             if box[0] <= lat <= box[2] and
+                             box[1] <= lon <= box[3])
+                assert inside and inside <= set(nodes)
+                assert all(id in inside or any(id in refs[way]
+                                               for way in ways)
+                           for id in nodes)
+            print('{0}: {1:,} of {2:,} elements'.format(name, written,
+                                                         len(everything)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
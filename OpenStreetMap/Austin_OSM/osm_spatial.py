@@ -0,0 +1,251 @@
+"""In-process spatial index over node positions and way bounding boxes.
+
+Answering "what is in this area" used to need the JSON loaded into MongoDB.
+SpatialIndex is a uniform grid: every item (a node's ``pos`` or a way's
+bounding box from osm_geometry) is filed under each grid cell it touches,
+and the cells are stored CSR style in sorted arrays:
+
+  cells      sorted int64 keys (row * ncols + col) of the non-empty cells
+  starts     entries[starts[i]:starts[i + 1]] are the items of cells[i]
+  entries    int64 item numbers
+  kind, id, min_lat, min_lon, max_lat, max_lon    one row per item
+
+Queries look up the cells overlapping the query box and check the
+candidates exactly.  ``save`` writes the arrays as .npy files and ``load``
+memory-maps them back, so reopening an index costs milliseconds.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from osm_geometry import EARTH_RADIUS_M, haversine
+
+NODE, WAY = 0, 1
+ARRAYS = ('cells', 'starts', 'entries', 'kind', 'id',
+          'min_lat', 'min_lon', 'max_lat', 'max_lon')
+
+
+class SpatialIndex(object):
+    """Uniform grid index supporting box, radius and k-nearest queries."""
+
+    def __init__(self, arrays, meta):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.meta = meta
+        self.cell_size = meta['cell_size']
+        self.lat0 = meta['lat0']
+        self.lon0 = meta['lon0']
+        self.nrows = meta['nrows']
+        self.ncols = meta['ncols']
+
+    def __len__(self):
+        return len(self.id)
+
+    @classmethod
+    def build(cls, kind, id, min_lat, min_lon, max_lat, max_lon,
+              cell_size=0.01):
+        """Index items given as parallel arrays; NaN boxes are skipped."""
+        columns = [np.asarray(a, dtype=np.float64)
+                   for a in (min_lat, min_lon, max_lat, max_lon)]
+        keep = ~np.any([np.isnan(a) for a in columns], axis=0)
+        kind = np.asarray(kind, dtype=np.int8)[keep]
+        id = np.asarray(id, dtype=np.int64)[keep]
+        min_lat, min_lon, max_lat, max_lon = [a[keep] for a in columns]
+
+        lat0 = float(min_lat.min()) if len(id) else 0.0
+        lon0 = float(min_lon.min()) if len(id) else 0.0
+        nrows = int((max_lat.max() - lat0) // cell_size) + 1 if len(id) else 1
+        ncols = int((max_lon.max() - lon0) // cell_size) + 1 if len(id) else 1
+        meta = {'cell_size': cell_size, 'lat0': lat0, 'lon0': lon0,
+                'nrows': nrows, 'ncols': ncols}
+        index = cls(dict((name, np.zeros(0)) for name in ARRAYS), meta)
+
+        r0, c0 = index._cell(min_lat, min_lon)
+        r1, c1 = index._cell(max_lat, max_lon)
+        width = c1 - c0 + 1
+        counts = (r1 - r0 + 1) * width
+        item = np.repeat(np.arange(len(id)), counts)
+        within = np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        rows = r0[item] + within // width[item]
+        cols = c0[item] + within % width[item]
+        keys = rows * ncols + cols
+
+        order = np.argsort(keys, kind='mergesort')
+        keys, entries = keys[order], item[order]
+        cells, first = np.unique(keys, return_index=True)
+        starts = np.append(first, len(keys)).astype(np.int64)
+        arrays = {'cells': cells.astype(np.int64), 'starts': starts,
+                  'entries': entries.astype(np.int64), 'kind': kind,
+                  'id': id, 'min_lat': min_lat, 'min_lon': min_lon,
+                  'max_lat': max_lat, 'max_lon': max_lon}
+        return cls(arrays, meta)
+
+    def _cell(self, lat, lon):
+        row = np.floor((np.asarray(lat) - self.lat0) / self.cell_size)
+        col = np.floor((np.asarray(lon) - self.lon0) / self.cell_size)
+        return (np.clip(row, 0, self.nrows - 1).astype(np.int64),
+                np.clip(col, 0, self.ncols - 1).astype(np.int64))
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        r0, c0 = self._cell(min_lat, min_lon)
+        r1, c1 = self._cell(max_lat, max_lon)
+        found = []
+        for row in range(int(r0), int(r1) + 1):
+            lo = np.searchsorted(self.cells, row * self.ncols + c0)
+            hi = np.searchsorted(self.cells, row * self.ncols + c1,
+                                 side='right')
+            if hi > lo:
+                found.append(self.entries[self.starts[lo]:self.starts[hi]])
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def _result(self, items):
+        return self.kind[items], self.id[items]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """(kinds, ids) of the items intersecting the box."""
+        items = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        hit = (self.min_lat[items] <= max_lat) & \
+            (self.max_lat[items] >= min_lat) & \
+            (self.min_lon[items] <= max_lon) & \
+            (self.max_lon[items] >= min_lon)
+        return self._result(items[hit])
+
+    def _distances(self, items, lat, lon):
+        # nearest point of each item's box to (lat, lon)
+        near_lat = np.clip(lat, self.min_lat[items], self.max_lat[items])
+        near_lon = np.clip(lon, self.min_lon[items], self.max_lon[items])
+        return haversine(lat, lon, near_lat, near_lon)
+
+    def _window(self, lat, lon, meters):
+        dlat = np.degrees(meters / EARTH_RADIUS_M)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+    def radius(self, lat, lon, meters):
+        """(kinds, ids, distances) of the items within meters of a point."""
+        items = self._candidates(*self._window(lat, lon, meters))
+        distance = self._distances(items, lat, lon)
+        hit = distance <= meters
+        order = np.argsort(distance[hit], kind='mergesort')
+        kinds, ids = self._result(items[hit][order])
+        return kinds, ids, distance[hit][order]
+
+    def nearest(self, lat, lon, k=1):
+        """(kinds, ids, distances) of the k items nearest to a point.
+
+        Searches a circle that doubles until it holds k items or covers
+        the whole grid: anything outside the circle is farther away.
+        """
+        k = min(k, len(self.id))
+        lat1 = self.lat0 + self.nrows * self.cell_size
+        lon1 = self.lon0 + self.ncols * self.cell_size
+        meters = self.cell_size * np.pi / 180 * EARTH_RADIUS_M
+        while True:
+            kinds, ids, distance = self.radius(lat, lon, meters)
+            min_lat, min_lon, max_lat, max_lon = self._window(lat, lon, meters)
+            covers_all = min_lat <= self.lat0 and min_lon <= self.lon0 and \
+                max_lat >= lat1 and max_lon >= lon1
+            if len(ids) >= k or covers_all:
+                return kinds[:k], ids[:k], distance[:k]
+            meters *= 2
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+        with open(os.path.join(directory, 'grid.json'), 'w') as fo:
+            json.dump(self.meta, fo)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'grid.json')) as f:
+            meta = json.load(f)
+        arrays = dict((name, np.load(os.path.join(directory, name + '.npy'),
+                                     mmap_mode=mmap_mode))
+                      for name in ARRAYS)
+        return cls(arrays, meta)
+
+
+def build_spatial_index(nodes, way_ids=None, geometry=None, cell_size=0.01):
+    """Index the nodes of a NodeStore and, optionally, way bounding boxes."""
+    lat, lon, _ = nodes.lookup_many(nodes.ids)
+    kind = [np.full(len(nodes.ids), NODE, dtype=np.int8)]
+    ids = [np.asarray(nodes.ids)]
+    boxes = [[lat], [lon], [lat], [lon]]
+    if way_ids is not None:
+        kind.append(np.full(len(way_ids), WAY, dtype=np.int8))
+        ids.append(np.asarray(way_ids))
+        for column, name in zip(boxes, ('min_lat', 'min_lon',
+                                        'max_lat', 'max_lon')):
+            column.append(geometry[name])
+    return SpatialIndex.build(np.concatenate(kind), np.concatenate(ids),
+                              *[np.concatenate(c) for c in boxes],
+                              cell_size=cell_size)
+
+
+def test(nodes=5000, ways=1000, queries=200, seed=0):
+    """bbox, radius and nearest agree with a scan over every item."""
+    from osm_nodes import NodeStore
+
+    rng = np.random.RandomState(seed)
+    store = NodeStore(np.arange(nodes, dtype=np.int64) * 3,
+                      rng.uniform(30.1, 30.5, nodes),
+                      rng.uniform(-97.9, -97.5, nodes))
+    min_lat = rng.uniform(30.1, 30.5, ways)
+    min_lon = rng.uniform(-97.9, -97.5, ways)
+    geometry = {'min_lat': min_lat, 'min_lon': min_lon,
+                'max_lat': min_lat + rng.uniform(0, 0.05, ways),
+                'max_lon': min_lon + rng.uniform(0, 0.05, ways)}
+    geometry['min_lat'][::50] = np.nan  # ways without a resolved node
+    index = build_spatial_index(store, np.arange(ways), geometry)
+    assert len(index) == nodes + ways - len(geometry['min_lat'][::50])
+
+    def items(kinds, ids):
+        return sorted(zip(kinds.tolist(), ids.tolist()))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        index.save(tmp)
+        for index in (index, SpatialIndex.load(tmp)):
+            everything = np.arange(len(index))
+            for _ in range(queries):
+                # some queries reach past the grid on every side
+                lat, lon = rng.uniform(30.0, 30.6), rng.uniform(-98.0, -97.4)
+                size = rng.uniform(0, 0.05)
+                hit = (index.min_lat <= lat + size) & \
+                    (index.max_lat >= lat) & \
+                    (index.min_lon <= lon + size) & (index.max_lon >= lon)
+                assert items(*index.bbox(lat, lon, lat + size, lon + size)) \
+                    == items(index.kind[hit], index.id[hit])
+
+                distance = index._distances(everything, lat, lon)
+                meters = rng.uniform(0, 3000)
+                kinds, ids, found = index.radius(lat, lon, meters)
+                hit = distance <= meters
+                assert items(kinds, ids) == \
+                    items(index.kind[hit], index.id[hit])
+                assert np.all(np.diff(found) >= 0)
+
+                k = rng.randint(1, 20)
+                _, _, found = index.nearest(lat, lon, k)
+                assert np.allclose(found, np.sort(distance)[:k])
+            _, _, found = index.nearest(45.0, -80.0, 3)
+            assert len(found) == 3
+        assert len(index.nearest(30.3, -97.7, len(index) + 5)[1]) == \
+            len(index)
+    finally:
+        shutil.rmtree(tmp)
+    print('{0:,} items, {1} queries of each kind agree with a scan'.format(
+        len(index), queries))
+
+
+if __name__ == '__main__':
+    test()
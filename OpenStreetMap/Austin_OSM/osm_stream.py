@@ -0,0 +1,120 @@
+"""Bounded-memory streaming reader shared by every pass over an OSM file.
+
+``ET.iterparse`` on its own keeps every parsed element attached to the root,
+so a pass over the 1.4 GB extract holds the whole tree in memory by the end.
+``get_element`` clears the root after each top level element has been handed
+out, which drops the element together with everything parsed before it.
+
+Memory ceiling: at any time only the root and the element currently being
+yielded (with its <tag>/<nd>/<member> children) are alive, so peak memory is
+bounded by the largest single node/way/relation plus the parser's read
+buffer.  It does not grow with the size of the file; ``test`` below checks
+that peak RSS stays within RSS_CEILING of the smallest run.
+
+Reference: http://stackoverflow.com/questions/3095434/inserting-newlines-in-
+xml-file-generated-via-xml-etree-elementtree-in-python
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+
+from osm_decompress import open_osm
+from osm_output import compression_of, is_pbf
+
+TOP_LEVEL = ('node', 'way', 'relation')
+
+# Allowed growth of peak RSS between the smallest and the largest file
+# read by test().
+RSS_CEILING = 32 * 1024 * 1024
+
+
+def get_element(osm_file, tags=TOP_LEVEL, on_root=None, truncated=False):
+    """Yield every top level element whose tag is in tags (all if None).
+
+    on_root is called with the <osm> root element before anything else is
+    yielded.  Each element is only valid until the next one is requested:
+    it is cleared from the tree as soon as the caller moves on.
+
+    A path ending in .bz2, .gz or .zst is decompressed on the fly (see
+    osm_decompress), one ending in .pbf is decoded by osm_pbf; osm_file may
+    also be an open binary file.
+
+    With truncated, a file cut off in the middle of an element (sample.osm
+    is) ends at the last complete element instead of raising ParseError;
+    any parse error ends it there, so only use it on such samples.
+    """
+    if isinstance(osm_file, str) and is_pbf(osm_file):
+        from osm_pbf import iter_elements
+        for elem in iter_elements(osm_file, tags, on_root):
+            yield elem
+        return
+    source = osm_file
+    if isinstance(osm_file, str) and compression_of(osm_file) is not None:
+        source = open_osm(osm_file)
+    try:
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+        _, root = next(context)
+        if on_root is not None:
+            on_root(root)
+
+        depth = 1
+        try:
+            for event, elem in context:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    if tags is None or elem.tag in tags:
+                        yield elem
+                    root.clear()
+        except ET.ParseError:
+            if not truncated:
+                raise
+    finally:
+        if source is not osm_file:
+            source.close()
+
+
+def peak_rss(osm_file):
+    """Read osm_file with get_element and return the peak RSS in bytes."""
+    count = 0
+    for elem in get_element(osm_file):
+        count += len(elem)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def test(size_gb=2.0):
+    """Peak RSS must stay flat between a small and a multi-GB file."""
+    from osm_synthetic import write_osm
+
+    sizes = [int(size_gb * 2 ** 30) // 64, int(size_gb * 2 ** 30)]
+    tmp = tempfile.mkdtemp()
+    peaks = []
+    try:
+        for size in sizes:
+            path = os.path.join(tmp, 'synthetic.osm')
+            write_osm(path, size)
+            # Fresh interpreter per size: ru_maxrss never goes down.
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--peak-rss', path])
+            peaks.append(int(out))
+            os.remove(path)
+            print('{0:.2f} GB: peak RSS {1:.1f} MB'.format(
+                size / 2.0 ** 30, peaks[-1] / 2.0 ** 20))
+    finally:
+        os.rmdir(tmp)
+    assert peaks[-1] - peaks[0] < RSS_CEILING, peaks
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--peak-rss':
+        print(peak_rss(sys.argv[2]))
+    else:
+        test(*[float(a) for a in sys.argv[1:]])
@@ -0,0 +1,117 @@
+"""Compiled, memoizing street name normalization.
+
+``update(name, mapping)`` used to split every name, look each word up in the
+mapping and re-join the words after every replacement, so keys made of
+several words such as 'IH 35' could never match.  StreetNormalizer compiles
+the whole mapping into one alternation pattern (longest keys first, words of
+a key separated by any whitespace) and rewrites a name in a single
+``re.sub``.  Austin repeats the same few thousand street names millions of
+times, so results are cached as well.
+
+With ``anchored=True`` only the street type is expanded: a key matches at
+the end of the name and nowhere else, as the lesson's ``update_name`` did
+with ``\S+\.?$``.  'St. Johns Ave' becomes 'St. Johns Avenue', not
+'Street Johns Avenue'.
+"""
+import re
+
+from osm_cache import BoundedCache
+
+# Don't expand the unit after these, e.g. 'Suite E' is not 'Suite East'.
+SKIP_AFTER = ('suite', 'ste.', 'ste')
+
+
+class StreetNormalizer(object):
+    """Expand the abbreviations of mapping in street names.
+
+    anchored expands the last words of a name only (the street type).
+    """
+
+    def __init__(self, mapping, maxsize=100000, anchored=False):
+        self.source = mapping
+        self.anchored = anchored
+        self.size = len(mapping)
+        self.mapping = dict(mapping)
+        self.lookup = dict((' '.join(key.split()), value)
+                           for key, value in mapping.items())
+        keys = sorted(self.lookup, key=len, reverse=True)
+        alternation = '|'.join(r'\s+'.join(re.escape(word)
+                                           for word in key.split())
+                               for key in keys)
+        end = r'(?=\s*$)' if anchored else r'(?!\S)'
+        self.pattern = re.compile(r'(?<!\S)(?:{0}){1}'.format(alternation,
+                                                             end))
+        self.cache = BoundedCache(self._normalize, maxsize)
+
+    def _replace(self, m):
+        before = m.string[:m.start()].split()
+        if before and before[-1].lower() in SKIP_AFTER:
+            return m.group()
+        return self.lookup[' '.join(m.group().split())]
+
+    def _normalize(self, name):
+        if not self.lookup:
+            return name
+        better_name, replaced = self.pattern.subn(self._replace, name)
+        if replaced and better_name != name:
+            better_name = ' '.join(better_name.split())
+        return better_name
+
+    def __call__(self, name):
+        return self.cache(name)
+
+    def normalize_many(self, names):
+        """Normalize a list of names in one call, in order."""
+        cache = self.cache
+        return [cache(name) for name in names]
+
+
+_normalizers = {}
+
+
+def normalizer(mapping, anchored=False):
+    """StreetNormalizer for mapping, compiled once per mapping and mode.
+
+    This runs for every name, so a mapping is recognized by identity and
+    recompiled when keys are added or removed.  Hold on to the
+    StreetNormalizer instead after changing a value in place.
+    """
+    key = id(mapping), anchored
+    cached = _normalizers.get(key)
+    if cached is None or cached.source is not mapping or \
+            cached.size != len(mapping):
+        cached = _normalizers[key] = StreetNormalizer(mapping,
+                                                      anchored=anchored)
+    return cached
+
+
+def test():
+    """Every word, or the street type only; skipped units; the cache."""
+    mapping = {'St': 'Street', 'St.': 'Street', 'Ave': 'Avenue',
+               'Rd.': 'Road', 'N': 'North', 'E': 'East',
+               'IH 35': 'Interstate Highway 35'}
+    cases = [
+        # name, every word, street type only
+        ('St. Johns Ave', 'Street Johns Avenue', 'St. Johns Avenue'),
+        ('St Elmo Rd.', 'Street Elmo Road', 'St Elmo Road'),
+        ('Main St Suite 5', 'Main Street Suite 5', 'Main St Suite 5'),
+        ('N Lamar Suite E', 'North Lamar Suite E', 'N Lamar Suite E'),
+        ('N  IH 35', 'North Interstate Highway 35',
+         'N Interstate Highway 35'),
+        ('Stassney Ln', 'Stassney Ln', 'Stassney Ln'),
+    ]
+    every, anchored = normalizer(mapping), normalizer(mapping, anchored=True)
+    assert every is not anchored and normalizer(mapping) is every
+    for name, expanded, street_type in cases:
+        assert every(name) == expanded, (name, every(name))
+        assert anchored(name) == street_type, (name, anchored(name))
+    names = [name for name, _, _ in cases] * 2
+    assert anchored.normalize_many(names) == [anchored(n) for n in names]
+    mapping['Ln'] = 'Lane'
+    assert normalizer(mapping, anchored=True)('Stassney Ln') == \
+        'Stassney Lane'
+    print('{0} names, both modes'.format(len(cases)))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,244 @@
+"""Report answers kept up to date during ingestion.
+
+Every query in the report is a scan of the whole collection, but all of
+them are counts grouped by one field.  Summary keeps those counts as the
+documents go by:
+
+  type         node / way
+  user         created.user (distinct users, top contributors)
+  postcode     address.postcode, street address.street, city address.city
+  amenity      amenity
+  religion     religion of places of worship
+  restaurant   name of restaurants, cuisine of restaurants
+
+The counters are exact, so a document can be taken out again (``remove``)
+and two summaries can be merged, which is how partial runs and change
+files are folded in.  Top-k lists are cut from the counters when asked for,
+rather than kept in heaps that could not handle removals.  ``save`` writes
+a small JSON file that ``load`` reads back in milliseconds.
+"""
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+
+from osm_engine import DocumentVisitor
+
+COUNTERS = ('type', 'user', 'postcode', 'street', 'city', 'amenity',
+            'religion', 'restaurant', 'cuisine')
+VERSION = 1
+
+
+def _fields(doc):
+    """(counter, value) pairs a shaped document contributes."""
+    address = doc.get('address', {})
+    amenity = doc.get('amenity')
+    yield 'type', doc.get('type')
+    yield 'user', doc.get('created', {}).get('user')
+    if 'postcode' in address:
+        yield 'postcode', address['postcode']
+    if 'street' in address:
+        yield 'street', address['street']
+    yield 'city', address.get('city')
+    yield 'amenity', amenity
+    if amenity == 'place_of_worship':
+        yield 'religion', doc.get('religion')
+    if amenity == 'restaurant':
+        yield 'restaurant', doc.get('name')
+        yield 'cuisine', doc.get('cuisine')
+
+
+class Summary(object):
+    """Exact per-field counters over a set of shaped documents."""
+
+    def __init__(self):
+        self.documents = 0
+        self.counters = dict((name, {}) for name in COUNTERS)
+
+    def add(self, doc, sign=1):
+        self.documents += sign
+        for name, value in _fields(doc):
+            counter = self.counters[name]
+            count = counter.get(value, 0) + sign
+            if count:
+                counter[value] = count
+            else:
+                del counter[value]
+
+    def remove(self, doc):
+        self.add(doc, -1)
+
+    def merge(self, other):
+        """Fold in another summary, e.g. a delta built from a change file."""
+        self.documents += other.documents
+        for name, theirs in other.counters.items():
+            counter = self.counters[name]
+            for value, delta in theirs.items():
+                count = counter.get(value, 0) + delta
+                if count:
+                    counter[value] = count
+                else:
+                    counter.pop(value, None)
+
+    def count(self, type=None):
+        if type is None:
+            return self.documents
+        return self.counters['type'].get(type, 0)
+
+    def distinct(self, name):
+        return [value for value in self.counters[name] if value is not None]
+
+    def top(self, name, k=10):
+        """[{'_id': value, 'count': n}], like the report's $group/$sort."""
+        items = heapq.nlargest(k, self.counters[name].items(),
+                               key=lambda item: item[1])
+        return [{'_id': value, 'count': count} for value, count in items]
+
+    def users_once(self):
+        """The report's second pipeline: users with the fewest documents."""
+        counts = {}
+        for count in self.counters['user'].values():
+            counts[count] = counts.get(count, 0) + 1
+        if not counts:
+            return []
+        fewest = min(counts)
+        return [{'_id': fewest, 'num_users': counts[fewest]}]
+
+    def report(self):
+        """Every answer of the report, in report order."""
+        return OrderedDict([
+            ('documents', self.count()),
+            ('users', len(self.distinct('user'))),
+            ('nodes', self.count('node')),
+            ('ways', self.count('way')),
+            ('top_users', self.top('user', 5)),
+            ('users_once', self.users_once()),
+            ('postcodes', self.top('postcode')),
+            ('streets', self.top('street')),
+            ('cities', self.top('city')),
+            ('amenities', self.top('amenity')),
+            ('religions', self.top('religion', 5)),
+            ('restaurants', self.top('restaurant')),
+            ('cuisines', self.top('cuisine', 5))])
+
+    def save(self, path):
+        """Write the summary; the file is replaced atomically."""
+        data = {'version': VERSION, 'documents': self.documents,
+                'counters': dict((name, list(counter.items()))
+                                 for name, counter in self.counters.items())}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump(data, fo)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != VERSION:
+            raise ValueError('{0}: unknown summary version {1!r}'.format(
+                path, data.get('version')))
+        summary = cls()
+        summary.documents = data['documents']
+        for name, items in data['counters'].items():
+            summary.counters[name] = dict(items)
+        return summary
+
+
+class SummaryBuilder(DocumentVisitor):
+    """Shape every element into a Summary, saved to path when given."""
+
+    def __init__(self, shape_element, path=None):
+        self.shape_element = shape_element
+        self.path = path
+        self.summary = Summary()
+
+    def visit_doc(self, doc):
+        self.summary.add(doc)
+
+    def partial(self, index):
+        return SummaryBuilder(self.shape_element)
+
+    def merge(self, other):
+        self.summary.merge(other.summary)
+
+    def finish(self):
+        if self.path is not None:
+            self.summary.save(self.path)
+
+    def result(self):
+        return self.summary
+
+
+def test(size=4 * 2 ** 20):
+    """Counters match a recount; merge, remove and load keep them exact."""
+    from osm_engine import run_visitors
+    from osm_intern import _shape
+    from osm_stream import get_element
+    from osm_synthetic import write_osm
+
+    tmp = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp, 'synthetic.osm')
+        write_osm(osm_file, size)
+        docs = [doc for doc in (_shape(e) for e in get_element(osm_file))
+                if doc]
+        expected = dict((name, Counter()) for name in COUNTERS)
+        for doc in docs:
+            for name, value in _fields(doc):
+                expected[name][value] += 1
+        summaries = [run_visitors(osm_file, {
+            'summary': SummaryBuilder(_shape)},
+            processes=processes)['summary'] for processes in (1, 2)]
+        for summary in summaries:
+            assert summary.documents == len(docs)
+            assert summary.counters == dict(
+                (name, dict(counter)) for name, counter in expected.items())
+        assert expected['postcode'] and expected['amenity']
+
+        half = len(docs) // 2
+        first, second, whole = Summary(), Summary(), Summary()
+        for doc in docs[:half]:
+            first.add(doc)
+            whole.add(doc)
+        for doc in docs[half:]:
+            second.add(doc)
+            whole.add(doc)
+        merged = Summary()
+        merged.merge(first)
+        merged.merge(second)
+        assert merged.counters == whole.counters == summaries[0].counters
+
+        # taking the second half out, one by one or as a negative delta,
+        # leaves no zero counts behind
+        delta = Summary()
+        for doc in docs[half:]:
+            whole.remove(doc)
+            delta.remove(doc)
+        merged.merge(delta)
+        for summary in (whole, merged):
+            assert summary.documents == half
+            assert summary.counters == first.counters
+        merged.merge(second)
+        assert merged.counters == summaries[1].counters
+
+        path = os.path.join(tmp, 'summary.json')
+        summaries[0].save(path)
+        loaded = Summary.load(path)
+        assert (loaded.documents, loaded.counters) == \
+            (len(docs), summaries[0].counters)
+        report = summaries[0].report()
+        assert report['documents'] == len(docs)
+        assert [item['count'] for item in report['postcodes']] == \
+            [n for _, n in expected['postcode'].most_common(10)]
+        print('{0:,} documents, {1} postcodes, {2} users'.format(
+            report['documents'], len(expected['postcode']),
+            report['users']))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test()
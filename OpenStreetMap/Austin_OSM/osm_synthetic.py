@@ -0,0 +1,540 @@
+"""Synthetic .osm extracts of any size, shaped like a real one.
+
+sample.osm is 4 MB; testing at metro scale meant the 1.4 GB download.
+``learn`` reads a sample and keeps the distributions that matter to the
+passes: tag key sets and values per key, users, versions, coordinates,
+timestamps, changesets, the number of refs per way and the members of
+relations, plus the street names and postcodes of addresses.  Every
+distribution keeps at most MAX_VALUES values, so a Profile is small and
+can be saved once and reused.
+
+``write_osm`` writes valid OSM XML of about the requested number of bytes
+from a Profile: nodes first, then ways, then relations, as in an extract.
+Each way gets a run of consecutive node ids laid out as a short walk from a
+sampled position, so every <nd ref> names a node written earlier and way
+geometry stays local.  Nothing is kept per element: the run lengths are
+drawn from a generator seeded the same way in the node and the way phase,
+so memory stays constant whatever the size (tested up to 10 GB).
+
+sample.osm is cut off before its first way and has no addresses.  What a
+sample lacks comes from DEFAULTS: way and relation shapes typical of a US
+metro extract, and street names and postcodes that are formatted the way
+the Austin audit found them (abbreviated street types, ZIP+4, 'TX 78701').
+Those are what the street and postcode cleaning has to handle.
+
+It is the one generator of test files: the module tests that need an
+extract larger than sample.osm write it with ``write_osm``.
+"""
+import bisect
+import calendar
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from xml.sax.saxutils import escape
+
+from osm_output import open_output
+from osm_postcodes import AUSTIN_ZIPS
+from osm_stream import get_element
+
+MAX_VALUES = 1000
+MAX_POSITIONS = 5000
+VERSION = 1
+DISTRIBUTIONS = ('node_keysets', 'way_keysets', 'relation_keysets', 'users',
+                 'versions', 'refs', 'members', 'member_types', 'roles',
+                 'streets', 'postcodes')
+OSM_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+ATTRIBUTE_ESCAPES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                     '\t': '&#9;'}
+# degrees between consecutive nodes of a way, about 50 m
+STEP = 0.0005
+
+STREET_NAMES = ['Congress', 'Lamar', 'Guadalupe', 'Burnet', 'Riverside',
+                'Oltorf', 'Parmer', 'Anderson', 'Koenig', 'Manor',
+                'Cesar Chavez', 'Barton Springs', 'Slaughter',
+                'William Cannon', 'Braker', 'Rundberg', 'Airport',
+                'Pleasant Valley', 'Red River', 'Duval', 'Speedway',
+                'Ben White', 'Mopac', 'Wells Branch', 'Spicewood Springs',
+                'Far West', 'Bee Cave']
+# the forms the audit found: full, abbreviated, with and without a period
+STREET_TYPES = [('Street', 40), ('St', 8), ('St.', 3), ('Avenue', 15),
+                ('Ave', 4), ('Drive', 20), ('Dr', 5), ('Dr.', 1),
+                ('Lane', 10), ('Ln', 3), ('Boulevard', 8), ('Blvd', 3),
+                ('Road', 10), ('Rd', 3), ('Cove', 6), ('Cv', 2),
+                ('Parkway', 4), ('Pkwy', 2), ('Trail', 5), ('Way', 5)]
+DIRECTIONS = [('', 85), ('North ', 3), ('N ', 2), ('South ', 3), ('S ', 2),
+              ('East ', 2), ('E ', 1), ('West ', 1), ('W ', 1)]
+
+DEFAULTS = {
+    'refs': [(2, 25), (3, 10), (4, 8), (5, 20), (6, 8), (7, 5), (8, 5),
+             (10, 5), (14, 5), (20, 4), (40, 3), (100, 2)],
+    'closed': 0.4,
+    'way_keysets': [(('building',), 30), (('highway',), 15),
+                    (('highway', 'name'), 25),
+                    (('highway', 'name', 'oneway'), 5),
+                    (('building', 'name'), 3), (('landuse',), 5),
+                    (('leisure', 'name'), 3), (('amenity', 'name'), 4),
+                    (('amenity', 'parking'), 2), (('waterway',), 3),
+                    (('natural',), 2), (('railway',), 1), ((), 2)],
+    'relation_keysets': [(('type',), 20), (('restriction', 'type'), 40),
+                         (('name', 'route', 'type'), 20),
+                         (('landuse', 'type'), 10),
+                         (('boundary', 'name', 'type'), 10)],
+    'values': {
+        'building': [('yes', 70), ('house', 20), ('apartments', 5),
+                     ('commercial', 3), ('school', 2)],
+        'highway': [('residential', 40), ('service', 30), ('footway', 10),
+                    ('tertiary', 6), ('secondary', 5), ('primary', 4),
+                    ('motorway_link', 2), ('track', 3)],
+        'oneway': [('yes', 90), ('-1', 5), ('no', 5)],
+        'landuse': [('residential', 40), ('grass', 30), ('commercial', 15),
+                    ('industrial', 15)],
+        'leisure': [('park', 50), ('pitch', 30), ('playground', 20)],
+        'amenity': [('parking', 40), ('school', 15), ('restaurant', 15),
+                    ('place_of_worship', 10), ('fast_food', 10),
+                    ('cafe', 5), ('bank', 5)],
+        'parking': [('surface', 80), ('multi-storey', 20)],
+        'waterway': [('stream', 70), ('river', 10), ('ditch', 20)],
+        'natural': [('water', 60), ('wood', 40)],
+        'railway': [('rail', 80), ('abandoned', 20)],
+        'type': [('multipolygon', 50), ('restriction', 30), ('route', 15),
+                 ('boundary', 5)],
+        'restriction': [('no_left_turn', 40), ('no_u_turn', 30),
+                        ('only_right_turn', 20), ('only_straight_on', 10)],
+        'route': [('bus', 60), ('bicycle', 30), ('road', 10)],
+        'boundary': [('administrative', 80), ('postal_code', 20)],
+        'addr:city': [('Austin', 90), ('austin', 3), ('Austin, TX', 2),
+                      ('Round Rock', 3), ('Pflugerville', 2)],
+        'addr:housenumber': [(str(n), 1) for n in range(100, 12000, 37)],
+    },
+    'members': [(1, 10), (2, 20), (3, 50), (5, 10), (10, 7), (30, 3)],
+    'member_types': [('way', 75), ('node', 20), ('relation', 5)],
+    'roles': [('', 30), ('outer', 25), ('inner', 10), ('from', 10),
+              ('to', 10), ('via', 10), ('stop', 5)],
+    'relations_per_way': 0.01,
+    'addresses': 0.1,
+    'address_keys': ('addr:housenumber', 'addr:street', 'addr:postcode'),
+}
+
+
+class Distribution(object):
+    """Weighted values, drawn with one bisect over the cumulative weights."""
+
+    def __init__(self, pairs):
+        self.values = []
+        self.totals = []
+        total = 0
+        for value, weight in pairs:
+            total += weight
+            self.values.append(value)
+            self.totals.append(total)
+
+    def __len__(self):
+        return len(self.values)
+
+    def draw(self, rng):
+        return self.values[bisect.bisect_right(self.totals,
+                                               rng.random() * self.totals[-1])]
+
+    def pairs(self):
+        return list(zip(self.values, [b - a for a, b in
+                                      zip([0] + self.totals, self.totals)]))
+
+    def mean(self):
+        return sum(v * w for v, w in self.pairs()) / float(self.totals[-1])
+
+
+def _default_streets():
+    return [(direction + name + ' ' + kind, a * b)
+            for direction, a in DIRECTIONS for name in STREET_NAMES
+            for kind, b in STREET_TYPES]
+
+
+def _default_postcodes():
+    pairs = []
+    for i, code in enumerate(sorted(AUSTIN_ZIPS)):
+        pairs += [(code, 90), (code + '-{0:04d}'.format(i * 37 % 10000), 6),
+                  ('TX ' + code, 3), (code[:4], 1)]
+    return pairs
+
+
+class Profile(object):
+    """Distributions learned from a sample, with DEFAULTS for the rest."""
+
+    def __init__(self, data):
+        self.data = data
+        d = dict((name, Distribution(data[name])) for name in DISTRIBUTIONS)
+        self.node_keysets = d['node_keysets']
+        self.way_keysets = d['way_keysets']
+        self.relation_keysets = d['relation_keysets']
+        self.users = d['users']
+        self.versions = d['versions']
+        self.refs = d['refs']
+        self.members = d['members']
+        self.member_types = d['member_types']
+        self.roles = d['roles']
+        self.streets = d['streets']
+        self.postcodes = d['postcodes']
+        self.values = dict((key, Distribution(pairs))
+                           for key, pairs in data['values'].items())
+        self.positions = data['positions']
+        self.closed = data['closed']
+        self.tagged = data['tagged']
+        self.relations_per_way = data['relations_per_way']
+        self.addresses = data['addresses']
+        self.timestamps = data['timestamps']
+        self.changesets = data['changesets']
+        mean_refs = self.refs.mean()
+        # tagged nodes not on a way, per way, so the tagged share matches
+        self.pois_per_way = self.tagged * mean_refs / (1.0 - self.tagged) \
+            if self.tagged < 1 else mean_refs
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump(dict(self.data, version=VERSION), fo)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.pop('version', None) != VERSION:
+            raise ValueError('{0}: unknown profile version'.format(path))
+        for name in ('node_keysets', 'way_keysets', 'relation_keysets'):
+            data[name] = [(tuple(keys), n) for keys, n in data[name]]
+        data['users'] = [(tuple(user), n) for user, n in data['users']]
+        return cls(data)
+
+
+def learn(osm_file, max_values=MAX_VALUES, seed=0):
+    """Profile of osm_file.
+
+    A file cut off mid-element (like sample.osm) is learned up to the cut.
+    """
+    rng = random.Random(seed)
+    counts = Counter()
+    keysets = dict((kind, Counter()) for kind in ('node', 'way',
+                                                  'relation'))
+    values = {}
+    users, versions, refs = Counter(), Counter(), Counter()
+    members, member_types, roles = Counter(), Counter(), Counter()
+    positions = []
+    timestamps = set()
+    changesets = set()
+    closed = 0
+    try:
+        for elem in get_element(osm_file):
+            kind = elem.tag
+            counts[kind] += 1
+            keys = []
+            for tag in elem.iter('tag'):
+                k = tag.get('k')
+                keys.append(k)
+                values.setdefault(k, Counter())[tag.get('v')] += 1
+            keysets[kind][tuple(sorted(set(keys)))] += 1
+            if elem.get('uid') is not None:
+                users[(elem.get('uid'), elem.get('user'))] += 1
+            if elem.get('version') is not None:
+                versions[int(elem.get('version'))] += 1
+            if elem.get('timestamp') is not None:
+                timestamps.add(elem.get('timestamp'))
+            if elem.get('changeset') is not None:
+                changesets.add(int(elem.get('changeset')))
+            if kind == 'node':
+                position = (float(elem.get('lat')), float(elem.get('lon')))
+                # reservoir sample of positions
+                if len(positions) < MAX_POSITIONS:
+                    positions.append(position)
+                else:
+                    i = rng.randint(0, counts['node'] - 1)
+                    if i < MAX_POSITIONS:
+                        positions[i] = position
+            elif kind == 'way':
+                nds = [nd.get('ref') for nd in elem.iter('nd')]
+                refs[len(nds)] += 1
+                closed += len(nds) > 2 and nds[0] == nds[-1]
+            else:
+                count = 0
+                for member in elem.iter('member'):
+                    count += 1
+                    member_types[member.get('type')] += 1
+                    roles[member.get('role')] += 1
+                members[count] += 1
+    except ET.ParseError:
+        if not counts:
+            raise
+
+    def learned(counter, default):
+        return counter.most_common(max_values) if counter else list(default)
+
+    data = {
+        'node_keysets': [(k, n) for k, n in
+                         keysets['node'].most_common(max_values) if k],
+        'way_keysets': learned(keysets['way'], DEFAULTS['way_keysets']),
+        'relation_keysets': learned(keysets['relation'],
+                                    DEFAULTS['relation_keysets']),
+        'values': dict((k, v.most_common(max_values))
+                       for k, v in values.items()),
+        'users': learned(users, [(('1', 'synthetic'), 1)]),
+        'versions': learned(versions, [(1, 1)]),
+        'refs': learned(refs, DEFAULTS['refs']),
+        'members': learned(members, DEFAULTS['members']),
+        'member_types': learned(member_types, DEFAULTS['member_types']),
+        'roles': learned(roles, DEFAULTS['roles']),
+        'streets': learned(values.get('addr:street', Counter()),
+                           _default_streets()),
+        'postcodes': learned(values.get('addr:postcode', Counter()),
+                             _default_postcodes()),
+        'positions': positions or [(30.2672, -97.7431)],
+        'closed': (float(closed) / counts['way'] if counts['way']
+                   else DEFAULTS['closed']),
+        'tagged': (float(sum(keysets['node'].values()) -
+                         keysets['node'][()]) / counts['node']
+                   if counts['node'] else 0.1),
+        'relations_per_way': (float(counts['relation']) / counts['way']
+                              if counts['way'] else
+                              DEFAULTS['relations_per_way']),
+        # addresses come with the learned key sets if the sample has any
+        'addresses': (0.0 if any(k.startswith('addr:') for k in values)
+                      else DEFAULTS['addresses']),
+        'timestamps': ([calendar.timegm(time.strptime(t, OSM_FORMAT))
+                        for t in (min(timestamps), max(timestamps))]
+                       if timestamps else [1262304000, 1420070400]),
+        'changesets': ([min(changesets), max(changesets)] if changesets
+                       else [1, 30000000]),
+    }
+    for key, pairs in DEFAULTS['values'].items():
+        data['values'].setdefault(key, pairs)
+    if not data['node_keysets']:
+        data['node_keysets'] = [(('amenity', 'name'), 1)]
+    return Profile(data)
+
+
+class _Writer(object):
+    """Formats elements; counts the bytes it writes."""
+
+    def __init__(self, profile, rng, fo=None):
+        self.p = profile
+        self.rng = rng
+        self.fo = fo
+        self.size = 0
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+        if len(self.lines) >= 1000:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.lines).encode('utf-8')
+        self.size += len(data)
+        if self.fo is not None:
+            self.fo.write(data)
+        self.lines = []
+
+    def head(self, kind, id):
+        p, rng = self.p, self.rng
+        uid, user = p.users.draw(rng)
+        stamp = time.strftime(OSM_FORMAT, time.gmtime(
+            rng.randint(*p.timestamps)))
+        return ('  <{0} id="{1}" version="{2}" timestamp="{3}" '
+                'changeset="{4}" uid="{5}" user="{6}"').format(
+                    kind, id, p.versions.draw(rng), stamp,
+                    rng.randint(*p.changesets), uid,
+                    escape(user, ATTRIBUTE_ESCAPES))
+
+    def tags(self, keys, street=False):
+        p, rng = self.p, self.rng
+        if p.addresses and rng.random() < p.addresses:
+            keys = tuple(keys) + DEFAULTS['address_keys']
+        lines = []
+        for k in keys:
+            if k == 'addr:street' or street and k == 'name':
+                v = p.streets.draw(rng)
+            elif k == 'addr:postcode':
+                v = p.postcodes.draw(rng)
+            elif k in p.values:
+                v = p.values[k].draw(rng)
+            else:
+                v = 'yes'
+            lines.append('    <tag k="{0}" v="{1}"/>\n'.format(
+                escape(k, ATTRIBUTE_ESCAPES), escape(v, ATTRIBUTE_ESCAPES)))
+        return lines
+
+    def node(self, id, lat, lon, keys=()):
+        head = '{0} lat="{1:.7f}" lon="{2:.7f}"'.format(
+            self.head('node', id), lat, lon)
+        tags = self.tags(keys) if keys else []
+        if tags:
+            self.write(head + '>\n' + ''.join(tags) + '  </node>\n')
+        else:
+            self.write(head + '/>\n')
+
+    def way(self, id, refs):
+        keys = self.p.way_keysets.draw(self.rng)
+        self.write(self.head('way', id) + '>\n' +
+                   ''.join('    <nd ref="{0}"/>\n'.format(ref)
+                           for ref in refs) +
+                   ''.join(self.tags(keys, 'highway' in keys)) + '  </way>\n')
+
+    def relation(self, id, nodes, ways, relations):
+        p, rng = self.p, self.rng
+        members = []
+        for _ in range(p.members.draw(rng)):
+            kind = p.member_types.draw(rng)
+            last = {'node': nodes, 'way': ways, 'relation': relations}[kind]
+            if last < 1:
+                continue
+            members.append('    <member type="{0}" ref="{1}" role="{2}"/>\n'
+                           .format(kind, rng.randint(1, last),
+                                   escape(p.roles.draw(rng) or '',
+                                          ATTRIBUTE_ESCAPES)))
+        keys = p.relation_keysets.draw(rng)
+        self.write(self.head('relation', id) + '>\n' + ''.join(members) +
+                   ''.join(self.tags(keys)) + '  </relation>\n')
+
+
+def _layout(profile, seed):
+    """Yield (refs, closed, pois) per way; the same sequence for a seed."""
+    rng = random.Random(seed)
+    while True:
+        refs = max(profile.refs.draw(rng), 2)
+        closed = refs > 3 and rng.random() < profile.closed
+        pois = int(profile.pois_per_way) + \
+            (rng.random() < profile.pois_per_way % 1)
+        yield refs, closed, pois
+
+
+def write_osm(path, size, profile=None, seed=0):
+    """Write about size bytes of OSM XML to path (.gz/.bz2 compress).
+
+    Returns the number of nodes, ways and relations written, and the bytes
+    of XML (before compression).
+    """
+    if profile is None:
+        profile = learn(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'sample.osm'))
+    # bytes per way with its nodes and share of relations, from a trial run
+    trial = 2000
+    counts = _generate(_Writer(profile, random.Random(seed)), profile,
+                       trial, seed)
+    ways = max(1, int(size * trial / counts['bytes']))
+    with open_output(path) as fo:
+        return _generate(_Writer(profile, random.Random(seed), fo), profile,
+                         ways, seed)
+
+
+def _generate(writer, profile, ways, seed):
+    p, rng = profile, writer.rng
+    lats = [lat for lat, _ in p.positions]
+    lons = [lon for _, lon in p.positions]
+    writer.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<osm version="0.6" generator="osm_synthetic">\n'
+                 '  <bounds minlat="{0:.7f}" minlon="{1:.7f}" '
+                 'maxlat="{2:.7f}" maxlon="{3:.7f}"/>\n'.format(
+                     min(lats), min(lons), max(lats), max(lons)))
+
+    # nodes: per way a walk of its unique nodes, then its tagged POIs
+    node_id = 0
+    for refs, closed, pois in itertools.islice(_layout(p, seed), ways):
+        lat, lon = rng.choice(p.positions)
+        for _ in range(refs - 1 if closed else refs):
+            node_id += 1
+            lat += rng.uniform(-STEP, STEP)
+            lon += rng.uniform(-STEP, STEP)
+            writer.node(node_id, lat, lon)
+        for _ in range(pois):
+            node_id += 1
+            lat, lon = rng.choice(p.positions)
+            writer.node(node_id, lat + rng.uniform(-STEP, STEP),
+                        lon + rng.uniform(-STEP, STEP),
+                        p.node_keysets.draw(rng))
+    nodes = node_id
+
+    # ways: the same layout again gives every way its run of node ids
+    first = 1
+    for way_id, (refs, closed, pois) in enumerate(
+            itertools.islice(_layout(p, seed), ways), 1):
+        unique = refs - 1 if closed else refs
+        run = list(range(first, first + unique))
+        writer.way(way_id, run + run[:1] if closed else run)
+        first += unique + pois
+
+    relations = int(ways * p.relations_per_way)
+    for relation_id in range(1, relations + 1):
+        writer.relation(relation_id, nodes, ways, relation_id - 1)
+    writer.write('</osm>\n')
+    writer.flush()
+    return {'node': nodes, 'way': ways, 'relation': relations,
+            'bytes': writer.size}
+
+
+def parse_size(text):
+    """Bytes of '10G', '500M', '64K' or a plain number."""
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    text = str(text).upper().rstrip('B')
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def peak_rss(path, size):
+    """Write size bytes to path and return the peak RSS in bytes."""
+    write_osm(path, size)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def test(size=16 * 2 ** 20):
+    """Valid XML, way refs all written, size close, memory flat."""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'synthetic.osm')
+        counts = write_osm(path, size)
+        assert abs(counts['bytes'] - size) < size * 0.1, counts
+        assert os.path.getsize(path) == counts['bytes']
+        found = Counter()
+        node_ids = bytearray(counts['node'] + 1)
+        for elem in get_element(path):
+            found[elem.tag] += 1
+            if elem.tag == 'node':
+                node_ids[int(elem.get('id'))] = 1
+            elif elem.tag == 'way':
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                assert len(refs) >= 2
+                assert all(node_ids[ref] for ref in refs), elem.get('id')
+        assert dict(found) == dict((k, counts[k]) for k in found), found
+        assert all(node_ids[1:])
+        # fresh interpreters: ru_maxrss never goes down
+        peaks = [int(subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--peak-rss', path,
+             str(n)])) for n in (size // 16, size * 4)]
+        assert peaks[1] - peaks[0] < 16 * 2 ** 20, peaks
+        print('{0} {1:.1f} MB; peak RSS {2:.1f} / {3:.1f} MB'.format(
+            counts, counts['bytes'] / 2.0 ** 20, peaks[0] / 2.0 ** 20,
+            peaks[1] / 2.0 ** 20))
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--peak-rss':
+        print(peak_rss(sys.argv[2], int(sys.argv[3])))
+    elif len(sys.argv) >= 3:
+        sample = sys.argv[3] if len(sys.argv) > 3 else None
+        print(write_osm(sys.argv[1], parse_size(sys.argv[2]),
+                        learn(sample) if sample else None))
+    else:
+        test()
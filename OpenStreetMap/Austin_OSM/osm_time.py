@@ -0,0 +1,75 @@
+"""Fast parsing of OSM timestamps.
+
+Every node and way carries a timestamp in one fixed format,
+'2013-08-03T16:43:42Z', and ``strptime`` is one of the most expensive calls
+made per element.  parse_fixed reads the fields by position instead and only
+falls back to strptime for strings that are not in that format (so bad
+input raises the same ValueError).  Elements edited in one changeset share
+their timestamps, so the parsers are wrapped in a BoundedCache.
+
+timestamp_epoch gives the same instant as int seconds since the epoch,
+which is cheaper to store, serialize and sort than a datetime.
+"""
+import calendar
+from datetime import datetime
+
+from osm_cache import BoundedCache
+
+OSM_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def parse_fixed(value):
+    """datetime of an OSM timestamp, by slicing 'YYYY-MM-DDTHH:MM:SSZ'."""
+    if len(value) == 20 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == ':' and \
+            value[19] == 'Z':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]),
+                            int(value[8:10]), int(value[11:13]),
+                            int(value[14:16]), int(value[17:19]))
+        except ValueError:
+            pass
+    return datetime.strptime(value, OSM_FORMAT)
+
+
+def epoch_fixed(value):
+    """Seconds since the epoch of an OSM timestamp."""
+    return calendar.timegm(parse_fixed(value).utctimetuple())
+
+
+parse_timestamp = BoundedCache(parse_fixed, maxsize=100000)
+timestamp_epoch = BoundedCache(epoch_fixed, maxsize=100000)
+
+
+def benchmark(values, repeat=3):
+    """Timestamps per second of strptime, parse_fixed and parse_timestamp."""
+    import time
+
+    values = list(values)
+    rates = {}
+    for name, function in (('strptime',
+                            lambda v: datetime.strptime(v, OSM_FORMAT)),
+                           ('parse_fixed', parse_fixed),
+                           ('parse_timestamp', parse_timestamp)):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for value in values:
+                function(value)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[name] = len(values) / best if best else float('inf')
+    return rates
+
+
+if __name__ == '__main__':
+    import sys
+    from osm_stream import get_element
+
+    # sample.osm is cut off in the middle of an element
+    stamps = [elem.get('timestamp')
+              for elem in get_element(sys.argv[1], truncated=True)
+              if elem.get('timestamp')]
+    for name, rate in sorted(benchmark(stamps).items()):
+        print('{0:16s} {1:12,.0f} timestamps/sec'.format(name, rate))
+    print(parse_timestamp.stats())
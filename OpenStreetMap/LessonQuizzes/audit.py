@@ -122,6 +122,8 @@ import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+# the notebook's readers and street normalizer (shared.py)
+from shared import open_osm, normalizer
 
 OSMFILE = "example.osm"
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -151,26 +153,27 @@ def is_street_name(elem):
 
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
+    osm_file = open_osm(osmfile)
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    context = iter(ET.iterparse(osm_file, events=("start", "end")))
+    _, root = next(context)
+    for event, elem in context:
 
-        if elem.tag == "node" or elem.tag == "way":
+        if event == "end" and (elem.tag == "node" or elem.tag == "way"):
             for tag in elem.iter("tag"):
                 if is_street_name(tag):
                     audit_street_type(street_types, tag.attrib['v'])
+            # free the processed element and its siblings
+            root.clear()
     osm_file.close()
     return street_types
 
 
+# mapping is compiled once into a single pattern with a bounded cache of
+# fixed names (osm_streets); anchored=True expands the street type at the
+# end of the name only, like street_type_re
 def update_name(name, mapping):
-    m = street_type_re.search(name)
-    if m:
-        street_type = m.group()
-        if street_type in mapping:
-            name = name.split(street_type)[0] + mapping[street_type]
-
-    return name
+    return normalizer(mapping, anchored=True)(name)
 
 
 def test():
@@ -186,6 +189,7 @@ def test():
                 assert better_name == "West Lexington Street"
             if name == "Baldwin Rd.":
                 assert better_name == "Baldwin Road"
+    assert update_name("St. Johns Ave", mapping) == "St. Johns Avenue"
 
 
 if __name__ == '__main__':
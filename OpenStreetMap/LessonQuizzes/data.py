@@ -114,6 +114,9 @@ import pprint
 import re
 import codecs
 import json
+# the notebook's readers, interner and key classifier, with its bounded
+# key cache shared with tags.py (shared.py)
+from shared import open_osm, classify_key, CREATED_FIELDS, Interner
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -202,6 +205,11 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
+# one shared copy of the users, uids, changesets, versions, tag keys and
+# values that repeat; process_map keeps all the documents.  Each table is
+# bounded (osm_intern), and timestamps are left alone: they are unique
+interner = Interner()
+
 
 def shape_element(element):
     node = {}
@@ -209,7 +217,8 @@ def shape_element(element):
         # created dict
         node['created'] = {}
         for k in CREATED:
-            node['created'][k] = element.get(k)
+            value = element.get(k)
+            node['created'][k] = interner.intern(k, value) if k in CREATED_FIELDS else value
             
         # position array
         if element.attrib.get('lat') and element.attrib.get('lon'):
@@ -225,14 +234,14 @@ def shape_element(element):
             
         # process tags
         for tag in element.iter('tag'):
-            key = tag.attrib['k']
-            value = tag.attrib['v']
-            if not problemchars.search(key):
+            key = interner.intern('keys', tag.attrib['k'])
+            value = interner.intern('values', tag.attrib['v'])
+            if classify_key(key) != 'problemchars':
                 if key[:5] == 'addr:':
                     if 'address' not in node:
                         node['address'] = {}
                     if ':' not in key[5:]:
-                        node['address'][key[5:]] = value
+                        node['address'][interner.intern('keys', key[5:])] = value
         
         # process nodes
         for nd in element.iter('nd'):
@@ -248,14 +257,22 @@ def process_map(file_in, pretty = False):
     file_out = "{0}.json".format(file_in)
     data = []
     with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
+        osm_file = open_osm(file_in)
+        context = iter(ET.iterparse(osm_file, events=('start', 'end')))
+        _, root = next(context)
+        for event, element in context:
+            if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+                continue
             el = shape_element(element)
+            # free the processed element and its siblings
+            root.clear()
             if el:
                 data.append(el)
                 if pretty:
                     fo.write(json.dumps(el, indent=2)+"\n")
                 else:
                     fo.write(json.dumps(el) + "\n")
+        osm_file.close()
     return data
 
 def test():
@@ -264,6 +281,8 @@ def test():
     # additional spaces to the output, making it significantly larger.
     data = process_map('example.osm', True)
     #pprint.pprint(data)
+    # hits, misses and hit_rate of the shared key cache
+    pprint.pprint(classify_key.stats())
     
     correct_first_elem = {
         "id": "261114295", 
@@ -0,0 +1,19 @@
+"""The notebook's modules, for the quiz answers.
+
+The quizzes read .osm, .osm.bz2 and .osm.gz files the way the notebook
+does and reuse its tag key classifier, street name normalizer and string
+interner.  These live in ../Austin_OSM; importing this module puts that
+directory on sys.path once, so each quiz takes what it needs from here.
+"""
+import os
+import sys
+
+AUSTIN_OSM = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'Austin_OSM')
+if AUSTIN_OSM not in sys.path:
+    sys.path.append(AUSTIN_OSM)
+
+from osm_decompress import open_osm  # noqa: E402
+from osm_intern import CREATED_FIELDS, Interner  # noqa: E402
+from osm_keys import classify_key  # noqa: E402
+from osm_streets import normalizer  # noqa: E402
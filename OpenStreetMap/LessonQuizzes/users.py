@@ -62,6 +62,8 @@
 import xml.etree.cElementTree as ET
 import pprint
 import re
+# the notebook's readers (shared.py)
+from shared import open_osm
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -70,18 +72,22 @@ have contributed to the map in this particular area!
 The function process_map should return a set of unique user IDs ("uid")
 """
 def get_user(element):
-    users = set()
-    for e in element:
-        if 'uid' in e.attrib:
-            users.add(e.attrib['uid'])
-    return users
+    return element.attrib.get('uid')
 
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
-        users = get_user(element)
-
+    osm_file = open_osm(filename)
+    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag in ('node', 'way', 'relation'):
+            uid = get_user(element)
+            if uid is not None:
+                users.add(uid)
+            # free the processed element and its siblings
+            root.clear()
+    osm_file.close()
     return users
 
 